@@ -2,6 +2,8 @@
 #include <numpy/arrayobject.h>
 #include <math.h>
 #include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
 #include "evrot_extensions.h"
 
 // Utilities
@@ -196,9 +198,217 @@ static PyObject *build_Uab(PyObject *self, PyObject *args) {
     return PyArray_Return(Uab); 
 }
 
+// Quality (Zelnik-Manor & Perona's J) of the rotated eigenvectors Y,
+// ndata x dim, row-major
+double evqual_rows(double *Y, npy_intp ndata, npy_intp dim) {
+    npy_intp r, col;
+    double *row, sq, max_sq, total;
+
+    total = 0;
+    for (r = 0; r < ndata; r++) {
+        row = Y + r * dim;
+        max_sq = 0;
+        for (col = 0; col < dim; col++) {
+            sq = row[col] * row[col];
+            if (sq > max_sq) max_sq = sq;
+        }
+        for (col = 0; col < dim; col++) {
+            total += row[col] * row[col] / max_sq;
+        }
+    }
+    return 1 - (total / ndata - 1) / dim;
+}
+
+static PyObject *sweep(PyObject *self, PyObject *args) {
+    // One pass of the gradient descent over every Givens angle, as the
+    // loop over angles in evrot.main: angle d takes a step of alpha times
+    // the gradient, which is kept if it improves the quality. theta is
+    // updated in place and the new quality returned.
+    // Y = X.U(0..d-1).G(d).U(d+1..) is kept up to date, with the prefix
+    // X.U(0..d-1) and the suffix U(d+1..) (from the rotation at the start
+    // of the pass, undone one angle at a time). Each angle then costs
+    // O(ndata * dim): a Givens rotation only touches two columns of the
+    // prefix and two rows of the suffix.
+
+    // arguments
+    PyArrayObject *X, *theta, *ik, *jk;
+    double alpha, Q;
+
+    // locals
+    npy_intp ndata, dim, angle_num, r, col, d, i, j, mx;
+    double *p_X, *p_theta, *XU, *S, *Y, *Ytrial, *swap, *ai, *aj;
+    double c, s, c_new, s_new, dc, ds, tmp, xi, xj, sq, max_sq, m;
+    double A, dJ, theta_new, Q_new;
+    npy_long *p_ik, *p_jk;
+
+    // parse input
+    if (!PyArg_ParseTuple(args, "O!O!O!O!dd",
+        &PyArray_Type, &X,
+        &PyArray_Type, &theta,
+        &PyArray_Type, &ik,
+        &PyArray_Type, &jk,
+        &alpha, &Q)) return NULL;
+
+    // type checking
+    if (X->nd != 2 || X->descr->type_num != NPY_DOUBLE
+        || !PyArray_ISCARRAY_RO(X)) {
+        PyErr_SetString(PyExc_ValueError,
+        "X must be a C-contiguous two-dimensional float array");
+        return NULL;
+    }
+    if (theta->nd != 1 || theta->descr->type_num != NPY_DOUBLE
+        || !PyArray_ISCARRAY(theta)) {
+        PyErr_SetString(PyExc_ValueError,
+        "theta must be a writeable, contiguous one-dimensional float array");
+        return NULL;
+    }
+    if (ik->nd != 1 || ik->descr->type_num != NPY_LONG
+        || !PyArray_ISCARRAY_RO(ik)) {
+        PyErr_SetString(PyExc_ValueError,
+        "ik must be a contiguous one-dimensional integer array");
+        return NULL;
+    }
+    if (jk->nd != 1 || jk->descr->type_num != NPY_LONG
+        || !PyArray_ISCARRAY_RO(jk)) {
+        PyErr_SetString(PyExc_ValueError,
+        "jk must be a contiguous one-dimensional integer array");
+        return NULL;
+    }
+
+    ndata = X->dimensions[0];
+    dim = X->dimensions[1];
+    angle_num = theta->dimensions[0];
+    if (ik->dimensions[0] < angle_num || jk->dimensions[0] < angle_num) {
+        PyErr_SetString(PyExc_ValueError,
+        "ik and jk need an entry for every angle");
+        return NULL;
+    }
+    p_X = (double *) X->data;
+    p_theta = (double *) theta->data;
+    p_ik = (npy_long *) ik->data;
+    p_jk = (npy_long *) jk->data;
+
+    XU = (double *) malloc(ndata * dim * sizeof(double));
+    Y = (double *) malloc(ndata * dim * sizeof(double));
+    Ytrial = (double *) malloc(ndata * dim * sizeof(double));
+    S = (double *) malloc(dim * dim * sizeof(double));
+    ai = (double *) malloc(ndata * sizeof(double));
+    aj = (double *) malloc(ndata * sizeof(double));
+    if (!XU || !Y || !Ytrial || !S || !ai || !aj) {
+        free(XU); free(Y); free(Ytrial); free(S); free(ai); free(aj);
+        return PyErr_NoMemory();
+    }
+
+    // S = the whole rotation, built as in build_Uab; Y = X.S
+    for (i = 0; i < dim; i++) {
+        for (j = 0; j < dim; j++) S[i * dim + j] = (i == j);
+    }
+    for (d = 0; d < angle_num; d++) {
+        i = p_ik[d];
+        j = p_jk[d];
+        c = cos(p_theta[d]);
+        s = sin(p_theta[d]);
+        for (r = 0; r < dim; r++) {
+            tmp = S[r * dim + i] * c - S[r * dim + j] * s;
+            S[r * dim + j] = S[r * dim + i] * s + S[r * dim + j] * c;
+            S[r * dim + i] = tmp;
+        }
+    }
+    memcpy(XU, p_X, ndata * dim * sizeof(double));
+    for (r = 0; r < ndata; r++) {
+        for (col = 0; col < dim; col++) {
+            tmp = 0;
+            for (d = 0; d < dim; d++) {
+                tmp += p_X[r * dim + d] * S[d * dim + col];
+            }
+            Y[r * dim + col] = tmp;
+        }
+    }
+
+    for (d = 0; d < angle_num; d++) {
+        i = p_ik[d];
+        j = p_jk[d];
+        c = cos(p_theta[d]);
+        s = sin(p_theta[d]);
+
+        // suffix: take rotation d off the front of S (rows i and j)
+        for (col = 0; col < dim; col++) {
+            tmp = S[i * dim + col] * c - S[j * dim + col] * s;
+            S[j * dim + col] = S[i * dim + col] * s + S[j * dim + col] * c;
+            S[i * dim + col] = tmp;
+        }
+
+        // gradient: A = X.U(0..d-1).dG(d).U(d+1..), where the derivative
+        // of the rotation only fills columns i and j
+        dJ = 0;
+        for (r = 0; r < ndata; r++) {
+            xi = XU[r * dim + i];
+            xj = XU[r * dim + j];
+            ai[r] = -s * xi - c * xj;
+            aj[r] = c * xi - s * xj;
+            max_sq = -1;
+            mx = 0;
+            for (col = 0; col < dim; col++) {
+                sq = Y[r * dim + col] * Y[r * dim + col];
+                if (sq > max_sq) {
+                    max_sq = sq;
+                    mx = col;
+                }
+            }
+            m = Y[r * dim + mx];
+            A = ai[r] * S[i * dim + mx] + aj[r] * S[j * dim + mx];
+            for (col = 0; col < dim; col++) {
+                tmp = ai[r] * S[i * dim + col] + aj[r] * S[j * dim + col];
+                dJ += tmp * Y[r * dim + col] / (m * m)
+                    - A * Y[r * dim + col] * Y[r * dim + col] / (m * m * m);
+            }
+        }
+        dJ = 2 * dJ / ndata / dim;
+
+        // trial step: Y changes by X.U(0..d-1).(G'(d) - G(d)).U(d+1..)
+        theta_new = p_theta[d] - alpha * dJ;
+        c_new = cos(theta_new);
+        s_new = sin(theta_new);
+        dc = c_new - c;
+        ds = s_new - s;
+        for (r = 0; r < ndata; r++) {
+            xi = XU[r * dim + i];
+            xj = XU[r * dim + j];
+            ai[r] = dc * xi - ds * xj;
+            aj[r] = ds * xi + dc * xj;
+            for (col = 0; col < dim; col++) {
+                Ytrial[r * dim + col] = Y[r * dim + col]
+                    + ai[r] * S[i * dim + col] + aj[r] * S[j * dim + col];
+            }
+        }
+        Q_new = evqual_rows(Ytrial, ndata, dim);
+        if (Q_new > Q) {
+            p_theta[d] = theta_new;
+            Q = Q_new;
+            c = c_new;
+            s = s_new;
+            swap = Y;
+            Y = Ytrial;
+            Ytrial = swap;
+        }
+
+        // prefix: apply rotation d, at its final angle, to columns i and j
+        for (r = 0; r < ndata; r++) {
+            tmp = XU[r * dim + i] * c - XU[r * dim + j] * s;
+            XU[r * dim + j] = XU[r * dim + i] * s + XU[r * dim + j] * c;
+            XU[r * dim + i] = tmp;
+        }
+    }
+
+    free(XU); free(Y); free(Ytrial); free(S); free(ai); free(aj);
+    return Py_BuildValue("d", Q);
+}
+
 static PyMethodDef evrot_extensions_methods[] = {
     {"build_Uab", build_Uab, METH_VARARGS},
-    {"sum_dJ", sum_dJ, METH_VARARGS}
+    {"sum_dJ", sum_dJ, METH_VARARGS},
+    {"sweep", sweep, METH_VARARGS},
+    {NULL, NULL, 0, NULL}
 };
 
 void initevrot_extensions() {
@@ -2,5 +2,7 @@ double *pyvector_to_Carraypxtrs(PyArrayObject *arrayin);
 double **pymatrix_to_Carraypxtrs(PyArrayObject *arrayin);
 double **ptrvector(long n);
 void free_Carrayptrs(double **v);
+double evqual_rows(double *Y, npy_intp ndata, npy_intp dim);
 static PyObject *build_Uab(PyObject *self, PyObject *args);
-static PyObject *sum_dJ(PyObject *self, PyObject *args);
\ No newline at end of file
+static PyObject *sum_dJ(PyObject *self, PyObject *args);
+static PyObject *sweep(PyObject *self, PyObject *args);
\ No newline at end of file
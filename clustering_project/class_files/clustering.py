@@ -13,36 +13,82 @@ if import_debugging:
 from scipy.cluster.hierarchy import linkage, fcluster, dendrogram
 if import_debugging:
     print '  scipy.cluster.hierarchy::linkage, fcluster, dendrogram (cl)'
-from Bio.Cluster import kmedoids
+from scipy import sparse
+from scipy.sparse.linalg import eigsh
 if import_debugging:
-    print '  Bio.Cluster::kmedoids (cl)'
+    print '  scipy.sparse::linalg.eigsh (cl)'
+import scipy.linalg
+if import_debugging:
+    print '  scipy.linalg (cl)'
+import medoids
+if import_debugging:
+    print '  medoids (cl)'
 import matplotlib.pyplot as plt
 if import_debugging:
     print '  matplotlib.pyplot (cl)'
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 if import_debugging:
-    print '  sklearn.cluster::KMeans (cl)'
+    print '  sklearn.cluster::KMeans, MiniBatchKMeans (cl)'
 from collections import defaultdict
 if import_debugging:
     print '  collections::defaultdict (cl)'
 import evrot
 if import_debugging:
     print '  evrot (cl)'
+from decomposition_cache import DecompositionCache
+if import_debugging:
+    print '  decomposition_cache::DecompositionCache (cl)'
 import cPickle
 
+# Pruned spectral clustering of this many trees or more uses sparse affinity
+# and Laplacian matrices, and a partial eigendecomposition
+
+SPARSE_SIZE = 2000
+
+# Matrices of this size or less are always fully decomposed: finding only
+# the leading eigenpairs doesn't pay
+
+TRUNCATE_SIZE = 200
+
+# Eigenvalues above -NEGATIVE_TOLERANCE times the trace are taken as
+# rounding error, not as negative variance
+
+NEGATIVE_TOLERANCE = 1e-9
+
+# Methods run by cutting a scipy linkage tree
+
+HIERARCHICAL_METHODS = ('single', 'complete', 'average', 'ward')
+
+# KMeans of this many points or more uses MiniBatchKMeans; below it, Elkan's
+# algorithm is used for embeddings of up to ELKAN_DIMENSIONS dimensions
+
+MINIBATCH_SIZE = 10000
+ELKAN_DIMENSIONS = 50
+
+
 class Clustering(object):
 
     """
     Apply clustering methods to distance matrix
     """
 
-    def __init__(self):
+    def __init__(self, cache_bytes=2 ** 30, n_jobs=1):
         """
         self.partitions uses a compound key to retrieve partitions
         key = tuple of (distance_metric, linkage_method, num_classes)
+        Laplacians, double-centred matrices and their eigendecompositions
+        are kept in self.cache (a DecompositionCache holding at most
+        cache_bytes of arrays), keyed by (distance matrix fingerprint,
+        method, prune, sigma7, noise).
+        KMeans labels are kept in self.kmeans_solutions, by the same keys
+        and then number of clusters, to warm-start other numbers of
+        clusters on the same embedding. n_jobs processes run KMeans
+        restarts.
         """
 
-        self.cache = {}
+        self.cache = DecompositionCache(cache_bytes)
+        self.kmeans_solutions = {}
+        self.n_jobs = n_jobs
 
     def __str__(self):
         pass
@@ -58,20 +104,109 @@ class Clustering(object):
         #     s += ' '.join(str(x) for x in p) + '\n'
         # return s
 
+    def __setstate__(self, state):
+
+        # objects pickled before the keyed cache held a plain dict
+
+        if not isinstance(state.get('cache'), DecompositionCache):
+            state['cache'] = DecompositionCache()
+        state.setdefault('kmeans_solutions', {})
+        state.setdefault('n_jobs', 1)
+        self.__dict__.update(state)
+
     def clear_cache(self):
-        self.cache = {}
+        self.cache.clear()
+        self.kmeans_solutions = {}
 
-    def run_kmedoids(self, dm, nclusters):
+    def cache_key(
+        self,
+        dm,
+        method,
+        prune=None,
+        sigma7=None,
+        noise=None,
+        ):
+
+        return (dm.fingerprint(), method, prune, sigma7, noise)
 
+    def get_decomposition(
+        self,
+        key,
+        matrix_function,
+        nvectors=None,
+        cutoff=None,
+        standardize=False,
+        recalculate=False,
+        ):
+        """
+        (eigvals, eigvecs, cve) of the matrix from matrix_function(),
+        reusing the cached matrix and decomposition under key. A cached
+        truncated decomposition (see get_eigen) with fewer than nvectors
+        eigenvectors, or made for a lower cutoff, is redone from the cached
+        matrix.
+        """
+
+        entry = (None if recalculate else self.cache.get(key))
+        if entry is None:
+            entry = {'matrix': matrix_function()}
+        matrix = entry['matrix']
+
+        def sufficient(entry):
+            if 'decomp' not in entry:
+                return False
+            found = entry['decomp'][1].shape[1]
+            if found == matrix.shape[0]:
+                return True
+            if nvectors is None and cutoff is None:
+                return False
+            if nvectors is not None and found < nvectors:
+                return False
+            return cutoff is None or entry['cutoff'] is not None \
+                and entry['cutoff'] >= cutoff
+
+        if not sufficient(entry):
+            entry['decomp'] = self.get_eigen(matrix,
+                    standardize=standardize, nvectors=nvectors,
+                    cutoff=cutoff)
+            entry['cutoff'] = cutoff
+            self.cache.put(key, entry)
+        return entry['decomp']
+
+    def run_kmedoids(
+        self,
+        dm,
+        nclusters,
+        nstarts=10,
+        n_jobs=None,
+        sample_size=None,
+        nsamples=5,
+        seed=None,
+        ):
+        """
+        Best of nstarts runs of PAM (see medoids.kmedoids), shared among
+        n_jobs processes (self.n_jobs by default). Given a sample_size,
+        CLARA is used instead: PAM on nsamples samples of that many trees,
+        reading only the sampled and medoid rows of the distance matrix.
+        """
+
+        if n_jobs is None:
+            n_jobs = self.n_jobs
         if dm.metric == 'rf':
-            matrix = dm.add_noise(dm.matrix)
+            matrix = dm.add_noise()
         else:
-            matrix = dm.matrix
+            matrix = None
 
-        p = [kmedoids(matrix, nclusters=nclusters, npass=100) for _ in
-             range(100)]
-        p.sort(key=lambda x: x[1])
-        T = self.order(p[0][0])
+        if sample_size:
+            (clusterid, error, _) = medoids.clara(lambda rows: \
+                    dm.get_rows(rows, matrix), len(dm), nclusters,
+                    sample_size=sample_size, nsamples=nsamples,
+                    n_jobs=n_jobs, seed=seed)
+        else:
+            if matrix is None:
+                matrix = dm.dense()
+            (clusterid, error, _) = medoids.kmedoids(matrix, nclusters,
+                    nstarts=nstarts, n_jobs=n_jobs, seed=seed)
+        T = self.order(clusterid)
         return T
 
     def run_spectral(
@@ -81,6 +216,7 @@ class Clustering(object):
         prune=True,
         sigma7=False,
         recalculate=False,
+        use_sparse=None,
         ):
 
         if dm.metric == 'rf':
@@ -88,21 +224,15 @@ class Clustering(object):
         else:
             noise = False
 
-        if recalculate or not 'spectral_decomp' in self.cache:
-            laplacian = self.spectral(dm, prune=prune, sigma7=sigma7,
-                add_noise=noise)
-
-            (eigvals, eigvecs, cve) = self.get_eigen(laplacian,
-                    standardize=False)
-            self.cache['spectral_decomp'] = (eigvals, eigvecs, cve)
-            self.cache['laplacian'] = laplacian
-        else:
-
-            (eigvals, eigvecs, cve) = self.cache['spectral_decomp']
+        key = self.cache_key(dm, 'spectral', prune, sigma7, noise)
+        (eigvals, eigvecs, cve) = self.get_decomposition(key, lambda : \
+                self.spectral(dm, prune=prune, sigma7=sigma7,
+                add_noise=noise, use_sparse=use_sparse),
+                nvectors=nclusters, recalculate=recalculate)
 
         coords = self.get_coords_by_dimension(eigvals, eigvecs, cve,
                 nclusters, normalise=True)[0]
-        T = self.run_KMeans(coords, nclusters)
+        T = self.run_KMeans(coords, nclusters, warm_key=key)
         return T
 
     def run_spectral_rotate(
@@ -114,35 +244,30 @@ class Clustering(object):
         max_groups=None,
         min_groups=2,
         verbose=True,
+        use_sparse=None,
         ):
 
         if dm.metric == 'rf':
             noise = True
         else:
             noise = False
-        if recalculate or not 'spectral_decomp' in self.cache:
-            laplacian = self.spectral(dm, prune=prune, add_noise=noise)
-
-            (eigvals, eigvecs, cve) = self.get_eigen(laplacian,
-                    standardize=False)
-            self.cache['spectral_decomp'] = (eigvals, eigvecs, cve)
-            self.cache['laplacian'] = laplacian
-        else:
-
-            (eigvals, eigvecs, cve) = self.cache['spectral_decomp']
+        size = len(dm)
+        if not max_groups:
+            max_groups = int(np.sqrt(size) + np.power(size, 1.0 / 3))
+        key = self.cache_key(dm, 'spectral', prune, False, noise)
+        (eigvals, eigvecs, cve) = self.get_decomposition(key, lambda : \
+                self.spectral(dm, prune=prune, add_noise=noise,
+                use_sparse=use_sparse), nvectors=max_groups,
+                recalculate=recalculate)
 
         # ######################
         # CLUSTER_ROTATE STUFF HERE
 
-        M = dm.matrix
-        if not max_groups:
-            max_groups = int(np.sqrt(M.shape[0]) + np.power(M.shape[0],
-                             1.0 / 3))
         (nclusters, clustering, quality_scores, rotated_vectors) = \
             self.cluster_rotate(eigvecs, max_groups=max_groups,
                                 min_groups=min_groups)
 
-        translate_clustering = [None] * len(M)
+        translate_clustering = [None] * size
         no_of_empty_clusters = 0
         for (group_number, group_membership) in enumerate(clustering):
             if len(group_membership) == 0:
@@ -182,21 +307,19 @@ class Clustering(object):
             noise = True
         else:
             noise = False
-        if recalculate or not 'NJW_decomp' in self.cache:
-            laplacian = self.NJW(matrix, sigma=np.median(matrix),
-                                 add_noise=noise)
 
-            (eigvals, eigvecs, cve) = self.get_eigen(laplacian,
-                    standardize=False)
-            self.cache['NJW_decomp'] = (eigvals, eigvecs, cve)
-            self.cache['NJW_laplacian'] = laplacian
-        else:
+        def laplacian():
+            matrix = (dm.add_noise() if noise else dm.dense())
+            matrix = np.asarray(matrix, dtype=np.float)
+            return self.NJW(matrix, sigma=np.median(matrix))
 
-            (eigvals, eigvecs, cve) = self.cache['NJW_decomp']
+        key = self.cache_key(dm, 'NJW', noise=noise)
+        (eigvals, eigvecs, cve) = self.get_decomposition(key, laplacian,
+                recalculate=recalculate)
 
         coords = self.get_coords_by_dimension(eigvals, eigvecs, cve,
                 nclusters, normalise=True)[0]
-        T = self.run_KMeans(coords, nclusters)
+        T = self.run_KMeans(coords, nclusters, warm_key=key)
         return T
 
     def run_ShiMalik(
@@ -210,84 +333,208 @@ class Clustering(object):
             noise = True
         else:
             noise = False
-        if recalculate or not 'SM_decomp' in self.cache:
-            laplacian = self.ShiMalik(matrix, sigma=np.median(matrix),
-                    add_noise=noise)
 
-            (eigvals, eigvecs, cve) = self.get_eigen(laplacian,
-                    standardize=False)
-            self.cache['SM_decomp'] = (eigvals, eigvecs, cve)
-            self.cache['SM_laplacian'] = laplacian
-        else:
+        def laplacian():
+            matrix = (dm.add_noise() if noise else dm.dense())
+            matrix = np.asarray(matrix, dtype=np.float)
+            return self.ShiMalik(matrix, sigma=np.median(matrix))
 
-            (eigvals, eigvecs, cve) = self.cache['SM_decomp']
+        key = self.cache_key(dm, 'ShiMalik', noise=noise)
+        (eigvals, eigvecs, cve) = self.get_decomposition(key, laplacian,
+                recalculate=recalculate)
 
         coords = self.get_coords_by_dimension(eigvals, eigvecs, cve,
                 nclusters, normalise=True)[0]
-        T = self.run_KMeans(coords, nclusters)
+        T = self.run_KMeans(coords, nclusters, warm_key=key)
         return T
 
-    def run_hierarchical(
+    def get_linkage(
         self,
         dm,
-        nclusters,
         linkage_method,
+        recalculate=False,
         ):
+        """
+        scipy linkage matrix of the distances, built once per distance
+        matrix and method and kept in the cache
+        """
 
-        if dm.metric == 'rf':
-            matrix = dm.add_noise(dm.matrix)
-        else:
-            matrix = dm.matrix
+        noise = dm.metric == 'rf'
+        key = self.cache_key(dm, linkage_method, noise=noise)
+        entry = (None if recalculate else self.cache.get(key))
+        if entry is None:
+
+            # linkage takes distances in condensed (upper triangle) form; a
+            # square array would be read as a matrix of observation vectors
+
+            matrix = dm.get_condensed(add_noise=noise)
+            entry = {'linkage': linkage(matrix, linkage_method)}
+            self.cache.put(key, entry)
+        return entry['linkage']
+
+    @staticmethod
+    def cut_thresholds(linkmat, nclusters):
+        """
+        Heights at which to cut a linkage tree to get each number of
+        clusters in nclusters: halfway between the merge that would leave
+        fewer clusters and the one below it
+        """
 
-        linkmat = linkage(matrix, linkage_method)
+        heights = linkmat[:, 2]
         linkmat_size = len(linkmat)
-        if nclusters <= 1:
-            br_top = linkmat[linkmat_size - nclusters][2]
-        else:
-            br_top = linkmat[linkmat_size - nclusters + 1][2]
-        if nclusters >= len(linkmat):
-            br_bottom = 0
-        else:
-            br_bottom = linkmat[linkmat_size - nclusters][2]
-        threshold = 0.5 * (br_top + br_bottom)
-        T = fcluster(linkmat, threshold, criterion='distance')
-        T = self.order(T)
-        return T
+        nclusters = np.asarray(nclusters)
+        top = np.where(nclusters <= 1, linkmat_size - nclusters,
+                       linkmat_size - nclusters + 1)
+        br_top = heights[np.clip(top, 0, linkmat_size - 1)]
+        br_bottom = np.where(nclusters >= linkmat_size, 0,
+                             heights[np.clip(linkmat_size - nclusters, 0,
+                             linkmat_size - 1)])
+        return 0.5 * (br_top + br_bottom)
 
-    def run_MDS(
+    def run_hierarchical(
         self,
         dm,
         nclusters,
+        linkage_method,
         recalculate=False,
         ):
 
-        if recalculate or not 'MDS_decomp' in self.cache:
+        return self.run_hierarchical_cuts(dm, [nclusters], linkage_method,
+                recalculate=recalculate)[0]
 
-            if dm.metric == 'rf':
-                noise = True
-            else:
-                noise = False
+    def run_hierarchical_cuts(
+        self,
+        dm,
+        nclusters,
+        linkage_method,
+        recalculate=False,
+        ):
+        """
+        Partitions for each number of clusters in nclusters, all cut from
+        one linkage tree
+        """
 
-            dbc = dm.get_double_centre(add_noise=noise)
-            (eigvals, eigvecs, cve) = self.get_eigen(dbc,
-                    standardize=True)
-            self.cache['MDS_decomp'] = (eigvals, eigvecs, cve)
-            self.cache['dbc'] = dbc
+        linkmat = self.get_linkage(dm, linkage_method,
+                                   recalculate=recalculate)
+        return [self.order(fcluster(linkmat, threshold,
+                criterion='distance')) for threshold in
+                self.cut_thresholds(linkmat, nclusters)]
+
+    def run_MDS(
+        self,
+        dm,
+        nclusters,
+        recalculate=False,
+        ):
+
+        if dm.metric == 'rf':
+            noise = True
         else:
+            noise = False
 
-            (eigvals, eigvecs, cve) = self.cache['MDS_decomp']
+        key = self.cache_key(dm, 'MDS', noise=noise)
+        (eigvals, eigvecs, cve) = self.get_decomposition(key, lambda : \
+                dm.get_double_centre(add_noise=noise), cutoff=95,
+                standardize=True, recalculate=recalculate)
 
         coords = self.get_coords_by_cutoff(eigvals, eigvecs, cve, 95,
                 normalise=False)
-        T = self.run_KMeans(coords, nclusters)
+        T = self.run_KMeans(coords, nclusters, warm_key=key)
         return T
 
-    def run_KMeans(self, coords, nclusters):
-        est = KMeans(n_clusters=nclusters)
-        est.fit(coords)
+    def run_KMeans(
+        self,
+        coords,
+        nclusters,
+        n_init=10,
+        warm_n_init=2,
+        warm_key=None,
+        random_state=None,
+        ):
+        """
+        KMeans of the embedded coordinates: MiniBatchKMeans for
+        MINIBATCH_SIZE points or more, otherwise KMeans (Elkan's algorithm
+        in up to ELKAN_DIMENSIONS dimensions), with n_init k-means++
+        restarts run by self.n_jobs processes.
+        Given a warm_key, a solution kept under it for another number of
+        clusters (see warm_start_centres) seeds one more run and only
+        warm_n_init k-means++ restarts are made; the lower inertia wins.
+        The solution is kept under warm_key in turn.
+        """
+
+        def fit(init, n_init):
+            if len(coords) >= MINIBATCH_SIZE:
+                est = MiniBatchKMeans(n_clusters=nclusters, init=init,
+                        n_init=n_init, random_state=random_state)
+            else:
+                algorithm = ('elkan' if coords.shape[1]
+                             <= ELKAN_DIMENSIONS else 'full')
+                est = KMeans(n_clusters=nclusters, init=init,
+                             n_init=n_init, algorithm=algorithm,
+                             n_jobs=self.n_jobs, random_state=random_state)
+            return est.fit(coords)
+
+        centres = self.warm_start_centres(coords, nclusters, warm_key,
+                random_state)
+        if centres is None:
+            est = fit('k-means++', n_init)
+        else:
+            est = min(fit(centres, 1), fit('k-means++', warm_n_init),
+                      key=lambda est: est.inertia_)
+        if warm_key is not None:
+            self.kmeans_solutions.setdefault(warm_key,
+                    {})[nclusters] = est.labels_
         T = self.order(est.labels_)
         return T
 
+    def warm_start_centres(
+        self,
+        coords,
+        nclusters,
+        warm_key,
+        random_state=None,
+        ):
+        """
+        Starting centres for KMeans from the kept solution under warm_key
+        with the nearest number of clusters (the smaller, on ties): the
+        means of its clusters in these coordinates, which may have a
+        different number of dimensions. Extra centres are added by
+        k-means++ sampling; surplus ones are removed by merging the
+        closest pair. None if there is no kept solution.
+        """
+
+        solutions = self.kmeans_solutions.get(warm_key)
+        if not solutions:
+            return None
+        nearest_k = min(solutions, key=lambda k: (abs(k - nclusters), k))
+        (groups, labels) = np.unique(solutions[nearest_k],
+                                     return_inverse=True)
+        if len(labels) != len(coords):
+            return None
+        counts = np.bincount(labels).astype(np.float)
+        centres = np.array([np.bincount(labels, weights=column)
+                           for column in coords.T]).T / counts[:, None]
+        while len(centres) > nclusters:
+            gaps = ((centres[:, None] - centres[None]) ** 2).sum(axis=2)
+            gaps[np.diag_indices(len(centres))] = np.inf
+            (i, j) = np.unravel_index(gaps.argmin(), gaps.shape)
+            centres[i] = (counts[i] * centres[i] + counts[j] * centres[j]) \
+                / (counts[i] + counts[j])
+            counts[i] += counts[j]
+            centres = np.delete(centres, j, axis=0)
+            counts = np.delete(counts, j)
+        rng = np.random.RandomState(random_state)
+        sq_norms = (coords ** 2).sum(axis=1)
+        while len(centres) < nclusters:
+            gaps = np.maximum((sq_norms[:, None] - 2 * coords.dot(centres.T)
+                              + (centres ** 2).sum(axis=1)).min(axis=1), 0)
+            if gaps.sum() > 0:
+                new = rng.choice(len(coords), p=gaps / gaps.sum())
+            else:
+                new = rng.randint(len(coords))
+            centres = np.vstack((centres, coords[new]))
+        return centres
+
     def run_clustering(
         self,
         dm,
@@ -320,8 +567,9 @@ class Clustering(object):
                     recalculate=recalculate)
         elif method == 'MDS':
             return self.run_MDS(dm, nclusters, recalculate=recalculate)
-        elif method in ['single', 'complete', 'average', 'ward']:
-            return self.run_hierarchical(dm, nclusters, method)
+        elif method in HIERARCHICAL_METHODS:
+            return self.run_hierarchical(dm, nclusters, method,
+                    recalculate=recalculate)
         else:
             print 'Unrecognised method: {0}'.format(method)
 
@@ -423,7 +671,13 @@ class Clustering(object):
 
     # ## Methods for eigen decomposition
 
-    def get_eigen(self, matrix, standardize=False):
+    def get_eigen(
+        self,
+        matrix,
+        standardize=False,
+        nvectors=None,
+        cutoff=None,
+        ):
         """
         Calculates the eigenvalues and eigenvectors from the double-
         centred matrix
@@ -431,17 +685,108 @@ class Clustering(object):
         percentage of variance explained)
         eigenvalues and eigenvectors are sorted in order of eigenvalue
         magnitude, high to low 
+        Given nvectors, or a cutoff percentage of variance, only the
+        leading eigenpairs are found (see get_leading_eigen), unless the
+        matrix has TRUNCATE_SIZE rows or fewer; the cumulative percentages
+        are then of the total from get_leading_eigen.
         """
 
-        (vals, vecs) = np.linalg.eigh(matrix)
+        size = matrix.shape[0]
+        truncate = (nvectors is not None or cutoff is not None) and size \
+            > TRUNCATE_SIZE and (nvectors is None or nvectors < size - 1)
+        if truncate:
+            (vals, vecs, total) = self.get_leading_eigen(matrix,
+                    nvectors=nvectors, cutoff=cutoff)
+        else:
+            if sparse.issparse(matrix):
+                matrix = matrix.toarray()
+            (vals, vecs) = np.linalg.eigh(matrix)
+            total = sum(abs(vals))
         ind = vals.argsort()[::-1]
         vals = vals[ind]
         vecs = vecs[:, ind]
-        cum_var_exp = np.cumsum(100 * abs(vals) / sum(abs(vals)))
+        cum_var_exp = np.cumsum(100 * abs(vals) / total)
         if standardize:
             vecs = vecs * np.sqrt(abs(vals))
         return (vals, vecs, cum_var_exp)
 
+    def get_leading_eigen(
+        self,
+        matrix,
+        nvectors=None,
+        cutoff=None,
+        ):
+        """
+        The largest eigenvalues of a symmetric matrix and their
+        eigenvectors: nvectors of them, or with a cutoff as many as it takes
+        (at least nvectors) for their share of the total variance (the
+        sum of the absolute eigenvalues) to reach cutoff percent.
+        Dense matrices: with a cutoff, every eigenvalue is found first
+        (without eigenvectors this costs a fraction of a full
+        decomposition), giving the exact total and the number needed; the
+        eigenvectors are then found only for those, by LAPACK's subset
+        eigh (or all of them by a full decomposition, if that's more than a
+        quarter).
+        Sparse matrices: ARPACK's eigsh, with the number of eigenpairs
+        grown 4x at a time until the cutoff is reached.
+        Without the whole spectrum, the total is found as in
+        total_variance.
+        Returns (eigenvalues, eigenvectors, total), unsorted.
+        """
+
+        size = matrix.shape[0]
+        nvectors = min(nvectors or 1, size - 1)
+        if not sparse.issparse(matrix):
+            total = None
+            if cutoff is not None:
+                allvals = scipy.linalg.eigvalsh(matrix)[::-1]
+                total = abs(allvals).sum()
+                explained = np.cumsum(100 * abs(allvals) / total)
+                nvectors = max(nvectors, np.searchsorted(explained,
+                               cutoff) + 1)
+
+            # past about a quarter of the eigenvectors the subset costs as
+            # much as the lot
+
+            if nvectors > size // 4:
+                (vals, vecs) = np.linalg.eigh(matrix)
+                return (vals, vecs, abs(vals).sum())
+            (vals, vecs) = scipy.linalg.eigh(matrix, eigvals=(size
+                    - nvectors, size - 1))
+            if total is None:
+                total = self.total_variance(matrix)
+            return (vals, vecs, total)
+
+        total = self.total_variance(matrix)
+        if cutoff is not None:
+            nvectors = max(nvectors, min(8, size - 2))
+        while True:
+            (vals, vecs) = eigsh(matrix, k=nvectors, which='LA')
+            if cutoff is None or 100 * abs(vals).sum() / total >= cutoff:
+                return (vals, vecs, total)
+            if 4 * nvectors >= size - 1:
+                return self.get_leading_eigen(matrix.toarray(), nvectors,
+                        cutoff)
+            nvectors *= 4
+
+    @staticmethod
+    def total_variance(matrix):
+        """
+        Sum of the absolute eigenvalues of a symmetric matrix. If none is
+        negative (e.g. for the double-centred matrix of Euclidean
+        distances), as checked by finding the smallest, this is the trace.
+        Otherwise (e.g. for RF or geodesic distances) the trace would
+        underestimate it, so the whole spectrum is found.
+        """
+
+        trace = matrix.diagonal().sum()
+        lowest = eigsh(matrix, k=1, which='SA', return_eigenvectors=False)[0]
+        if lowest >= -NEGATIVE_TOLERANCE * abs(trace):
+            return trace
+        if sparse.issparse(matrix):
+            matrix = matrix.toarray()
+        return abs(scipy.linalg.eigvalsh(matrix)).sum()
+
     def get_coords_by_cutoff(
         self,
         vals,
@@ -456,7 +801,10 @@ class Clustering(object):
         in the cutoff)
         """
 
-        i = np.where(cum_var_exp >= cutoff)[0][0]
+        # a truncated decomposition may stop a rounding error short
+
+        reached = np.where(cum_var_exp >= cutoff)[0]
+        i = (reached[0] if len(reached) > 0 else len(cum_var_exp) - 1)
         coords_matrix = vecs[:, :i + 1]
 
         if normalise:
@@ -493,6 +841,7 @@ class Clustering(object):
         prune=True,
         sigma7=False,
         add_noise=False,
+        use_sparse=None,
         ):
         """
         1st: Calculates an affinity matrix from a distance matrix, using the
@@ -520,47 +869,20 @@ class Clustering(object):
         P Perona and L. Zelnik-Manor. (2004).
         Self-tuning spectral clustering.
         Advances in neural information processing systems, 2004 vol. 17 pp. 1601-1608
+
+        When pruning, use_sparse=True (the default, None, means for
+        SPARSE_SIZE or more trees) keeps the affinity and Laplacian
+        matrices as scipy.sparse matrices holding only the k-NN
+        adjacencies.
         """
         # if add_noise:
         #     dm = dm.noisy_copy()
-        size = len(dm.matrix)  # assume square and symmetrical input
+        size = len(dm)  # assume square and symmetrical input
         if size <= 10:  # no point pruning a small matrix
             prune = False
-
-        def isconnected(matrix):
-            """
-            Checks that all nodes are reachable from the first node - i.e. that
-            the graph is fully connected. The approach is borrowed from 
-            isconnected function from graph.c in Leigh's Conclustador program.
-            """
-
-            # INIT
-
-            matrix = np.array(matrix)
-            num_nodes = len(matrix)
-            checklist = [0]
-            checklength = 1
-            reachable = [0]
-
-            # ALGORITHM
-
-            while checklength > 0:
-                node = checklist.pop(0)
-                checklength -= 1
-                for edge in range(num_nodes):
-                    if matrix[node, edge] == 1:
-                        reachable_node = edge
-                        if reachable_node not in reachable:
-                            reachable.append(reachable_node)
-                            checklist.append(reachable_node)
-                            checklength += 1
-
-            # RESULT
-
-            for i in range(num_nodes):
-                if not i in reachable:
-                    return False
-            return True
+        if use_sparse is None:
+            use_sparse = size >= SPARSE_SIZE
+        use_sparse = use_sparse and prune
 
         def nodivzero(d):
             if 0 in d.values():
@@ -570,40 +892,44 @@ class Clustering(object):
 
         def laplace(affinity_matrix):
 
-            diagonal = affinity_matrix.sum(axis=1) \
+            diagonal = np.asarray(affinity_matrix.sum(axis=1)).ravel() \
                 - affinity_matrix.diagonal()
             if 0. in diagonal: raise ZeroDivisionError
+            if sparse.issparse(affinity_matrix):
+                invRootD = sparse.diags(np.sqrt(1 / diagonal))
+                return invRootD.dot(affinity_matrix).dot(invRootD).tocsr()
             invRootD = np.diag(np.sqrt(1 / diagonal))
             return np.dot(np.dot(invRootD, affinity_matrix), invRootD)
 
         # tuning step for adjacency matrix + max dists step
 
-        # Binary Search:
-        mink = 1
-        maxk = size
-        guessk = int(np.log(size).round())
-        while maxk - mink != 1:
-            test = dm.get_knn(guessk, add_noise=False)
-            if isconnected(test[0]) and nodivzero(test[1]):
-                maxk = guessk                       # either correct or too high
-                guessk = mink + (guessk - mink) / 2 # try a lower number
-            
-            else:
-                mink = guessk                       # too low
-                guessk = guessk + (maxk - guessk) / 2
-        (kneighbour_matrix, max_dists) = \
-            dm.get_knn(guessk + 1,
-                       add_noise=False)
+        # Smallest k >= 2 whose k-NN graph is connected, with no zero
+        # k-th neighbour distances (the k the binary search over get_knn
+        # used to find), from one neighbour ordering, grown if it's too short
+        nneighbours = min(size, max(8, 2 * int(np.log(size).round())))
+        parent = np.arange(size)
+        done = 0
+        while True:
+            (order, dists) = dm.get_neighbour_order(nneighbours)
+            guessk = self.connecting_k(order, dists, parent, done)
+            if guessk is not None or nneighbours == size:
+                break
+            done = nneighbours
+            nneighbours = min(size, 4 * nneighbours)
+        if guessk is None:
+            guessk = size
+        (kneighbour_matrix, max_dists) = dm.knn_from_order(order, dists,
+                guessk, sparse_output=use_sparse)
         if prune:
-            print 'Pruning adjacencies to {0}-NN'.format(guessk + 1)
+            print 'Pruning adjacencies to {0}-NN'.format(guessk)
         else: # we don't want a pruned adjacency matrix
             print 'Not pruning adjacencies'
             kneighbour_matrix = np.ones((size,size))
 
         # Tune the sigma parameter 
 
-        md7 = dm.get_knn(7, add_noise=False)[1] # try local scaling based on
-                                                # 7th nearest-neighbour
+        md7 = dict(enumerate(dists[:, 6])) # try local scaling based on
+                                           # 7th nearest-neighbour
         if sigma7 and nodivzero(md7): # zero-division safety test
             affinity_matrix = dm.get_affinity_matrix(kneighbour_matrix,
                     md7, add_noise=add_noise) # make affinity matrix based on
@@ -616,21 +942,20 @@ class Clustering(object):
               # matrix step
 
             if nodivzero(max_dists):
-                print 'Setting sigma to {0}-NN'.format(guessk + 1)
+                print 'Setting sigma to {0}-NN'.format(guessk)
                 affinity_matrix = \
                     dm.get_affinity_matrix(kneighbour_matrix, max_dists,
                         add_noise=add_noise)
             else: # tuned max dists is no good, use untuned version
                 print 'Setting sigma to {0}-NN'.format(size)
-                mdmax = dm.get_knn(size,
-                                   add_noise=False)[1]
+                mdmax = dm.get_max_dists()
                 affinity_matrix = \
                     dm.get_affinity_matrix(kneighbour_matrix, mdmax,
                         add_noise=add_noise)
 
         # normalise affinities to [0,1]
 
-        affinity_matrix *= 1.0 / np.max(affinity_matrix)
+        affinity_matrix = affinity_matrix * (1.0 / affinity_matrix.max())
         try:
             L = laplace(affinity_matrix)
         except ZeroDivisionError:
@@ -641,6 +966,59 @@ class Clustering(object):
             raise
         return L
 
+    @staticmethod
+    def connecting_k(
+        order,
+        dists,
+        parent=None,
+        start=0,
+        ):
+        """
+        Smallest k >= 2 for which the k-NN graph given by a neighbour
+        ordering (see DistanceMatrix.get_neighbour_order) is connected and
+        every k-th neighbour distance is non-zero, or None if the ordering
+        is too short to tell.
+        Neighbours are added a rank at a time to a union-find forest
+        (parent, kept fully compressed so parent[i] is the root of i).
+        Only edges joining different components need a union, so a rank
+        costs O(n) array operations. Passing the parent array and start
+        from an earlier, shorter ordering carries on from its last rank.
+        """
+
+        (size, nneighbours) = order.shape
+        if parent is None:
+            parent = np.arange(size)
+
+        # the k-th neighbour distance is non-zero once k is past the zeros
+
+        first_nonzero = (dists == 0).sum(axis=1).max() + 1
+
+        def find(i):
+            while parent[i] != i:
+                i = parent[i]
+            return i
+
+        components = (parent == np.arange(size)).sum()
+        for rank in range(start, nneighbours):
+            roots_i = parent.copy()
+            roots_j = parent[order[:, rank]]
+            cross = np.flatnonzero(roots_i != roots_j)
+            if len(cross) > 0:
+                for (i, j) in zip(roots_i[cross], roots_j[cross]):
+                    (root_i, root_j) = (find(i), find(j))
+                    if root_i != root_j:
+                        parent[root_i] = root_j
+                        components -= 1
+                while True:
+                    grandparent = parent[parent]
+                    if (grandparent == parent).all():
+                        break
+                    parent[:] = grandparent
+            k = rank + 1
+            if components == 1 and k >= first_nonzero:
+                return max(k, 2)
+        return None
+
     def NJW(self, distance_matrix, sigma):
         size = distance_matrix.shape[0]
         A = np.exp(-distance_matrix ** 2 / (2 * sigma))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import cPickle
+import glob
+import hashlib
+import os
+import struct
+import zlib
+
+# Last bytes of every store: magic string, index offset and index length
+
+MAGIC = 'SCSTORE1'
+FOOTER = struct.Struct('<8sQQ')
+
+
+class CollectionStore(object):
+
+    """
+    Single file of named sections, each pickled and zlib-compressed on its
+    own, so any of them can be read without the rest.
+
+    Sections are written one after another, followed by an index (itself
+    a compressed section: name -> (offset, length, digest)) and a fixed
+    size footer giving the index's position. Updating appends the new or
+    changed sections, then a new index and footer, after what is already
+    there: nothing written before is rewritten, and until the new footer
+    is in place the old index is still the one found. Superseded copies
+    stay in the file until compact().
+    """
+
+    def __init__(self, filename, level=6):
+
+        self.filename = filename
+        self.level = level
+        self.index = {}
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            self.index = self.read_index()
+
+    def __str__(self):
+        return 'CollectionStore: {0}\n{1} sections'.format(self.filename,
+                len(self))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    @staticmethod
+    def is_store(filename):
+        """
+        True if filename ends with a store footer
+        """
+
+        if not os.path.isfile(filename) or os.path.getsize(filename) \
+            < FOOTER.size:
+            return False
+        with open(filename, 'rb') as openfile:
+            openfile.seek(-FOOTER.size, os.SEEK_END)
+            return FOOTER.unpack(openfile.read(FOOTER.size))[0] == MAGIC
+
+    def read_index(self):
+        with open(self.filename, 'rb') as openfile:
+            openfile.seek(-FOOTER.size, os.SEEK_END)
+            (magic, offset, length) = \
+                FOOTER.unpack(openfile.read(FOOTER.size))
+            if magic != MAGIC:
+                raise IOError('{0} is not a collection store'.format(self.filename))
+            openfile.seek(offset)
+            return self._decode(openfile.read(length))
+
+    def keys(self, prefix=''):
+        return sorted(name for name in self.index
+                      if name.startswith(prefix))
+
+    def get(self, name):
+        return self.get_many([name])[name]
+
+    def get_many(self, names):
+        """
+        Dict of name: value for the sections in names, read in file order
+        """
+
+        names = sorted(names, key=lambda name: self.index[name][0])
+        values = {}
+        with open(self.filename, 'rb') as openfile:
+            for name in names:
+                (offset, length, _) = self.index[name]
+                openfile.seek(offset)
+                values[name] = self._decode(openfile.read(length))
+        return values
+
+    def update(self, sections, remove=()):
+        """
+        Appends the sections (a dict of name: value) whose pickles differ
+        from what is stored under their names, drops the names in remove,
+        and writes the new index. Returns the number of sections written.
+        """
+
+        written = 0
+        with open(self.filename, 'ab') as openfile:
+            openfile.seek(0, os.SEEK_END)
+            for (name, value) in sections.items():
+                pickled = cPickle.dumps(value, protocol=2)
+                digest = hashlib.sha1(pickled).hexdigest()
+                if name in self.index and self.index[name][2] == digest:
+                    continue
+                data = zlib.compress(pickled, self.level)
+                self.index[name] = (openfile.tell(), len(data), digest)
+                openfile.write(data)
+                written += 1
+            for name in remove:
+                self.index.pop(name, None)
+            if written or remove or openfile.tell() == 0:
+                self._write_index(openfile)
+        return written
+
+    def compact(self):
+        """
+        Rewrites the file with only the current sections
+        """
+
+        tmpfile = self.filename + '.tmp'
+        index = {}
+        with open(self.filename, 'rb') as infile:
+            with open(tmpfile, 'wb') as outfile:
+                for name in sorted(self.index, key=lambda name: \
+                                   self.index[name][0]):
+                    (offset, length, digest) = self.index[name]
+                    infile.seek(offset)
+                    index[name] = (outfile.tell(), length, digest)
+                    outfile.write(infile.read(length))
+                self.index = index
+                self._write_index(outfile)
+        os.rename(tmpfile, self.filename)
+
+    def _write_index(self, openfile):
+        data = zlib.compress(cPickle.dumps(self.index, protocol=2),
+                             self.level)
+        offset = openfile.tell()
+        openfile.write(data)
+        openfile.write(FOOTER.pack(MAGIC, offset, len(data)))
+        openfile.flush()
+        os.fsync(openfile.fileno())
+
+    @staticmethod
+    def _decode(data):
+        return cPickle.loads(zlib.decompress(data))
+
+
+def summary_filename(filename):
+    """
+    Sidecar written beside a saved collection: its file name plus
+    '.summary'
+    """
+
+    if filename.endswith('.summary'):
+        return filename
+    return filename + '.summary'
+
+
+def write_summary(filename, summary):
+    sidecar = summary_filename(filename)
+    with open(sidecar + '.tmp', 'wb') as openfile:
+        cPickle.dump(summary, openfile, protocol=2)
+    os.rename(sidecar + '.tmp', sidecar)
+
+
+def read_summary(filename):
+    """
+    The summary (see SequenceCollection.summary) saved beside the
+    collection in filename, or None if there isn't one. Only the sidecar
+    is read.
+    """
+
+    sidecar = summary_filename(filename)
+    if not os.path.isfile(sidecar):
+        return None
+    with open(sidecar, 'rb') as openfile:
+        return cPickle.load(openfile)
+
+
+def read_summaries(pattern):
+    """
+    (filename, summary) for each saved collection matching the glob
+    pattern (e.g. 'level*/sim*/*.pkl.gz') that has a sidecar
+    """
+
+    summaries = []
+    for filename in sorted(glob.glob(pattern)):
+        if filename.endswith('.summary'):
+            continue
+        summary = read_summary(filename)
+        if summary is not None:
+            summaries.append((filename, summary))
+    return summaries
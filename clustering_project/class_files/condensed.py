@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+import os
+
+
+class CondensedMatrix(object):
+
+    """
+    Symmetric matrix with a zero diagonal, stored as its upper triangle
+    read row by row (the 'condensed' order used by scipy's squareform,
+    pdist and linkage), so n trees take n(n-1)/2 values instead of n^2.
+
+    The values can be held in memory, in shared memory (so forked workers
+    can fill them), or in a np.memmap file for matrices that don't fit in
+    RAM. Single rows, and the full square matrix for code that needs one,
+    are produced on request.
+    """
+
+    def __init__(
+        self,
+        size,
+        dtype=np.float64,
+        filename=None,
+        shared=False,
+        data=None,
+        ):
+
+        self.size = size
+        self.filename = filename
+        length = size * (size - 1) // 2
+        dtype = np.dtype(dtype)
+        if data is not None:
+            self.data = data
+        elif filename and length > 0:
+
+            # unlinking first leaves any existing mapping of an older
+            # matrix in this file intact
+
+            if os.path.exists(filename):
+                os.remove(filename)
+            self.data = np.memmap(filename, dtype=dtype, mode='w+',
+                                  shape=(length, ))
+        elif shared:
+            typecode = ('f' if dtype == np.float32 else 'd')
+            self.data = np.frombuffer(RawArray(typecode, length),
+                    dtype=dtype)
+        else:
+            self.data = np.zeros(length, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return 'CondensedMatrix: {0} x {0}, {1}{2}'.format(self.size,
+                self.dtype, (' in {0}'.format(self.filename) if isinstance(self.data,
+                np.memmap) else ''))
+
+    def __getitem__(self, index):
+        (i, j) = index
+        if i == j:
+            return self.dtype.type(0)
+        return self.data[self.position(i, j)]
+
+    def __setitem__(self, index, value):
+        (i, j) = index
+        self.data[self.position(i, j)] = value
+
+    def __idiv__(self, value):
+        self.data /= value
+        return self
+
+    __itruediv__ = __idiv__
+
+    def __array__(self, dtype=None):
+        square = self.square()
+        return (square if dtype is None else square.astype(dtype))
+
+    @property
+    def shape(self):
+        return (self.size, self.size)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @classmethod
+    def open(
+        cls,
+        filename,
+        size,
+        dtype=np.float64,
+        mode='r+',
+        ):
+        """
+        Reopens a memmap file written earlier
+        """
+
+        data = np.memmap(filename, dtype=dtype, mode=mode,
+                         shape=(size * (size - 1) // 2, ))
+        return cls(size, filename=filename, data=data)
+
+    @classmethod
+    def from_square(
+        cls,
+        matrix,
+        dtype=np.float64,
+        filename=None,
+        ):
+        """
+        Condensed copy of the upper triangle of a square matrix, copied
+        a row at a time
+        """
+
+        new = cls(len(matrix), dtype=dtype, filename=filename)
+        for i in range(new.size - 1):
+            new.segment(i)[:] = matrix[i, i + 1:]
+        return new
+
+    def offset(self, i):
+        """
+        Position of element (i, i + 1) in the condensed vector
+        """
+
+        return i * (2 * self.size - i - 1) // 2
+
+    def position(self, i, j):
+        (i, j) = (min(i, j), max(i, j))
+        if i == j:
+            raise IndexError('the diagonal is not stored')
+        return self.offset(i) + j - i - 1
+
+    def take(self, rows, cols):
+        """
+        Values at the pairs (rows[n], cols[n]), 0 on the diagonal
+        """
+
+        (rows, cols) = (np.asarray(rows), np.asarray(cols))
+        (i, j) = (np.minimum(rows, cols), np.maximum(rows, cols))
+        off = i != j
+        out = np.zeros(len(i), dtype=self.dtype)
+        out[off] = self.data[self.offset(i[off]) + j[off] - i[off] - 1]
+        return out
+
+    def segment(self, i):
+        """
+        View of the stored part of row i: columns i + 1 onwards
+        """
+
+        start = self.offset(i)
+        return self.data[start:start + self.size - i - 1]
+
+    def row(self, i):
+        """
+        Full row i (the columns before i are read down column i)
+        """
+
+        out = np.zeros(self.size, dtype=self.dtype)
+        before = np.arange(i)
+        out[:i] = self.data[self.offset(before) + i - before - 1]
+        out[i + 1:] = self.segment(i)
+        return out
+
+    def square(self):
+        """
+        Dense square copy
+        """
+
+        out = np.zeros((self.size, self.size), dtype=self.dtype)
+        for i in range(self.size - 1):
+            segment = self.segment(i)
+            out[i, i + 1:] = segment
+            out[i + 1:, i] = segment
+        return out
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
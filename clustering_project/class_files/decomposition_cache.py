@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+from memory_cache import MemoryCache
+
+
+class DecompositionCache(MemoryCache):
+
+    """
+    In-memory store of the matrices and eigendecompositions made by
+    Clustering, so they are reused across numbers of clusters, metrics and
+    method variants.
+
+    Entries are keyed by (distance matrix fingerprint, method, prune,
+    sigma7, noise) and bounded only by max_bytes by default: a sweep over
+    metrics, methods and numbers of clusters easily makes more than any
+    fixed count of (often small) entries.
+    """
+
+    def __init__(self, max_bytes=2 ** 30, max_entries=None):
+
+        MemoryCache.__init__(self, max_bytes, max_entries)
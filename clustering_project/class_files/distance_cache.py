@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import hashlib
+import sqlite3
+
+
+class DistanceCache(object):
+
+    """
+    Persistent store of pairwise tree distances, shared between runs.
+
+    Each value is keyed by a hash of the metric, the normalise flag and
+    the two trees' normalised newick strings (whitespace removed, the
+    pair sorted so (a, b) and (b, a) share a key), so overlapping
+    experiments reuse each other's distances. Callers only store values
+    that depend on nothing else (see DistanceMatrix.get_cached_distances).
+    Values live in a single sqlite table. When it holds more than
+    max_entries, the least recently used are evicted.
+    """
+
+    def __init__(self, filename, max_entries=10000000):
+
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._clock = None
+
+    def __str__(self):
+        return 'DistanceCache: {0}\n{1} entries, {2} hits, {3} misses'.format(self.filename,
+                len(self), self.hits, self.misses)
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM distances'
+                ).fetchone()[0]
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d['_connection'] = None
+        d['_clock'] = None
+        return d
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS distances (key BLOB PRIMARY KEY, value REAL, used INTEGER)'
+                    )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS used_index ON distances (used)'
+                    )
+            self._clock = self._connection.execute('SELECT MAX(used) FROM distances'
+                    ).fetchone()[0] or 0
+        return self._connection
+
+    def _tick(self):
+        self.connection
+        self._clock += 1
+        return self._clock
+
+    @staticmethod
+    def tree_hash(newick):
+        return hashlib.sha1(''.join(newick.split())).digest()
+
+    @staticmethod
+    def pair_key(
+        metric,
+        normalise,
+        hash1,
+        hash2,
+        ):
+
+        (hash1, hash2) = sorted((hash1, hash2))
+        return hashlib.sha1('{0}:{1}:'.format(metric, bool(normalise))
+                            + hash1 + hash2).digest()
+
+    def lookup(self, keys):
+        """
+        Returns {key: value} for the keys found, counting hits and misses
+        (once per distinct key) and marking the found entries as recently
+        used
+        """
+
+        found = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            query = 'SELECT key, value FROM distances WHERE key IN ({0})'.format(','.join('?'
+                    * len(chunk)))
+            for (key, value) in self.connection.execute(query,
+                    [buffer(key) for key in chunk]):
+                found[str(key)] = value
+        if found:
+            used = self._tick()
+            self.connection.executemany('UPDATE distances SET used = ? WHERE key = ?'
+                    , ((used, buffer(key)) for key in found))
+            self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def store(self, items):
+        """
+        Adds (key, value) pairs, then evicts the least recently used
+        entries beyond max_entries
+        """
+
+        used = self._tick()
+        self.connection.executemany('INSERT OR REPLACE INTO distances VALUES (?, ?, ?)'
+                                    , ((buffer(key), float(value), used)
+                                    for (key, value) in items))
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute('DELETE FROM distances WHERE key IN (SELECT key FROM distances ORDER BY used LIMIT ?)'
+                                    , (excess, ))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM distances')
+        self.connection.commit()
+        (self.hits, self.misses) = (0, 0)
@@ -1,11 +1,26 @@
 #!/usr/bin/env python
 
 from gtp import GTP
+from geodesic import Geodesic, GeodesicTable
 from matplotlib import pyplot as plt
 from matplotlib import cm as CM
+import hashlib
 import numpy as np
 import os
 from dpy_utils import *
+from scipy import sparse
+from scipy.spatial.distance import squareform
+from splits import SplitTable
+from tiling import tiled_matrix, tiled_block, balanced_tiles
+from condensed import CondensedMatrix
+
+# Pairs whose DistanceCache keys are made and looked up at once
+
+CACHE_BLOCK_PAIRS = 2 ** 20
+
+# Metrics computed together from the split table's branch lengths
+
+LENGTH_METRICS = ('wrf', 'euc')
 
 
 class DistanceMatrix(object):
@@ -18,20 +33,194 @@ class DistanceMatrix(object):
         None: 'Empty matrix',
         }
 
-    def __init__(self, trees, tmpdir='/tmp'):
+    def __init__(
+        self,
+        trees,
+        tmpdir='/tmp',
+        split_table=None,
+        condensed=False,
+        dtype=np.float64,
+        memmap=None,
+        ):
+        """
+        With condensed=True only the upper triangle is stored (see
+        CondensedMatrix), as dtype (e.g. np.float32), and in the file
+        memmap if one is given.
+        """
 
         size = len(trees)
-        self.matrix = np.zeros((size, size), dtype='float')
+        self.condensed = condensed
+        self.dtype = dtype
+        self.memmap = memmap
+        if condensed:
+            self.matrix = self._new_storage(size)
+        else:
+            self.matrix = np.zeros((size, size), dtype='float')
         self.metric = None
         self.trees = trees
         self.tmpdir = tmpdir
+        self.split_table = split_table
+        self.geodesic_table = None
+        self.normalise = False
+        self.max_rf = None
 
     def __str__(self):
-        return '\n'.join([str(self.matrix),
+        return '\n'.join([str(self._matrix),
                          'Metric: {0}'.format(self.metrics_dict[self.metric])])
 
+    def __len__(self):
+        return len(self._matrix)
+
+    def __setstate__(self, state):
+
+        # objects pickled before condensed storage kept a plain matrix,
+        # and had none of the later attributes
+
+        if 'matrix' in state:
+            state['_matrix'] = state.pop('matrix')
+        for (attr, default) in (
+            ('condensed', False),
+            ('dtype', np.float64),
+            ('memmap', None),
+            ('normalise', False),
+            ('split_table', None),
+            ('geodesic_table', None),
+            ('max_rf', None),
+            ):
+            state.setdefault(attr, default)
+        self.__dict__.update(state)
+
+    @property
+    def matrix(self):
+        """
+        The square distance matrix. With condensed storage this is a new
+        read-only dense copy on every access, so it can't be edited in
+        place: assign a whole new matrix instead, and use dense() (once),
+        get_row or get_condensed to read it.
+        """
+
+        if isinstance(self._matrix, CondensedMatrix):
+            square = self._matrix.square()
+            square.flags.writeable = False
+            return square
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        if self.condensed and not isinstance(matrix, CondensedMatrix):
+            matrix = CondensedMatrix.from_square(matrix, self.dtype,
+                    self.memmap)
+        self._matrix = matrix
+        self._fingerprint = None
+
+    def dense(self):
+        """
+        The distances as a square array: the stored array itself, or a new
+        (writable) dense copy of condensed storage, taking O(n^2) memory
+        """
+
+        if isinstance(self._matrix, CondensedMatrix):
+            return self._matrix.square()
+        return self._matrix
+
+    def fingerprint(self):
+        """
+        Hash of the metric and the distances, identifying this matrix in
+        Clustering's decomposition cache. It is worked out once per
+        assignment to self.matrix, so changes made in place to the array
+        aren't seen.
+        """
+
+        if getattr(self, '_fingerprint', None) is None:
+            values = np.ascontiguousarray(self.get_condensed())
+            digest = hashlib.sha1('{0}:{1}:{2}:'.format(self.metric,
+                                  len(self), values.dtype))
+            digest.update(values)
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def _new_storage(self, size, shared=False):
+        return CondensedMatrix(size, self.dtype, self.memmap, shared)
+
+    def _tiled(
+        self,
+        block_function,
+        n_jobs=1,
+        nout=1,
+        ):
+        """
+        Matrix of the current trees from tiles of block_function, in
+        this object's storage format (a tuple of nout matrices if
+        block_function returns nout blocks)
+        """
+
+        size = len(self.trees)
+        if not self.condensed:
+            return tiled_matrix(size, block_function, n_jobs, nout=nout)
+        out = [self._new_storage(size, shared=True) for _ in range(nout)]
+        return tiled_matrix(size, block_function, n_jobs, out=(out[0]
+                            if nout == 1 else out), nout=nout)
+
+    def _from_condensed(self, vector):
+        if self.condensed:
+            storage = self._new_storage(len(self.trees))
+            storage.data[:] = vector
+            return storage
+        return CondensedMatrix(len(self.trees), data=vector).square()
+
+    def get_row(self, i, matrix=None):
+        """
+        Distances from tree i to every tree, from either storage format
+        """
+
+        if matrix is None:
+            matrix = self._matrix
+        if isinstance(matrix, CondensedMatrix):
+            return matrix.row(i)
+        return matrix[i]
+
+    def get_rows(self, rows, matrix=None):
+        """
+        Distances from each tree in rows to every tree, as a
+        len(rows) x n array
+        """
+
+        if matrix is None:
+            matrix = self._matrix
+        if isinstance(matrix, CondensedMatrix):
+            return np.array([matrix.row(i) for i in rows]).reshape(len(rows),
+                    len(matrix))
+        return np.asarray(matrix[rows], dtype=np.float)
+
+    def row_blocks(self, block_size=None):
+        """
+        Consecutive ranges of rows, holding about 2^22 cells each, so
+        whole-matrix temporaries are built a block at a time
+        """
+
+        size = len(self._matrix)
+        if block_size is None:
+            block_size = max(1, 2 ** 22 // max(size, 1))
+        return [np.arange(start, min(start + block_size, size))
+                for start in range(0, size, block_size)]
+
+    def get_condensed(self, add_noise=False):
+        """
+        Upper triangle as a condensed vector, as taken by
+        scipy.cluster.hierarchy.linkage
+        """
+
+        matrix = (self.add_noise() if add_noise else self._matrix)
+        if isinstance(matrix, CondensedMatrix):
+            return matrix.data
+        return squareform(matrix, checks=False)
+
     def get_dendropy_distances(self, fn):
         num_trees = len(self.trees)
+
+        # fresh parses, not the trees' cached ones: dendropy's distance
+        # functions re-encode (and can modify) the trees they're given
+
         dpy_trees = convert_to_dendropy_trees(self.trees)
 
         matrix = np.zeros((num_trees, num_trees))
@@ -41,12 +230,82 @@ class DistanceMatrix(object):
                 matrix[i, j] = matrix[j, i] = distance
         return matrix
 
-    def get_geo_distances(self, tmpdir=None):
+    @staticmethod
+    def _table_matches(table, trees):
+        """
+        True if table (a SplitTable or GeodesicTable) was built from trees,
+        in order, as identified by their newick strings
+        """
+
+        return table is not None and getattr(table, 'newicks', None) \
+            == [tree.newick for tree in trees]
+
+    def get_split_table(self, dpy_trees=None):
+        """
+        Encodes the splits of self.trees once; the table is kept so
+        later split-based metrics don't need to re-encode the trees, and
+        rebuilt if the trees have changed since
+        """
+
+        if not self._table_matches(self.split_table, self.trees):
+            self.split_table = SplitTable(self.trees, dpy_trees)
+        return self.split_table
+
+    def get_geodesic_table(self, dpy_trees=None):
+        """
+        As get_split_table, for the trees encoded for geodesic distances.
+        Rebuilt if the trees no longer agree on rootedness with the table.
+        """
+
+        rooted = Geodesic().allrooted(self.trees)
+        if not self._table_matches(self.geodesic_table, self.trees) \
+            or self.geodesic_table.rooted != rooted:
+            self.geodesic_table = GeodesicTable(self.trees, dpy_trees,
+                    rooted)
+        return self.geodesic_table
+
+    def get_rf_distances(self, dpy_trees=None, n_jobs=1):
+        return self._tiled(self.get_block_function('rf', dpy_trees),
+                           n_jobs)
+
+    def get_wrf_distances(self, dpy_trees=None, n_jobs=1):
+        return self._tiled(self.get_block_function('wrf', dpy_trees),
+                           n_jobs)
+
+    def get_euc_distances(self, dpy_trees=None, n_jobs=1):
+        return self._tiled(self.get_block_function('euc', dpy_trees),
+                           n_jobs)
+
+    def get_length_distances(self, dpy_trees=None, n_jobs=1):
+        """
+        (wrf, euc) matrices, from one pass over the split table
+        """
+
+        return self._tiled(self.get_block_function(LENGTH_METRICS,
+                           dpy_trees), n_jobs, nout=2)
+
+    def get_geo_distances(
+        self,
+        tmpdir=None,
+        dpy_trees=None,
+        native=True,
+        n_jobs=1,
+        ):
+        """
+        Geodesic distances, computed in-process (optionally by a pool of
+        n_jobs processes), or with gtp.jar if native is False (then up to
+        n_jobs JVMs at once)
+        """
+
+        if native:
+            table = self.get_geodesic_table(dpy_trees)
+            return self._tiled(lambda rows, cols: table.block(rows, cols,
+                               upper=True), n_jobs)
 
         if not tmpdir:
             tmpdir = self.tmpdir
 
-        g = GTP(tmpdir=tmpdir)
+        g = GTP(tmpdir=tmpdir, nprocesses=n_jobs)
         return g.run(self.trees)
 
     def get_geo_distance(
@@ -54,8 +313,12 @@ class DistanceMatrix(object):
         tree1,
         tree2,
         tmpdir=None,
+        native=True,
         ):
 
+        if native:
+            return Geodesic().pairwise(tree1, tree2)
+
         if not tmpdir:
             tmpdir = self.tmpdir
 
@@ -75,6 +338,9 @@ class DistanceMatrix(object):
         metric,
         normalise=False,
         tmpdir=None,
+        n_jobs=1,
+        cache=None,
+        companion=None,
         ):
         """
         Generates pairwise distance matrix between trees
@@ -84,33 +350,46 @@ class DistanceMatrix(object):
         Euclidean distance - Felsenstein's branch lengths
             distance (='euc')
         Geodesic distance - branch lengths (='geo')
+        With n_jobs > 1 the upper triangle is computed in tiles by a pool
+        of n_jobs processes (n_jobs < 1 uses every core)
+        With a DistanceCache as cache, only pairs it doesn't hold are
+        computed
+        For 'wrf' or 'euc', a DistanceMatrix of the same trees given as
+        companion is filled with the other of the two, computed in the
+        same pass
         """
 
         if not tmpdir:
             tmpdir = self.tmpdir
 
         self.metric = metric
-        dpy_trees = convert_to_dendropy_trees(self.trees)
-        branch_lengths = [self._sum_of_branch_lengths(x) for x in
-                          dpy_trees]
+        self.normalise = normalise
 
-        if metric == 'geo':
-            matrix = self.get_geo_distances(tmpdir=tmpdir)
-        elif metric == 'rf':
+        if companion is not None and metric in LENGTH_METRICS:
+            return self._get_length_pair(normalise, n_jobs, cache,
+                    companion)
+
+        if metric == 'rf':
+            ntax = len(self.trees[0].get_dendropy_tree().leaf_nodes())
+            self.max_rf = 2.0 * (ntax - 3)
 
-            ntax = len(dpy_trees[0].leaf_nodes())
-            max_rf = 2.0 * (ntax - 3)
+        if cache is not None and metric in ('rf', 'wrf', 'euc', 'geo'):
+            matrix = self.get_cached_distances(metric, normalise, cache,
+                    n_jobs=n_jobs)
+        elif metric == 'geo':
+            matrix = self.get_geo_distances(tmpdir=tmpdir, n_jobs=n_jobs)
+        elif metric == 'rf':
 
-            matrix = self.get_dendropy_distances(get_rf_distance)
+            matrix = self.get_rf_distances(n_jobs=n_jobs)
 
             if normalise:
-                matrix /= max_rf
+                matrix /= self.max_rf
         elif metric == 'wrf':
 
-            matrix = self.get_dendropy_distances(get_wrf_distance)
+            matrix = self.get_wrf_distances(n_jobs=n_jobs)
         elif metric == 'euc':
 
-            matrix = self.get_dendropy_distances(get_euc_distance)
+            matrix = self.get_euc_distances(n_jobs=n_jobs)
         else:
 
             print 'Unrecognised distance metric'
@@ -122,25 +401,263 @@ class DistanceMatrix(object):
             self.matrix = matrix
         return matrix
 
+    def get_block_function(
+        self,
+        metric,
+        dpy_trees=None,
+        needed=None,
+        ):
+        """
+        Function (rows, cols) -> block of (unnormalised) distances between
+        the trees in rows and the trees in cols, for any metric but gtp.jar
+        geodesics, or -> (wrf block, euc block) for metric LENGTH_METRICS.
+        For geodesics, which are computed pair by pair, needed can restrict
+        the block to a set of (row, col) pairs.
+        """
+
+        if metric == 'rf':
+            return self.get_split_table(dpy_trees).rf_block
+        elif metric == LENGTH_METRICS:
+            return self.get_split_table(dpy_trees).length_distance_blocks
+        elif metric in LENGTH_METRICS:
+            table = self.get_split_table(dpy_trees)
+            position = (0 if metric == 'wrf' else 1)
+            return lambda rows, cols: \
+                table.length_distance_blocks(rows, cols)[position]
+        elif metric == 'geo':
+            table = self.get_geodesic_table(dpy_trees)
+            return lambda rows, cols: table.block(rows, cols,
+                    needed=needed)
+
+    @staticmethod
+    def _block_pairs(size, start, stop):
+        """
+        (rows, cols) of the upper triangle pairs in rows [start, stop), in
+        condensed order
+        """
+
+        counts = size - 1 - np.arange(start, stop)
+        rows = np.repeat(np.arange(start, stop), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        cols = np.arange(counts.sum()) - first + rows + 1
+        return (rows, cols)
+
+    def _cache_groups(self, metric, dpy_trees=None):
+        """
+        Group number of each tree, such that distances between trees of
+        one group don't depend on the other trees: for split-based metrics
+        the SplitTable groups (rootedness and leaf set), as other pairs are
+        compared after projecting on the collection's taxon order; for
+        geodesics the leaf set, as the encoding of other pairs depends on
+        it too.
+        """
+
+        if metric != 'geo':
+            return np.array(self.get_split_table(dpy_trees).tree_groups)
+        numbers = {}
+        return np.array([numbers.setdefault(sum(leaves), len(numbers))
+                        for (leaves, _) in
+                        self.get_geodesic_table(dpy_trees).encoded])
+
+    def get_cached_distances(
+        self,
+        metric,
+        normalise,
+        cache,
+        dpy_trees=None,
+        n_jobs=1,
+        ):
+        """
+        Distance matrix filled from a DistanceCache. Only the pairs the
+        cache doesn't hold are computed (over the rectangle of their rows
+        and columns, or pair by pair for geodesics), then stored in it.
+        With metric LENGTH_METRICS, a (wrf, euc) pair of matrices is made,
+        computing each missing pair for both at once.
+        Distances between trees of different leaf sets (or, for the
+        split-based metrics, rooting) depend on the rest of the collection
+        (see _cache_groups), so those pairs are always computed and never
+        cached.
+        """
+
+        metrics = (metric if metric == LENGTH_METRICS else (metric, ))
+        size = len(self.trees)
+        cache_metrics = list(metrics)
+        if metric == 'geo':
+
+            # geodesics depend on whether the whole set is treated as rooted
+
+            rooted = Geodesic().allrooted(self.trees)
+            cache_metrics = [('geo-rooted' if rooted else 'geo-unrooted')]
+        hashes = [cache.tree_hash(tree.newick) for tree in self.trees]
+        vectors = [np.zeros(size * (size - 1) // 2) for _ in metrics]
+        block_function = self.get_block_function(metric, dpy_trees)
+        groups = self._cache_groups(metric, dpy_trees)
+
+        # keys are made and looked up a block of rows at a time, so only
+        # about CACHE_BLOCK_PAIRS of them are held at once
+
+        condensed = CondensedMatrix(size, data=vectors[0])
+        for (start, stop) in balanced_tiles(size, size * (size - 1)
+                // (2 * CACHE_BLOCK_PAIRS) + 1):
+            (rows, cols) = self._block_pairs(size, start, stop)
+            positions = condensed.offset(rows) + cols - rows - 1
+            shared = np.flatnonzero(groups[rows] == groups[cols])
+            missing = set(range(len(rows))) - set(shared)
+            all_keys = []
+            for (vector, cache_metric) in zip(vectors, cache_metrics):
+                keys = dict((n, cache.pair_key(cache_metric, normalise,
+                            hashes[rows[n]], hashes[cols[n]])) for n in
+                            shared)
+                found = cache.lookup(keys.values())
+                for (n, key) in keys.iteritems():
+                    if key in found:
+                        vector[positions[n]] = found[key]
+                    else:
+                        missing.add(n)
+                all_keys.append(keys)
+            if not missing:
+                continue
+            missing = sorted(missing)
+            (missing_rows, missing_cols) = (rows[missing], cols[missing])
+            (block_rows, row_positions) = np.unique(missing_rows,
+                    return_inverse=True)
+            (block_cols, col_positions) = np.unique(missing_cols,
+                    return_inverse=True)
+            if metric == 'geo':
+                function = self.get_block_function(metric, dpy_trees,
+                        set(zip(missing_rows, missing_cols)))
+            else:
+                function = block_function
+            blocks = tiled_block(block_rows, block_cols, function, n_jobs,
+                                 nout=len(metrics))
+            if len(metrics) == 1:
+                blocks = (blocks, )
+            for (vector, keys, block) in zip(vectors, all_keys, blocks):
+                values = block[row_positions, col_positions]
+                if metric == 'rf' and normalise:
+                    values /= self.max_rf
+                vector[positions[missing]] = values
+                cache.store((keys[n], value) for (n, value) in
+                            zip(missing, values) if n in keys)
+        matrices = [self._from_condensed(vector) for vector in vectors]
+        return (matrices[0] if len(metrics) == 1 else tuple(matrices))
+
+    def _get_length_pair(
+        self,
+        normalise,
+        n_jobs,
+        cache,
+        companion,
+        ):
+        """
+        Fills self (metric 'wrf' or 'euc') and companion with the wrf and
+        euc matrices made in one pass (see get_distance_matrix)
+        """
+
+        if cache is not None:
+            pair = self.get_cached_distances(LENGTH_METRICS, normalise,
+                    cache, n_jobs=n_jobs)
+        else:
+            pair = self.get_length_distances(n_jobs=n_jobs)
+        other = LENGTH_METRICS[1 - LENGTH_METRICS.index(self.metric)]
+        companion.metric = other
+        companion.normalise = normalise
+        companion.split_table = self.split_table
+        companion.matrix = pair[LENGTH_METRICS.index(other)]
+        matrix = pair[LENGTH_METRICS.index(self.metric)]
+        self.matrix = matrix
+        return matrix
+
+    def extend(self, trees, n_jobs=1):
+        """
+        Appends trees to the matrix, computing only the distances that
+        involve them (the new rows, mirrored into the new columns) with
+        the split / geodesic tables kept from the earlier computation.
+        Geodesic distances are recomputed in full if the new trees change
+        whether the set is treated as rooted.
+        """
+
+        old = len(self.trees)
+        self.trees = list(self.trees) + list(trees)
+        size = len(self.trees)
+        new_rows = np.arange(old, size)
+        if self.metric in ('rf', 'wrf', 'euc'):
+            table = self.split_table
+            if self._table_matches(table, self.trees[:old]):
+                table.add_trees(trees)
+        elif self.metric == 'geo':
+            table = self.geodesic_table
+            if self._table_matches(table, self.trees[:old]) \
+                and table.rooted == Geodesic().allrooted(self.trees):
+                table.add_trees(trees)
+            elif not self._table_matches(table, self.trees):
+                return self.get_distance_matrix('geo', n_jobs=n_jobs)
+        else:
+            matrix = np.zeros((size, size))
+            matrix[:old, :old] = self.dense()
+            self.matrix = matrix
+            return self._matrix
+        block_function = self.get_block_function(self.metric)
+
+        block = tiled_block(new_rows, np.arange(size), block_function,
+                            n_jobs)
+        if self.metric == 'rf' and self.normalise:
+            block /= self.max_rf
+        square = np.triu(block[:, old:], 1)
+        block[:, old:] = square + square.T
+        if self.condensed:
+            matrix = self._new_storage(size)
+            for i in range(old):
+                segment = matrix.segment(i)
+                segment[:old - i - 1] = self._matrix.segment(i)
+                segment[old - i - 1:] = block[:, i]
+            for i in new_rows[:-1]:
+                matrix.segment(i)[:] = block[i - old, i + 1:]
+        else:
+            matrix = np.zeros((size, size))
+            matrix[:old, :old] = self._matrix
+            matrix[old:] = block
+            matrix[:, old:] = block.T
+        self.matrix = matrix
+        return matrix
+
+    @staticmethod
+    def _noisy(values):
+        """
+        values + eps, eps ~ N(0, 0.001) drawn once per value in order, or
+        values - eps where that would not be positive
+        """
+
+        eps = np.random.normal(0, 0.001, len(values))
+        noisy = values + eps
+        flip = noisy <= 0
+        noisy[flip] = values[flip] - eps[flip]
+        return noisy
+
     def add_noise(self, dm=None):
+        """
+        Copy of the distances with independent noise on each pair, the
+        same in both triangles. The draws are in the order of the upper
+        triangle read row by row, as the earlier per-element loop made them.
+        """
+
         if dm is None:
-            dm = self.matrix
-        size = len(dm)
-        new = np.zeros((size, size))
-        r = range(size)
-        for i in r:
-            for j in r[i + 1:]:
-                eps = np.random.normal(0, 0.001)
-                if dm[i, j] + eps > 0:
-                    new[i, j] = new[j, i] = dm[i, j] + eps
-                else:
-                    new[i, j] = new[j, i] = dm[i, j] - eps
-        return new
+            dm = self._matrix
+        if isinstance(dm, CondensedMatrix):
+            return CondensedMatrix(dm.size,
+                                   data=self._noisy(dm.data).astype(dm.dtype))
+        values = squareform(np.asarray(dm, dtype=np.float), checks=False)
+        return squareform(self._noisy(values))
 
     def noisy_copy(self):
         new_object = DistanceMatrix(trees=self.trees,
-                                    tmpdir=self.tmpdir)
+                                    tmpdir=self.tmpdir,
+                                    condensed=self.condensed,
+                                    dtype=self.dtype)
         new_object.metric = self.metric
+        new_object.split_table = self.split_table
+        new_object.geodesic_table = self.geodesic_table
+        new_object.normalise = self.normalise
         new_object.matrix = self.add_noise()
         return new_object
 
@@ -150,7 +667,7 @@ class DistanceMatrix(object):
         as returned by Partition().get_memberships(..., flatten=True)
         """
 
-        dm = np.array(self.matrix, copy=True)
+        dm = np.array(self.dense(), copy=True)
         length = dm.shape[0]
         datamax = abs(dm).max()
         fig = plt.figure()
@@ -194,7 +711,7 @@ class DistanceMatrix(object):
               n is the matrix size, common to all
         """
 
-        D = self.matrix
+        D = self.dense()
         I = np.identity(D.shape)
         ones = np.ones(D.shape)
 
@@ -210,28 +727,116 @@ class DistanceMatrix(object):
 
         return True
 
-    def get_knn(self, k, add_noise=False):
+    def get_knn(
+        self,
+        k,
+        add_noise=False,
+        sparse_output=False,
+        ):
         """
         Acts on distance matrix. For each datapoint, finds
         the `k` nearest neighbours. Returns an adjacency
         matrix, and a dictionary of the kth distance for 
         each node.
+        Neighbours are found by partitioning each row at its kth smallest
+        distance. Only rows where that distance is tied are fully sorted,
+        so the tied neighbours chosen are the same as before.
+        With sparse_output=True the adjacency matrix is a scipy.sparse CSR
+        matrix, holding only the O(nk) adjacencies.
         """
 
         if add_noise:
             M = self.add_noise()
         else:
-            M = self.matrix
-        shape = M.shape
-        kneighbour_matrix = np.zeros(shape)
-        max_dists = {}
-        for i in range(shape[0]):
-            sorted_dists = M[i].argsort()
-            for j in sorted_dists[:k]:
-                kneighbour_matrix[i, j] = kneighbour_matrix[j, i] = 1
-                max_dists[i] = M[i, sorted_dists[k - 1]]
+            M = self._matrix
+        size = len(M)
+        if sparse_output:
+            (edge_rows, edge_cols) = ([], [])
+        else:
+            kneighbour_matrix = np.zeros((size, size), dtype=np.bool)
+        kth = np.zeros(size)
+        for rows in self.row_blocks():
+            block = self.get_rows(rows, M)
+            kth[rows] = np.partition(block, k - 1, axis=1)[:, k - 1]
+            neighbours = block <= kth[rows, np.newaxis]
+            tied = np.flatnonzero(neighbours.sum(axis=1) > k)
+            if len(tied) > 0:
+                neighbours[tied] = False
+                neighbours[tied[:, np.newaxis], np.argsort(block[tied],
+                           axis=1)[:, :k]] = True
+            if sparse_output:
+                (r, c) = np.nonzero(neighbours)
+                edge_rows.append(rows[r])
+                edge_cols.append(c)
+            else:
+                kneighbour_matrix[rows] = neighbours
+        if sparse_output:
+            (r, c) = (np.concatenate(edge_rows), np.concatenate(edge_cols))
+            kneighbour_matrix = sparse.coo_matrix((np.ones(len(r)), (r,
+                    c)), shape=(size, size)).tocsr()
+            kneighbour_matrix = kneighbour_matrix.maximum(kneighbour_matrix.T)
+        else:
+            kneighbour_matrix = (kneighbour_matrix
+                                 | kneighbour_matrix.T).astype(np.float)
+        max_dists = dict(enumerate(kth))
         return (kneighbour_matrix, max_dists)
 
+    def get_neighbour_order(self, k, add_noise=False):
+        """
+        The k nearest neighbours of every tree, nearest first, as a pair of
+        n x k arrays: (neighbour indices, distances). Each row is in
+        argsort order, so get_knn(j) for any j <= k chooses the first j
+        (see knn_from_order).
+        """
+
+        if add_noise:
+            M = self.add_noise()
+        else:
+            M = self._matrix
+        size = len(M)
+        order = np.zeros((size, k), dtype=np.int)
+        dists = np.zeros((size, k))
+        for rows in self.row_blocks():
+            block = self.get_rows(rows, M)
+            order[rows] = np.argsort(block, axis=1)[:, :k]
+            dists[rows] = block[np.arange(len(rows))[:, np.newaxis],
+                                order[rows]]
+        return (order, dists)
+
+    @staticmethod
+    def knn_from_order(
+        order,
+        dists,
+        k,
+        sparse_output=False,
+        ):
+        """
+        get_knn's (adjacency matrix, max_dists) for k up to the number of
+        neighbours in a get_neighbour_order result
+        """
+
+        size = len(order)
+        rows = np.repeat(np.arange(size), k)
+        cols = order[:, :k].ravel()
+        if sparse_output:
+            kneighbour_matrix = sparse.coo_matrix((np.ones(len(rows)),
+                    (rows, cols)), shape=(size, size)).tocsr()
+            kneighbour_matrix = kneighbour_matrix.maximum(kneighbour_matrix.T)
+        else:
+            kneighbour_matrix = np.zeros((size, size))
+            kneighbour_matrix[rows, cols] = 1
+            kneighbour_matrix[cols, rows] = 1
+        max_dists = dict(enumerate(dists[:, k - 1]))
+        return (kneighbour_matrix, max_dists)
+
+    def get_max_dists(self):
+        """
+        get_knn(n)'s max_dists: the largest distance from each tree
+        """
+
+        return dict(enumerate(np.concatenate([self.get_rows(rows).max(axis=1)
+                    for rows in self.row_blocks()])))
+
     def get_affinity_matrix(
         self,
         kneighbour_matrix,
@@ -243,26 +848,45 @@ class DistanceMatrix(object):
         """
         Makes weighted adjacency matrix along the lines of
         Zelnik-Manor and Perona (2004), with local scaling.
+        A sparse kneighbour_matrix gives a sparse (CSR) affinity matrix
+        with the same structure.
         """
 
         if add_noise:
             M = self.add_noise()
         else:
-            M = self.matrix
-        shape = M.shape
-        affinity_matrix = np.zeros(shape)
-        for i in range(shape[0]):
-            for j in range(shape[1]):
-                if kneighbour_matrix[i, j] == 1:
-                    distance = M[i, j]
-                    if local_scaling:
-                        sigma_i = max_dists[i]
-                        sigma_j = max_dists[j]
-                        affinity_matrix[i, j] = np.exp(-distance ** 2
-                                / (sigma_i * sigma_j))
-                    else:
-                        affinity_matrix[i, j] = np.exp(-distance ** 2
-                                / 2 * sigma)
+            M = self._matrix
+        size = len(M)
+        scales = np.array([max_dists[i] for i in range(size)])
+        if sparse.issparse(kneighbour_matrix):
+            adjacency = sparse.triu(kneighbour_matrix, format='coo')
+            (rows, cols) = (adjacency.row, adjacency.col)
+            if isinstance(M, CondensedMatrix):
+                distance = M.take(rows, cols).astype(np.float)
+            else:
+                distance = np.asarray(M[rows, cols], dtype=np.float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if local_scaling:
+                    values = np.exp(-distance ** 2 / (scales[rows]
+                                    * scales[cols]))
+                else:
+                    values = np.exp(-distance ** 2 / 2 * sigma)
+            upper = rows != cols
+            return sparse.coo_matrix((np.concatenate((values,
+                    values[upper])), (np.concatenate((rows,
+                    cols[upper])), np.concatenate((cols, rows[upper])))),
+                    shape=(size, size)).tocsr()
+        affinity_matrix = np.zeros((size, size))
+        for rows in self.row_blocks():
+            block = self.get_rows(rows, M)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if local_scaling:
+                    block = np.exp(-block ** 2 / np.outer(scales[rows],
+                                   scales))
+                else:
+                    block = np.exp(-block ** 2 / 2 * sigma)
+            affinity_matrix[rows] = np.where(kneighbour_matrix[rows]
+                    == 1, block, 0)
         return affinity_matrix
 
     def get_double_centre(self, square_input=False, add_noise=False):
@@ -281,7 +905,11 @@ class DistanceMatrix(object):
         if add_noise:
             M = self.add_noise()
         else:
-            M = np.array(self.matrix, copy=True)
+            M = self._matrix
+        if isinstance(M, CondensedMatrix):
+            M = np.asarray(M.square(), dtype=np.float64)  # a new array
+        elif not add_noise:
+            M = np.array(M, copy=True)
         if square_input:
             M *= M
         (rows, cols) = M.shape
@@ -5,13 +5,41 @@ import dendropy as dpy
 
 # DENDROPY UTILS
 
-def convert_to_dendropy_trees(trees):
-    taxa = dpy.TaxonSet()
+def convert_to_dendropy_trees(trees, taxon_set=None):
+    taxa = (taxon_set if taxon_set is not None else dpy.TaxonSet())
     dpy_tree_list = [dpy.Tree.get_from_string(tree.newick, 'newick',
                      taxon_set=taxa) for tree in trees]
     return dpy_tree_list
 
 
+def get_dendropy_trees(trees, labels=()):
+    """
+    Dendropy trees in one TaxonSet, numbered as if the trees were parsed
+    in order into dpy.TaxonSet(labels). The trees' cached parses (see
+    Tree.get_dendropy_tree) are used if they already share such a
+    TaxonSet, otherwise they're parsed again into a new one, which is
+    cached in turn. The trees returned are shared, so must not be modified.
+    """
+
+    if not trees:
+        return []
+    labels = list(labels)
+    taxon_set = trees[0].cached_taxon_set
+    if taxon_set is not None:
+        dpy_trees = [tree.get_dendropy_tree(taxon_set) for tree in trees]
+        order = list(labels)
+        seen = set(order)
+        for tree in dpy_trees:
+            for leaf in tree.leaf_iter():
+                if not leaf.taxon.label in seen:
+                    seen.add(leaf.taxon.label)
+                    order.append(leaf.taxon.label)
+        if [taxon.label for taxon in taxon_set[:len(order)]] == order:
+            return dpy_trees
+    taxon_set = dpy.TaxonSet(labels)
+    return [tree.get_dendropy_tree(taxon_set) for tree in trees]
+
+
 def get_rf_distance(tree1, tree2):
     return tree1.symmetric_difference(tree2)
 
@@ -1,5 +1,5 @@
 import numpy as np
-from evrot_extensions import build_Uab, sum_dJ
+from evrot_extensions import build_Uab, sum_dJ, sweep
 
 def buildA(X, U1, Vk, U2):
     
@@ -69,21 +69,14 @@ def evqual(X, ndata, dim):
 
 def cluster_assign(X):#, ik, jk, dim, ndata):
 
+    # cluster j lists (1-based, in order) the rows whose largest squared
+    # value is in column j
+
     (ndata,dim)=X.shape
-    Xsq = X*X
-    max_values = np.max(Xsq, axis=1)
-    max_index = np.argmax(Xsq, axis=1)
+    max_index = np.argmax(X*X, axis=1)
     cluster_count = np.bincount(max_index, minlength=dim)
-    cluster_cell_array = [ np.array( [0]*count ) for count in cluster_count  ]
-
-    for j in xrange(dim):
-        cluster = cluster_cell_array[j]
-        cind = 0
-        for i in xrange(ndata):
-            if max_index[i] == j:
-                cluster[cind] = i+1
-                cind+=1
-    return cluster_cell_array
+    order = np.argsort(max_index, kind='mergesort') + 1
+    return np.split(order, np.cumsum(cluster_count)[:-1])
     
 def test(X):
     (ndata, dim) = X.shape
@@ -106,24 +99,21 @@ def main(X, max_iter=200):
     angle_num = len(ik)
 
     theta = np.array( [0.0]*angle_num )
-    theta_new = np.array( [0.0]*angle_num )
+    X = np.ascontiguousarray(X, dtype=np.float)
+    ik = np.ascontiguousarray(ik, dtype=np.int_)
+    jk = np.ascontiguousarray(jk, dtype=np.int_)
 
     Q = evqual(X, ndata, dim)
     Q_old1 = Q
     Q_old2 = Q
     alpha = 1
     for iteration in range(max_iter):
-        
-        for d in range(angle_num):
-            dQ = evqualitygrad(X, theta, ik, jk, angle_num, d, dim, ndata)
-            theta_new[d] = theta[d] - alpha * dQ
-            Xrot = rotate_givens(X, theta_new, ik, jk, angle_num, dim)
-            Q_new = evqual(Xrot, ndata, dim)
-            if Q_new > Q:
-                theta[d] = theta_new[d]
-                Q = Q_new
-            else:
-                theta_new[d] = theta[d]
+
+        # one gradient step per angle, kept if it improves Q (as
+        # evqualitygrad / rotate_givens / evqual would do it, but updating
+        # the rotated matrix a Givens rotation at a time)
+
+        Q = sweep(X, theta, ik, jk, alpha, Q)
 
 
         # Stopping criterion
@@ -134,7 +124,7 @@ def main(X, max_iter=200):
         Q_old2 = Q_old1
         Q_old1 = Q
 
-    Xrot = rotate_givens(X, theta_new, ik, jk, angle_num, dim)
+    Xrot = rotate_givens(X, theta, ik, jk, angle_num, dim)
     clusts = cluster_assign(Xrot)
 
     return (clusts, Q, Xrot)
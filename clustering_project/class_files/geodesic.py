@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+import numpy as np
+from dpy_utils import get_dendropy_trees
+from tiling import tiled_matrix
+
+TOLERANCE = 1e-10
+
+
+def _popcount(x):
+    return bin(x).count('1')
+
+
+def _compatible(x, y):
+    """
+    Clusters x and y (leaf bitmasks) can coexist in one tree if they are
+    nested or disjoint
+    """
+
+    common = x & y
+    return common == 0 or common == x or common == y
+
+
+def encode_tree(dpy_tree, rooted):
+    """
+    Reduces a dendropy tree to what the geodesic needs:
+        leaves - {leaf bit: pendant edge length}
+        splits - {cluster bitmask: edge length} for internal edges
+    Rooted trees use the cluster below each internal edge (the root edge
+    is ignored, as in gtp.jar). Unrooted trees use the side of each split
+    that excludes the lowest-numbered leaf, so the two edges at a
+    bifurcating root become one split and their lengths are summed.
+    Zero-length internal edges are dropped: they don't move the tree.
+    The tree itself is not modified (dendropy's encode_splits would
+    collapse the basal bifurcation of trees read without [&R]).
+    """
+
+    bits = dict((taxon, 1 << n) for (n, taxon) in
+                enumerate(dpy_tree.taxon_set))
+    seed = dpy_tree.seed_node
+    masks = {}
+    for node in dpy_tree.postorder_node_iter():
+        if node.is_leaf():
+            masks[node] = bits[node.taxon]
+        else:
+            masks[node] = sum(masks[child] for child in
+                              node.child_nodes())
+    full = masks[seed]
+    reference = full & -full
+    leaves = {}
+    splits = {}
+    for (node, mask) in masks.iteritems():
+        if node is seed:
+            continue
+        length = node.edge.length or 0.0
+        if not rooted and mask & reference:
+            mask = full ^ mask
+        if mask == 0 or mask == full:
+            continue
+        if _popcount(mask) == 1:
+            leaves[mask] = leaves.get(mask, 0.0) + length
+        else:
+            splits[mask] = splits.get(mask, 0.0) + length
+    splits = dict((mask, length) for (mask, length) in splits.iteritems()
+                  if length != 0)
+    return (leaves, splits)
+
+
+def _min_weight_cover(a_weights, b_weights, neighbours):
+    """
+    Minimum weight vertex cover of a bipartite graph, where neighbours[i]
+    lists the b vertices joined to a vertex i. Found as a minimum s-t cut
+    (source -> a, capacity a_weights; a -> b, unbounded; b -> sink,
+    capacity b_weights) by shortest augmenting paths.
+    Returns (weight, cover_a, cover_b) with the covers as lists of bools.
+    """
+
+    (p, q) = (len(a_weights), len(b_weights))
+    source_cap = list(a_weights)
+    sink_cap = list(b_weights)
+    flows_in = [{} for _ in range(q)]  # flows_in[j][i]: flow on a_i -> b_j
+    total = 0.0
+    while True:
+        parent_a = [None] * p  # -1: reached from the source; else a b vertex
+        parent_b = [None] * q
+        queue = [i for i in range(p) if source_cap[i] > TOLERANCE]
+        for i in queue:
+            parent_a[i] = -1
+        end = None
+        for i in queue:
+            for j in neighbours[i]:
+                if parent_b[j] is not None:
+                    continue
+                parent_b[j] = i
+                if sink_cap[j] > TOLERANCE:
+                    end = j
+                    break
+                for (k, flow) in flows_in[j].iteritems():
+                    if flow > TOLERANCE and parent_a[k] is None:
+                        parent_a[k] = j
+                        queue.append(k)
+            if end is not None:
+                break
+        if end is None:
+            break
+        path = []
+        (i, j) = (parent_b[end], end)
+        push = sink_cap[end]
+        while True:
+            path.append((i, j))
+            if parent_a[i] == -1:
+                push = min(push, source_cap[i])
+                break
+            (i, j) = (parent_b[parent_a[i]], parent_a[i])
+            push = min(push, flows_in[j][path[-1][0]])
+        sink_cap[end] -= push
+        source_cap[path[-1][0]] -= push
+        for (n, (i, j)) in enumerate(path):
+            flows_in[j][i] = flows_in[j].get(i, 0.0) + push
+            if n + 1 < len(path):
+                back = parent_a[i]
+                flows_in[back][i] -= push
+        total += push
+    cover_a = [parent is None for parent in parent_a]
+    cover_b = [parent is not None for parent in parent_b]
+    return (total, cover_a, cover_b)
+
+
+def _ratio_sequence(a_splits, a_lengths, b_splits, b_lengths):
+    """
+    Owen & Provan's GTP iteration. Starting from the single ratio (A, B),
+    each ratio is split in two while the minimum weight vertex cover of its
+    incompatibility graph (weights |a|^2/||A||^2, |b|^2/||B||^2) is below 1:
+    (A, B) -> (A & cover, B - cover), (A - cover, B & cover).
+    Returns the final list of (||A_i||, ||B_i||).
+    """
+
+    a_sq = [length ** 2 for length in a_lengths]
+    b_sq = [length ** 2 for length in b_lengths]
+    pending = [(range(len(a_splits)), range(len(b_splits)))]
+    done = []
+    while pending:
+        (a, b) = pending.pop()
+        a_norm = sum(a_sq[i] for i in a)
+        b_norm = sum(b_sq[j] for j in b)
+        if len(a) > 0 and len(b) > 0 and len(a) + len(b) > 2:
+            position = dict((j, n) for (n, j) in enumerate(b))
+            neighbours = [[position[j] for j in b
+                          if not _compatible(a_splits[i], b_splits[j])]
+                          for i in a]
+            (weight, cover_a, cover_b) = _min_weight_cover([a_sq[i]
+                    / a_norm for i in a], [b_sq[j] / b_norm for j in
+                    b], neighbours)
+            if weight < 1 - TOLERANCE:
+                pending.append(([i for (i, c) in zip(a, cover_a)
+                               if not c], [j for (j, c) in zip(b,
+                               cover_b) if c]))
+                pending.append(([i for (i, c) in zip(a, cover_a) if c],
+                               [j for (j, c) in zip(b, cover_b)
+                               if not c]))
+                continue
+        done.append((a_norm ** 0.5, b_norm ** 0.5))
+    return done
+
+
+def geodesic_distance(tree1, tree2):
+    """
+    Geodesic distance in BHV tree space between two encoded trees
+    (see encode_tree). Splits common to both trees, or compatible with
+    every split of the other tree, contribute the squared difference of
+    their lengths; so do the leaf edges. The remaining, incompatible splits
+    contribute sum_i (||A_i|| + ||B_i||)^2 over the GTP ratio sequence.
+    """
+
+    (leaves1, splits1) = tree1
+    (leaves2, splits2) = tree2
+    total = 0.0
+    for leaf in set(leaves1) | set(leaves2):
+        total += (leaves1.get(leaf, 0.0) - leaves2.get(leaf, 0.0)) ** 2
+    (a_splits, a_lengths, b_splits, b_lengths) = ([], [], [], [])
+    for (splits, other, sp, ln) in ((splits1, splits2, a_splits,
+            a_lengths), (splits2, splits1, b_splits, b_lengths)):
+        for (split, length) in splits.iteritems():
+            if split in other:
+                if splits is splits1:
+                    total += (length - other[split]) ** 2
+            elif all(_compatible(split, x) for x in other):
+                total += length ** 2
+            else:
+                sp.append(split)
+                ln.append(length)
+    if a_splits:
+        for (a_norm, b_norm) in _ratio_sequence(a_splits, a_lengths,
+                b_splits, b_lengths):
+            total += (a_norm + b_norm) ** 2
+    return total ** 0.5
+
+
+class GeodesicTable(object):
+
+    """
+    The encoded trees of a collection (see encode_tree), kept together with
+    their taxon order so more trees can be added later with consistent
+    leaf bits, as in splits.SplitTable
+    """
+
+    def __init__(
+        self,
+        trees=None,
+        dpy_trees=None,
+        rooted=True,
+        ):
+
+        self.labels = []  # taxon labels, in bit order
+        self.newicks = []  # newick string of each tree, if known
+        self.rooted = rooted
+        self.encoded = []
+        if trees or dpy_trees:
+            self.add_trees(trees, dpy_trees)
+
+    def __len__(self):
+        return len(self.encoded)
+
+    def add_trees(self, trees=None, dpy_trees=None):
+        if dpy_trees is None:
+            dpy_trees = get_dendropy_trees(trees, self.labels)
+        self.newicks.extend([tree.newick for tree in trees] if trees
+                            else [None] * len(dpy_trees))
+        self.encoded.extend(encode_tree(tree, self.rooted) for tree in
+                            dpy_trees)
+        if dpy_trees:
+            self.labels = [taxon.label for taxon in dpy_trees[0].taxon_set]
+
+    def block(
+        self,
+        rows,
+        cols,
+        upper=False,
+        needed=None,
+        ):
+        """
+        Geodesic distances between trees in rows and trees in cols; with
+        upper=True only pairs with col > row are computed, and with a set
+        of (row, col) pairs as needed, only those (others are 0)
+        """
+
+        encoded = self.encoded
+        wanted = lambda i, j: (j > i if upper else j != i) and (needed
+                is None or (i, j) in needed)
+        return np.array([[(geodesic_distance(encoded[i], encoded[j])
+                        if wanted(i, j) else 0.0) for j in cols] for i in
+                        rows]).reshape(len(rows), len(cols))
+
+
+class Geodesic(object):
+
+    """
+    In-process replacement for gtp.jar: geodesic distances between trees
+    by the polynomial algorithm of Owen and Provan (2011), with the same
+    run / pairwise interface as the GTP wrapper.
+    With nprocesses > 1 the all-pairs matrix is computed by a pool of
+    processes, each working on tiles of rows of the upper triangle
+    (see tiling.tiled_matrix).
+    """
+
+    def __init__(self, nprocesses=1):
+        self.nprocesses = nprocesses
+
+    def __str__(self):
+        desc = 'In-process geodesic distance calculator'
+        authors = '(Owen, Megan, and J Scott Provan. 2011.'
+        title = \
+            'A Fast Algorithm for Computing Geodesic Distances in Tree Space,'
+        doi = 'doi:10.1109/TCBB.2010.3)'
+        details = 'Processes: {0}'.format(self.nprocesses)
+
+        return '\n'.join((
+            desc,
+            authors,
+            title,
+            doi,
+            '',
+            details,
+            '',
+            ))
+
+    def allrooted(self, trees):
+        return all(tree.rooted for tree in trees)
+
+    def encode(self, trees, dpy_trees=None):
+        return GeodesicTable(trees, dpy_trees, rooted=self.allrooted(trees))
+
+    def pairwise(self, tree1, tree2):
+        return self.encode((tree1, tree2)).block([0], [1])[0, 0]
+
+    def run(self, trees, dpy_trees=None):
+        return self.run_table(self.encode(trees, dpy_trees))
+
+    def run_table(self, table):
+        return tiled_matrix(len(table), lambda rows, cols: \
+                            table.block(rows, cols, upper=True),
+                            self.nprocesses)
@@ -4,7 +4,11 @@
 
 from errors import FileError
 from file_utils import *
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import shutil
+import tempfile
 
 local_dir = path_to(__file__)
 
@@ -12,10 +16,24 @@ local_dir = path_to(__file__)
 class GTP(object):
 
     """
-    Interacts with gtp.jar to calculate geodesic distances from trees
+    Interacts with gtp.jar to calculate geodesic distances from trees.
+
+    Every run works in its own directory under tmpdir, so concurrent runs
+    sharing a tmpdir don't overwrite each other's files. gtp.jar compares
+    every pair of trees in its input file, so a batch of pairwise or
+    one-vs-many comparisons is answered by a single JVM.
+    With nprocesses > 1, run() splits the trees into blocks and starts a
+    JVM for each pair of blocks (up to nprocesses at once); together these
+    cover every pair of trees, and their outputs are stitched into one
+    matrix.
     """
 
-    def __init__(self, supplied_binary='', tmpdir='/tmp'):
+    def __init__(
+        self,
+        supplied_binary='',
+        tmpdir='/tmp',
+        nprocesses=1,
+        ):
 
         if can_locate(supplied_binary):
             self.binary = supplied_binary
@@ -29,6 +47,9 @@ class GTP(object):
             raise FileError(supplied_binary)
 
         self.tmpdir = tmpdir.rstrip('/')
+        if nprocesses < 1:
+            nprocesses = multiprocessing.cpu_count()
+        self.nprocesses = nprocesses
 
     def __str__(self):
         desc = 'Wrapper for gtp.jar - geodesic distance calculator'
@@ -38,8 +59,8 @@ class GTP(object):
         doi = 'doi:10.1109/TCBB.2010.3)'
 
         details = \
-            'Jarfile: {0}\nTemp directory: {1}'.format(self.binary,
-                self.tmpdir)
+            'Jarfile: {0}\nTemp directory: {1}\nProcesses: {2}'.format(self.binary,
+                self.tmpdir, self.nprocesses)
 
         return '\n'.join((
             desc,
@@ -54,37 +75,90 @@ class GTP(object):
     def allrooted(self, trees):
         return all(tree.rooted for tree in trees)
 
-    def call(self, rooted):
+    def blocks(self, size):
+        """
+        Splits range(size) into the fewest blocks giving at least two pairs
+        of blocks per process, and returns the index arrays of the jobs
+        (one per pair of blocks), or a single job for one process
+        """
+
+        nblocks = 1
+        if self.nprocesses > 1:
+            while nblocks * (nblocks - 1) // 2 < 2 * self.nprocesses \
+                and nblocks < size:
+                nblocks += 1
+        blocks = [block for block in np.array_split(np.arange(size),
+                  nblocks) if len(block) > 0]
+        if len(blocks) < 2:
+            return [np.arange(size)]
+        return [np.concatenate((blocks[i], blocks[j])) for i in
+                range(len(blocks)) for j in range(i + 1, len(blocks))]
+
+    def call(
+        self,
+        rooted,
+        infile,
+        outfile,
+        ):
 
         bincall = 'java -jar {0}'.format(self.binary)
         if not rooted:
             flags = '-u -o'
         else:
             flags = '-o'
-        outf = '{0}/output.txt'.format(self.tmpdir)
-        inf = '{0}/geotrees.nwk > /dev/null'.format(self.tmpdir)
+        inf = '{0} > /dev/null'.format(infile)
 
-        cmd = ' '.join((bincall, flags, outf, inf))
+        cmd = ' '.join((bincall, flags, outfile, inf))
         syscall(cmd)
 
-    def clean(self):
-        delete('{0}/geotrees.nwk'.format(self.tmpdir))
-        delete('{0}/output.txt'.format(self.tmpdir))
+    def clean(self, workspace):
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    def one_vs_many(self, tree, trees):
+        """
+        Distances from tree to each of trees, from one JVM
+        """
+
+        return self.run([tree] + list(trees))[0, 1:]
 
     def pairwise(self, tree1, tree2):
         return self.run((tree1, tree2))[0, 1]
 
-    def read(self, size):
-        matrix = np.zeros((size, size))
+    def pairwise_many(self, pairs):
+        """
+        Distances for a list of (tree1, tree2) pairs, from one run over
+        the distinct trees involved
+        """
+
+        trees = []
+        index = {}
+        for tree in (tree for pair in pairs for tree in pair):
+            if not id(tree) in index:
+                index[id(tree)] = len(trees)
+                trees.append(tree)
+        matrix = self.run(trees)
+        return [matrix[index[id(tree1)], index[id(tree2)]] for (tree1,
+                tree2) in pairs]
+
+    def read(
+        self,
+        outfile,
+        matrix,
+        indices,
+        ):
+        """
+        Fills matrix from a gtp.jar output file, line by line, mapping the
+        file's tree numbers to rows and columns through indices
+        """
 
         try:
-            with open('{0}/output.txt'.format(self.tmpdir)) as outf:
+            with open(outfile) as outf:
                 for line in outf:
                     line = line.rstrip()
                     if line:
                         (i, j, value) = line.split()
-                        i = int(i)
-                        j = int(j)
+                        i = indices[int(i)]
+                        j = indices[int(j)]
                         value = float(value)
                         matrix[i, j] = matrix[j, i] = value
 
@@ -96,28 +170,69 @@ class GTP(object):
             raise
 
     def run(self, trees):
-        self.writetmp(trees)
+        trees = list(trees)
         rooted = self.allrooted(trees)
-        self.call(rooted)
+        jobs = self.blocks(len(trees))
+        workspace = tempfile.mkdtemp(prefix='gtp_', dir=self.tmpdir)
+        files = [('{0}/geotrees{1}.nwk'.format(workspace, n),
+                 '{0}/output{1}.txt'.format(workspace, n)) for n in
+                 range(len(jobs))]
         try:
-            matrix = self.read(len(trees))
-            self.clean()
+            for (job, (infile, outfile)) in zip(jobs, files):
+                self.writetmp([trees[i] for i in job], infile)
+            calls = lambda job_files: self.call(rooted, *job_files)
+            if len(jobs) > 1:
+
+                # the JVMs are separate processes, so threads are enough
+                # to keep nprocesses of them running
+
+                pool = ThreadPool(min(self.nprocesses, len(jobs)))
+                pool.map(calls, files, chunksize=1)
+                pool.close()
+                pool.join()
+            else:
+                calls(files[0])
+            matrix = np.zeros((len(trees), len(trees)))
+            for (job, (infile, outfile)) in zip(jobs, files):
+                self.read(outfile, matrix, job)
             return matrix
-        except IOError:
-            print 'except'
-            matrix = None
-            raise
+        finally:
+            self.clean(workspace)
 
-    def writetmp(self, trees):
-        with open('{0}/geotrees.nwk'.format(self.tmpdir), 'w') as tmpf:
+    def writetmp(self, trees, infile):
+        with open(infile, 'w') as tmpf:
             tmpf.write('\n'.join(tree.newick.rstrip() for tree in
                        trees))
 
 
 if __name__ == '__main__':
     from tree import Tree
+    from geodesic import Geodesic
     trees = [Tree.new_random_coal(10) for _ in range(100)]
     g = GTP()
     print g
     m = g.run(trees)
     print m
+
+    # block-parallel and batched runs must reproduce the single run
+
+    blocked = GTP(nprocesses=3).run(trees)
+    print 'Max difference of block-parallel run: {0}'.format(np.abs(blocked
+            - m).max())
+    assert np.allclose(blocked, m)
+    assert np.allclose(g.one_vs_many(trees[5], trees[10:20]), m[5, 10:
+                       20])
+    assert np.allclose(g.pairwise_many([(trees[1], trees[2]), (trees[3],
+                       trees[1])]), [m[1, 2], m[3, 1]])
+
+    # regression check of the in-process implementation against gtp.jar,
+    # which writes 6 decimal places
+
+    native = Geodesic().run(trees)
+    pooled = Geodesic(nprocesses=4).run(trees)
+    print 'Max difference from gtp.jar: {0}'.format(np.abs(native
+            - m).max())
+    print 'Max difference of pooled run: {0}'.format(np.abs(pooled
+            - native).max())
+    assert np.allclose(native, m, atol=1e-6)
+    assert np.allclose(pooled, native)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import numpy as np
+
+# Set in the parent before the pool is created, so forked workers inherit
+# the distances without pickling (as in tiling.py)
+
+_matrix = None
+_rows_function = None
+
+# Candidate medoids are scored this many at a time
+
+BLOCK_CELLS = 2 ** 22
+
+
+def _blocks(size, nrows):
+    step = max(1, BLOCK_CELLS // max(nrows, 1))
+    return [np.arange(start, min(start + step, size)) for start in
+            range(0, size, step)]
+
+
+def nearest(columns):
+    """
+    From columns, n x k distances from each point to each medoid, the
+    position of each point's nearest medoid and the distances to its
+    nearest and second-nearest medoids (inf if there is only one)
+    """
+
+    (n, k) = columns.shape
+    near = columns.argmin(axis=1)
+    nearest_dists = columns[np.arange(n), near]
+    if k == 1:
+        return (near, nearest_dists, np.repeat(np.inf, n))
+    rest = columns.copy()
+    rest[np.arange(n), near] = np.inf
+    return (near, nearest_dists, rest.min(axis=1))
+
+
+def build(matrix, nclusters):
+    """
+    PAM's BUILD: the most central point, then repeatedly the point whose
+    addition most reduces the total distance to the nearest medoid
+    """
+
+    size = len(matrix)
+    medoids = [int(np.asarray(matrix.sum(axis=0)).argmin())]
+    dists = np.array(matrix[medoids[0]], dtype=np.float)
+    for _ in range(nclusters - 1):
+        gains = np.concatenate([np.maximum(dists[:, None] - matrix[:,
+                               block], 0).sum(axis=0) for block in
+                               _blocks(size, size)])
+        gains[medoids] = -1
+        medoids.append(int(gains.argmax()))
+        dists = np.minimum(dists, matrix[medoids[-1]])
+    return medoids
+
+
+def swap(matrix, medoids, max_iter=1000):
+    """
+    PAM's SWAP, computed as in FastPAM1 (Schubert and Rousseeuw 2019): with
+    each point's nearest and second-nearest medoid distances cached, the
+    change in total distance from swapping any medoid for a candidate c
+    comes from one pass over the column of distances to c, for all k
+    medoids at once. The best swap is made until none improves.
+    Returns (medoids, total distance).
+    """
+
+    size = len(matrix)
+    medoids = list(medoids)
+    nclusters = len(medoids)
+    for _ in range(max_iter):
+        (near, dn, ds) = nearest(matrix[:, medoids])
+        error = dn.sum()
+
+        # removing medoid i sends its points to their second-nearest
+
+        removal = np.bincount(near, weights=ds - dn, minlength=nclusters)
+        membership = np.zeros((nclusters, size))
+        membership[near, np.arange(size)] = 1
+        (best, best_i, best_c) = (0.0, None, None)
+        for block in _blocks(size, size):
+            d = matrix[:, block]
+            closer = d < dn[:, None]
+
+            # points the candidate would take from every medoid, and those
+            # it would take only from their nearest medoid if it went
+
+            shared = np.where(closer, d - dn[:, None], 0).sum(axis=0)
+            own = np.where(closer, (dn - ds)[:, None], np.where(d
+                           < ds[:, None], d - ds[:, None], 0))
+            delta = removal[:, None] + membership.dot(own) + shared
+            delta[:, np.in1d(block, medoids)] = np.inf
+            (i, c) = np.unravel_index(delta.argmin(), delta.shape)
+            if delta[i, c] < best:
+                (best, best_i, best_c) = (delta[i, c], i, block[c])
+        if best_i is None or best > -1e-10 * max(error, 1.0):
+            break
+        medoids[best_i] = int(best_c)
+    (near, dn, ds) = nearest(matrix[:, medoids])
+    return (medoids, dn.sum())
+
+
+def pam(matrix, nclusters, seed=None):
+    """
+    BUILD then SWAP, or with a seed, SWAP from random medoids
+    """
+
+    if seed is None:
+        medoids = build(matrix, nclusters)
+    else:
+        medoids = np.random.RandomState(seed).choice(len(matrix),
+                nclusters, replace=False)
+    return swap(matrix, medoids)
+
+
+def _run_pam(task):
+    (nclusters, seed) = task
+    return pam(_matrix, nclusters, seed)
+
+
+def _run_sample(task):
+    """
+    CLARA: PAM on a random sample, scored over every point
+    """
+
+    (size, nclusters, sample_size, seed) = task
+    rng = np.random.RandomState(seed)
+    sample = np.sort(rng.choice(size, sample_size, replace=False))
+    (medoids, _) = pam(_rows_function(sample)[:, sample], nclusters)
+    medoids = sample[medoids]
+    (near, dn, ds) = nearest(_rows_function(medoids).T)
+    return (list(medoids), dn.sum())
+
+
+def _map(function, tasks, n_jobs):
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(tasks))
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        results = pool.map(function, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+        return results
+    return [function(task) for task in tasks]
+
+
+def kmedoids(
+    matrix,
+    nclusters,
+    nstarts=10,
+    n_jobs=1,
+    seed=None,
+    ):
+    """
+    k-medoids of a square distance matrix, best of nstarts runs of PAM:
+    one from BUILD and the rest from random medoids, with independent
+    seeds drawn from seed. With n_jobs > 1 the runs are shared among a
+    pool of forked processes (n_jobs < 1 uses every core).
+    Returns (clusterid, error, medoids) where clusterid gives each point's
+    medoid, as Bio.Cluster.kmedoids does, and error is the total distance
+    of the points to their medoids.
+    """
+
+    global _matrix
+    matrix = np.asarray(matrix, dtype=np.float)
+    seeds = [None] + list(np.random.RandomState(seed).randint(2 ** 31,
+                          size=nstarts - 1))
+    _matrix = matrix
+    try:
+        results = _map(_run_pam, [(nclusters, s) for s in seeds], n_jobs)
+    finally:
+        _matrix = None
+    return _best(results, lambda medoids: matrix[:, medoids])
+
+
+def clara(
+    rows_function,
+    size,
+    nclusters,
+    sample_size=None,
+    nsamples=5,
+    n_jobs=1,
+    seed=None,
+    ):
+    """
+    CLARA (Kaufman and Rousseeuw 1990) for large matrices: PAM on each of
+    nsamples random samples of sample_size points (default 40 + 2k), keeping
+    the medoids with the least total distance over all the points.
+    rows_function(rows) gives the len(rows) x size distances, so only the
+    sampled rows and the medoids' rows are read.
+    Returns (clusterid, error, medoids) as kmedoids.
+    """
+
+    global _rows_function
+    if sample_size is None:
+        sample_size = 40 + 2 * nclusters
+    sample_size = min(max(sample_size, nclusters), size)
+    tasks = [(size, nclusters, sample_size, s) for s in
+             np.random.RandomState(seed).randint(2 ** 31, size=nsamples)]
+    _rows_function = rows_function
+    try:
+        results = _map(_run_sample, tasks, n_jobs)
+    finally:
+        _rows_function = None
+    return _best(results, lambda medoids: rows_function(medoids).T)
+
+
+def _best(results, columns_function):
+    """
+    (clusterid, error, medoids) for the (medoids, error) with the least
+    error, the earliest on ties
+    """
+
+    errors = [error for (_, error) in results]
+    medoids = results[int(np.argmin(errors))][0]
+    (near, dn, ds) = nearest(columns_function(medoids))
+    return (np.asarray(medoids)[near], dn.sum(), medoids)
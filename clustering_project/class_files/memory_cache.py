@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import numpy as np
+from scipy import sparse
+
+
+def nbytes(value):
+    """
+    Approximate memory held by the arrays (dense or scipy.sparse) and
+    strings in a value, looking inside tuples, lists and dicts
+    """
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, str):
+        return len(value)
+    if sparse.issparse(value):
+        value = value.tocsr()
+        return value.data.nbytes + value.indices.nbytes \
+            + value.indptr.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+class MemoryCache(object):
+
+    """
+    Least recently used store of values bounded by the memory their arrays
+    and strings take (see nbytes), and optionally by their number.
+
+    Entries are keyed by the caller. When they take more than max_bytes,
+    or there are more than max_entries (unless that is None), the least
+    recently used are evicted. A single entry larger than max_bytes is not
+    kept at all. If pickle_entries is False the cache is pickled (and
+    copied) empty, keeping only its limits.
+    """
+
+    def __init__(
+        self,
+        max_bytes=2 ** 30,
+        max_entries=None,
+        pickle_entries=True,
+        ):
+
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.pickle_entries = pickle_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total = 0
+
+    def __str__(self):
+        return '{0}: {1} entries, {2:.1f} of {3:.1f} MB\n{4} hits, {5} misses'.format(type(self).__name__, len(self),
+                self.nbytes / 2.0 ** 20, self.max_bytes / 2.0 ** 20,
+                self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        if not self.pickle_entries:
+            d['entries'] = OrderedDict()
+            d['sizes'] = {}
+            d['total'] = 0
+        return d
+
+    @property
+    def nbytes(self):
+        return self.total
+
+    def get(self, key):
+        """
+        Entry for key, marked as recently used, or None
+        """
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Stores (or replaces) the entry for key, then evicts the least
+        recently used entries until the cache is within its limits
+        """
+
+        self.discard(key)
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.total += size
+        while self.max_entries is not None and len(self.entries) \
+            > self.max_entries or self.nbytes > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self.total -= self.sizes.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.total = 0
+
+    def report(self):
+        """
+        Lines describing each entry, least recently used first
+        """
+
+        return ['{0}: {1:.1f} MB'.format(key, self.sizes[key] / 2.0 ** 20)
+                for key in self.entries]
@@ -9,6 +9,9 @@ if import_debugging:
 from copy import deepcopy
 if import_debugging:
     print '  copy::deepcopy (pa)'
+import numpy as np
+if import_debugging:
+    print '  numpy (pa)'
 
 
 class Partition(object):
@@ -32,26 +35,42 @@ class Partition(object):
     def __str__(self):
         return str(self.partition_vector)
 
-    def concatenate_records(self, keys_to_records_map):
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d.pop('_memberships', None)
+        return d
+
+    def concatenate_records(self, keys_to_records_map, known=None):
         """
         NB: had a version of this which used a reduce construct to concatenate
         the alignments - reduce(lambda x,y: x+y, records_list) - but this led
         to problems of the original object being modified. Deepcopying the 
         first record, ensuring a new memory address for the concatenation, seems 
         more robust.
+        Clusters of several records are concatenated in one pass by the
+        records' concatenate method (see TCSeqRec.concatenate), which
+        builds a new record. Concatenations already made, in known (a dict
+        of name: (record, cluster), as SequenceCollection.concats), are
+        reused.
         """
 
         memberships = self.get_membership(self.partition_vector)
         concats = []
+        if known is None:
+            known = {}
 
         for cluster in memberships:
             cluster = sorted(cluster)
+            name = '-'.join(str(x) for x in cluster)
+            if name in known:
+                concats.append(known[name])
+                continue
             member_records = [keys_to_records_map[n] for n in cluster]
-            first_rec = member_records.pop(0)
-            seed = deepcopy(first_rec)  # use of deepcopy here
-            for rec in member_records:  # is important
-                seed += rec
-            seed.name = '-'.join(str(x) for x in cluster)
+            if len(member_records) == 1:
+                seed = deepcopy(member_records[0])  # use of deepcopy here
+            else:                                   # is important
+                seed = member_records[0].concatenate(member_records)
+            seed.name = name
             concats.append((seed, cluster))
         self.concats = concats
         return concats  # guaranteed same order as get_membership()
@@ -61,25 +80,157 @@ class Partition(object):
                          for (rec, _) in self.concats])
 
     def get_membership(self, partition_vector=None, flatten=False):
+        """
+        Members of each cluster (as sets of indices, largest cluster
+        first), or with flatten=True one list of the indices in that order.
+        Results are cached per partition vector.
+        """
+
         if not partition_vector:
             partition_vector = self.partition_vector
 
-        clusters = sorted(list(set(partition_vector)))
-        result = []
-        for c in clusters:
-            members = []
-            for i in range(len(partition_vector)):
-                if c == partition_vector[i]:
-                    members.append(i)
-            result.append(set(members))
-        result = sorted(result, key=len, reverse=True)
+        cache = self.__dict__.setdefault('_memberships', {})
+        key = tuple(partition_vector)
+        if key not in cache:
+            (codes, counts) = self.label_codes(partition_vector)
+            members = np.split(np.argsort(codes, kind='mergesort'),
+                               np.cumsum(counts)[:-1])
+            cache[key] = [members[c].tolist() for c in np.argsort(-counts,
+                          kind='mergesort')]
+        clusters = [set(cluster) for cluster in cache[key]]
         if flatten:
-            flatlist = []
-            ext = flatlist.extend
-            for cluster in result:
-                ext(list(cluster))
-            return flatlist
-        return result
+            return [i for cluster in clusters for i in cluster]
+        return clusters
+
+    @staticmethod
+    def label_codes(partition_vector):
+        """
+        (codes, counts): each item's cluster as an index 0..k-1 (in sorted
+        label order) and the size of each cluster
+        """
+
+        (_, codes) = np.unique(np.asarray(partition_vector),
+                               return_inverse=True)
+        return (codes, np.bincount(codes))
+
+    @staticmethod
+    def contingency(partition_1, partition_2):
+        """
+        k1 x k2 table of the number of items in each pair of clusters,
+        counted with one bincount over the pairs' combined codes
+        """
+
+        (codes_1, counts_1) = Partition.label_codes(partition_1)
+        (codes_2, counts_2) = Partition.label_codes(partition_2)
+        (k1, k2) = (len(counts_1), len(counts_2))
+        return np.bincount(codes_1 * k2 + codes_2, minlength=k1
+                           * k2).reshape(k1, k2)
+
+    @staticmethod
+    def _entropy(counts, total):
+        p = counts / total
+        return -(p * np.log2(p)).sum()
+
+    @staticmethod
+    def _information(labelled, others):
+        """
+        Entropies, mutual information and adjusted Rand indices of one
+        partition against each of several, given as (codes, counts) (see
+        label_codes). The contingency tables of every pair are counted in
+        one bincount, side by side.
+        Returns (entropy, other entropies, mutual informations, ARIs).
+        """
+
+        (codes, counts) = labelled
+        total = float(len(codes))
+        sizes = np.array([len(other_counts) for (_, other_counts) in
+                         others])
+        cells = len(counts) * sizes
+        offsets = np.concatenate(([0], np.cumsum(cells)[:-1]))
+        table = np.bincount(np.concatenate([offset + codes * size
+                            + other_codes for (offset, size,
+                            (other_codes, _)) in zip(offsets, sizes,
+                            others)]), minlength=cells.sum())
+
+        # row and column totals for every cell of every table
+
+        segment = np.repeat(np.arange(len(others)), cells)
+        local = np.arange(cells.sum()) - offsets[segment]
+        column_offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        column_totals = np.concatenate([other_counts for (_,
+                other_counts) in others])[column_offsets[segment] + local
+                % sizes[segment]]
+        row_totals = counts[local // sizes[segment]]
+
+        filled = table > 0
+        n = table[filled].astype(np.float)
+        mut_inf = np.bincount(segment[filled], weights=n / total
+                              * np.log2(total * n / (row_totals[filled]
+                              * column_totals[filled])),
+                              minlength=len(others))
+        entropy = Partition._entropy(counts, total)
+        other_entropies = np.array([Partition._entropy(other_counts,
+                                   total) for (_, other_counts) in others])
+
+        pairs = lambda x: x * (x - 1) / 2.0
+        index = np.bincount(segment, weights=pairs(table),
+                            minlength=len(others))
+        row_pairs = pairs(counts).sum()
+        column_pairs = np.array([pairs(other_counts).sum() for (_,
+                                other_counts) in others])
+        expected = row_pairs * column_pairs / pairs(total)
+        maximum = 0.5 * (row_pairs + column_pairs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ari = np.where(maximum == expected, 1.0, (index - expected)
+                           / (maximum - expected))
+        return (entropy, other_entropies, mut_inf, ari)
+
+    @staticmethod
+    def compare_many(partition, others, measure='vi'):
+        """
+        Scores of one partition against each of others, in one pass:
+        measure is 'vi' (variation of information, bits), 'nmi'
+        (normalised mutual information) or 'ari' (adjusted Rand index)
+        """
+
+        return Partition._measure(Partition.label_codes(partition),
+                                  [Partition.label_codes(other) for other in
+                                  others], measure)
+
+    @staticmethod
+    def compare_all(partitions, measure='vi'):
+        """
+        Symmetric matrix of the scores (see compare_many) between every
+        pair of partitions
+        """
+
+        labelled = [Partition.label_codes(p) for p in partitions]
+        size = len(labelled)
+        matrix = np.zeros((size, size))
+        for i in range(size):
+            matrix[i, i:] = Partition._measure(labelled[i], labelled[i:],
+                    measure)
+            matrix[i:, i] = matrix[i, i:]
+        return matrix
+
+    @staticmethod
+    def _measure(labelled, others, measure):
+        if not others:
+            return np.array([])
+        (entropy_1, entropy_2, mut_inf, ari) = \
+            Partition._information(labelled, others)
+        if measure == 'vi':
+            return entropy_1 + entropy_2 - 2 * mut_inf
+        if measure == 'nmi':
+
+            # two single-cluster partitions are identical
+
+            both = entropy_1 + entropy_2
+            return np.where(both > 0, 2 * mut_inf / np.where(both > 0,
+                            both, 1), 1.0)
+        if measure == 'ari':
+            return ari
+        raise ValueError('Unrecognised measure: {0}'.format(measure))
 
     def entropies(self, partition_1, partition_2):
         """ 
@@ -88,66 +239,25 @@ class Partition(object):
         clusterings: an information based distance. Journal of Multivariate
         Analysis, 98(5), 873-895. doi:10.1016/j.jmva.2006.11.013 
 
-        dependencies:
-        math.log
-        
         parameters:
         partition_1 (list / array) - a partitioning of a dataset according to 
                 some clustering method. Cluster labels are arbitrary.
         partition_2 (list / array) - another partitioning of the same dataset.
                 Labels don't need to match, nor do the number of clusters.
 
-        subfunctions:
-        get_membership - parameter partition (list / array)
-            returns a list of length equal to the number of clusters found in
-            the partition. Each element is the set of members of the cluster.
-            Ordering is arbitrary.
-
-        variables used:
-            t = total number of points in the dataset
-            m1 = cluster memberships from partition_1
-            m2 = cluster memberships from partition_2
-            l1 = length (i.e. number of clusters) of m1
-            l2 = length of m2
-            entropy_1 = Shannon entropy of partition_1
-            entropy_2 = Shannon entropy of partition_2
-            mut_inf = mutual information of partitions
-            prob1 = probability distribution of partition 1 - i.e. the 
-                probability that a randomly chosen datapoint belongs to
-                each cluster (size of cluster / size of dataset)
-            prob2 = as above, for partition 2
-            intersect = number of common elements in partition 1 [i] and
-                partition 2 [j]
+        Returns (entropy of partition_1, entropy of partition_2, mutual
+        information), in bits, from the contingency table of the two
+        partitions (see _information).
         """
 
         if len(partition_1) != len(partition_2):
             print 'Partition lists are not the same length'
             return 0
-        else:
-            total = float(len(partition_1))  # Ensure float division later
-
-        m1 = self.get_membership(partition_1)
-        m2 = self.get_membership(partition_2)
-        l1 = len(m1)
-        l2 = len(m2)
-        entropy_1 = 0
-        entropy_2 = 0
-        mut_inf = 0
-        for i in range(l1):
-            prob1 = len(m1[i]) / total
-            entropy_1 -= prob1 * log(prob1, 2)
-            for j in range(l2):
-                if i == 0:  # only calculate these once
-                    prob2 = len(m2[j]) / total
-                    entropy_2 -= prob2 * log(prob2, 2)
-                intersect = len(m1[i] & m2[j])
-                if intersect == 0:
-                    continue  # because 0 * log(0) = 0 (lim x->0: xlog(x)->0)
-                else:
-                    mut_inf += intersect / total * log(total
-                            * intersect / (len(m1[i]) * len(m2[j])), 2)
-
-        return (entropy_1, entropy_2, mut_inf)
+
+        (entropy_1, entropy_2, mut_inf, _) = \
+            self._information(self.label_codes(partition_1),
+                              [self.label_codes(partition_2)])
+        return (entropy_1, entropy_2[0], mut_inf[0])
 
     def variation_of_information(self, partition_1, partition_2):
         (entropy_1, entropy_2, mut_inf) = self.entropies(partition_1,
@@ -159,4 +269,11 @@ class Partition(object):
         (entropy_1, entropy_2, mut_inf) = self.entropies(partition_1,
                 partition_2)
 
+        # two single-cluster partitions are identical (as in compare_many)
+
+        if entropy_1 + entropy_2 == 0:
+            return 1.0
         return (2*mut_inf)/(entropy_1+entropy_2)
+
+    def adjusted_rand_index(self, partition_1, partition_2):
+        return self.compare_many(partition_1, [partition_2], 'ari')[0]
@@ -27,6 +27,9 @@ if import_debugging:
 import sys
 if import_debugging:
     print '  sys (sc)'
+import time
+if import_debugging:
+    print '  time (sc)'
 import numpy as np
 if import_debugging:
     print '  numpy (sc)'
@@ -36,12 +39,15 @@ if import_debugging:
 from mpl_toolkits.mplot3d import Axes3D
 if import_debugging:
     print '  mpl_toolkits.mplot3d::Axes3D (pa)'
-from sequence_record import TCSeqRec
-from distance_matrix import DistanceMatrix
+from sequence_record import TCSeqRec, LazyTCSeqRec, read_alignment
+from distance_matrix import DistanceMatrix, LENGTH_METRICS
 from tree import Tree
 if import_debugging:
     print '  distance_matrix::DistanceMatrix (sc)'
-from clustering import Clustering
+from clustering import Clustering, HIERARCHICAL_METHODS
+from memory_cache import MemoryCache
+from collection_store import CollectionStore, read_summary, \
+    write_summary
 if import_debugging:
     print '  clustering::Clustering (sc)'
 from partition import Partition
@@ -109,6 +115,47 @@ def _unpickle_method(func_name, obj, cls):
 
 copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 
+# Parts of a collection saved to and loaded from a CollectionStore, with
+# the prefixes of their sections' names
+
+STORE_COMPONENTS = {
+    'alignments': ('alignment/', ),
+    'dv': ('dv/', ),
+    'trees': ('tree/', 'inferred_trees'),
+    'distance_matrices': ('distance_matrix/', ),
+    'partitions': ('partition/', 'concat/'),
+    }
+
+
+def _read_alignment(args):
+    """
+    read_alignment for Pool.map: workers send back the parsed strings,
+    which pickle more cheaply than whole records
+    """
+
+    return read_alignment(*args)
+
+
+def read_alignments(files, file_format='fasta', n_jobs=1):
+    """
+    Parsed (headers, sequences) of each file, read by a pool of n_jobs
+    processes (n_jobs < 1 uses every core) in large chunks so that many
+    small files don't each cost a round trip
+    """
+
+    args = [(f, file_format) for f in files]
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(args))
+    if n_jobs <= 1:
+        return [_read_alignment(a) for a in args]
+    pool = multiprocessing.Pool(n_jobs)
+    results = pool.map(_read_alignment, args, chunksize=max(1,
+                       len(args) // (4 * n_jobs)))
+    pool.close()
+    pool.join()
+    return results
+
 
 class SequenceCollection(object):
 
@@ -139,6 +186,10 @@ class SequenceCollection(object):
         get_distances=False,
         parallel_load=False,
         overwrite=True,
+        distance_cache=None,
+        n_jobs=1,
+        lazy=False,
+        record_bytes=2 ** 30,
         ):
 
         # Unset Variables
@@ -152,7 +203,8 @@ class SequenceCollection(object):
         self.distance_matrices = {}
         self.concats = {}
         self.inferred_trees = {}
-        self.Clustering = Clustering()
+        self.timings = {}
+        self.Clustering = Clustering(n_jobs=n_jobs)
 
         # Store some data
 
@@ -166,6 +218,7 @@ class SequenceCollection(object):
         # Set Variables
 
         self.tmpdir = tmpdir
+        self.distance_cache = distance_cache  # optional DistanceCache
 
         # Lambda for sorting by name and number
 
@@ -200,11 +253,15 @@ class SequenceCollection(object):
 
             files.sort(key=sort_key)
             self.put_records(files=files, record_list=None,
-                             file_format=file_format, datatype=datatype)
+                             file_format=file_format, datatype=datatype,
+                             n_jobs=n_jobs, lazy=lazy,
+                             record_bytes=record_bytes)
 
                                # takes care of self.length for us
+                               # (lazy records are sanitised as they load)
 
-            self.sanitise_records()
+            if not lazy:
+                self.sanitise_records()
             if not os.path.isdir(tmpdir):
                 os.mkdir(tmpdir)
         elif records:
@@ -228,6 +285,14 @@ class SequenceCollection(object):
                 self.put_dv_matrices(helper=helper, tmpdir=tmpdir,
                         overwrite=overwrite)
 
+    def __setstate__(self, state):
+
+        # collections pickled before the distance cache and timings
+
+        state.setdefault('distance_cache', None)
+        state.setdefault('timings', {})
+        self.__dict__.update(state)
+
     def __str__(self):
         s = 'SequenceCollection object:\n'
         s += 'Contains {0} alignments\n'.format(self.length)
@@ -298,30 +363,275 @@ class SequenceCollection(object):
             filename += '.gz'
 
         cPickle.dump(self, file=gz.open(filename, 'wb'), protocol=-1)
+        write_summary(filename, self.summary())
 
     @classmethod
     def gunzip(cls, filename):
 
+        if CollectionStore.is_store(filename):
+            return cls.load(filename)
         return cPickle.load(gz.open(filename, 'rb'))
 
+    def store_sections(self, components=None):
+        """
+        The collection as a dict of CollectionStore sections. The
+        'collection' section holds the names, datatypes and every other
+        attribute not in a component; the components (see STORE_COMPONENTS)
+        have a section per record, distance matrix, partition and
+        concatenation. The Clustering object is kept without its caches.
+        """
+
+        if components is None:
+            components = STORE_COMPONENTS.keys()
+        records = self.get_records()
+        heavy = set([
+            'records',
+            'records_to_keys',
+            'keys_to_records',
+            'partitions',
+            'distance_matrices',
+            'concats',
+            'inferred_trees',
+            'Clustering',
+            ])
+        collection = dict((k, v) for (k, v) in self.__dict__.items()
+                          if k not in heavy)
+        collection['names'] = [rec.name for rec in records]
+        collection['datatypes'] = [rec.datatype for rec in records]
+        clustering = self.Clustering.__dict__.copy()
+        for k in ('cache', 'kmeans_solutions'):
+            clustering.pop(k, None)
+        sections = {'collection': collection, 'clustering': clustering}
+
+        for rec in records:
+            if 'alignments' in components:
+                sections['alignment/' + rec.name] = {'headers': tuple(rec.headers),
+                        'sequences': (rec.alignment if rec.alignment
+                        is not None else list(rec.sequences))}
+            if 'dv' in components:
+                sections['dv/' + rec.name] = rec.dv
+            if 'trees' in components:
+                sections['tree/' + rec.name] = rec.tree
+        if 'trees' in components:
+            sections['inferred_trees'] = self.inferred_trees
+
+        # distance matrices share the records' trees, which aren't stored
+        # twice
+
+        if 'distance_matrices' in components:
+            for (metric, dm) in self.distance_matrices.items():
+                state = dm.__dict__.copy()
+                state.pop('trees', None)
+                sections['distance_matrix/' + metric] = state
+
+        # partitions refer to their concatenations by name; these keep
+        # their trees but not the alignment or dvs, which are remade from
+        # the records
+
+        if 'partitions' in components:
+            for (vector, partition) in self.partitions.items():
+                state = partition.__getstate__()
+                if 'concats' in state:
+                    state['concats'] = [(rec.name, cluster) for (rec,
+                            cluster) in state['concats']]
+                sections['partition/' + self.hash(str(vector))] = \
+                    (vector, state)
+            concats = dict(self.concats)
+            for partition in self.partitions.values():
+                for (rec, cluster) in getattr(partition, 'concats', []):
+                    concats.setdefault(rec.name, (rec, cluster))
+            for (name, (rec, cluster)) in concats.items():
+                sections['concat/' + self.hash(name)] = {'name': name,
+                        'cluster': cluster, 'tree': rec.tree}
+        return sections
+
+    def save(self, filename, components=None):
+        """
+        Writes the collection to a CollectionStore (see store_sections).
+        Saving again to the same file appends only the sections that have
+        changed, and drops those of the saved components that no longer
+        exist. With components, only those are written.
+        Any other file already at filename (e.g. a gzip pickle from
+        before stores were used) is replaced.
+        Returns the store.
+        """
+
+        if components is None:
+            components = STORE_COMPONENTS.keys()
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0 \
+            and not CollectionStore.is_store(filename):
+            os.remove(filename)
+        store = CollectionStore(filename)
+        sections = self.store_sections(components)
+        prefixes = tuple(prefix for c in components for prefix in
+                         STORE_COMPONENTS[c])
+        stale = [name for name in store.keys() if name.startswith(prefixes)
+                 and name not in sections]
+        store.update(sections, remove=stale)
+        write_summary(filename, self.summary())
+        return store
+
+    @classmethod
+    def load(cls, filename, components=None):
+        """
+        Reads a collection saved by save, with only the given components
+        (all by default: see STORE_COMPONENTS). Records whose alignments
+        aren't loaded are empty apart from their name, datatype, and any
+        dv and tree that are.
+        """
+
+        if components is None:
+            components = STORE_COMPONENTS.keys()
+        store = CollectionStore(filename)
+        prefixes = tuple(prefix for c in components for prefix in
+                         STORE_COMPONENTS[c])
+        sections = store.get_many(['collection', 'clustering']
+                                  + [name for name in store.keys()
+                                  if name.startswith(prefixes)])
+
+        sc = cls.__new__(cls)
+        sc.__dict__.update(sections['collection'])
+        names = sc.__dict__.pop('names')
+        datatypes = sc.__dict__.pop('datatypes')
+        sc.Clustering = Clustering.__new__(Clustering)
+        sc.Clustering.__setstate__(sections['clustering'])
+
+        records = []
+        for (name, datatype) in zip(names, datatypes):
+            alignment = sections.get('alignment/' + name)
+            if alignment:
+                rec = TCSeqRec(name=name, headers=alignment['headers'],
+                               sequences=alignment['sequences'],
+                               datatype=datatype)
+            else:
+                rec = TCSeqRec(name=name, datatype=datatype)
+            rec.dv = sections.get('dv/' + name, [])
+            if 'tree/' + name in sections:
+                rec.tree = sections['tree/' + name]
+            records.append(rec)
+        sc.put_records(record_list=records)
+        sc.inferred_trees = sections.get('inferred_trees', {})
+
+        trees = [rec.tree for rec in records]
+        sc.distance_matrices = {}
+        for name in store.keys('distance_matrix/'):
+            if name in sections:
+                dm = DistanceMatrix.__new__(DistanceMatrix)
+                dm.__setstate__(dict(sections[name], trees=trees))
+                sc.distance_matrices[name[len('distance_matrix/'):]] = \
+                    dm
+
+        sc.concats = {}
+        for name in store.keys('concat/'):
+            if name in sections:
+                concat = sections[name]
+                members = [sc.keys_to_records[k] for k in concat['cluster']]
+                rec = TCSeqRec.concatenate(members)
+                rec.name = concat['name']
+                rec.tree = concat['tree']
+                sc.concats[rec.name] = (rec, concat['cluster'])
+        sc.partitions = {}
+        for name in store.keys('partition/'):
+            if name in sections:
+                (vector, state) = sections[name]
+                partition = Partition.__new__(Partition)
+                partition.__dict__.update(state)
+                if 'concats' in state:
+                    partition.concats = [sc.concats[rec_name] for (rec_name,
+                            _) in state['concats']]
+                sc.partitions[vector] = partition
+        return sc
+
+    def summary(self):
+        """
+        The results in brief, as saved beside the collection by gzip and
+        save: the record names, the scores (as get_scores), for each
+        partition key (metric, method, nclusters) its partition vector,
+        score and the newick trees and scores of its clusters, and the
+        timings of the steps run
+        """
+
+        partitions = {}
+        for (key, vector) in self.clusters_to_partitions.items():
+            partition = self.partitions[vector]
+            concats = [rec for (rec, _) in getattr(partition, 'concats',
+                       [])]
+            partitions[key] = {
+                'vector': vector,
+                'score': getattr(partition, 'score', None),
+                'trees': [rec.tree.newick for rec in concats],
+                'tree_scores': [rec.tree.score for rec in concats],
+                }
+        return {
+            'names': self.get_names(),
+            'scores': [(key, p['score']) for (key, p) in
+                       partitions.items()],
+            'partitions': partitions,
+            'timings': dict(getattr(self, 'timings', {})),
+            }
+
+    @classmethod
+    def load_summary(cls, filename):
+        """
+        The summary saved beside a collection, read without loading the
+        collection. Collections saved without one are loaded (only their
+        partitions, for a store) to make it.
+        """
+
+        summary = read_summary(filename)
+        if summary is not None:
+            return summary
+        if CollectionStore.is_store(filename):
+            return cls.load(filename, components=['partitions']).summary()
+        return cls.gunzip(filename).summary()
+
+    def _timed(self, key, start):
+        """
+        Records the seconds since start as the timing of step key
+        """
+
+        self.__dict__.setdefault('timings', {})[key] = time.time() - start
+
     def put_records(
         self,
         files=None,
         record_list=None,
         file_format='fasta',
         datatype='protein',
+        n_jobs=1,
+        lazy=False,
+        record_bytes=2 ** 30,
         ):
         """
         Reads sequence files from the list generated by
         get_files and stores in self.records
+        Files are parsed whole, by n_jobs processes
+        If lazy, the records are LazyTCSeqRecs, which read their files on
+        first use and share a store of at most record_bytes of alignments
         """
 
         get_name = lambda i: i[i.rindex('/') + 1:i.rindex('.')]
 
-        if files and not record_list:
-            record_list = [TCSeqRec(f, file_format=file_format,
-                           name=get_name(f), datatype=datatype)
-                           for f in files]
+        if files and not record_list and lazy:
+            store = MemoryCache(max_bytes=record_bytes,
+                                pickle_entries=False)
+            record_list = [LazyTCSeqRec(f, file_format=file_format,
+                           name=get_name(f), datatype=datatype,
+                           store=store) for f in files]
+        elif files and not record_list:
+            record_list = []
+            for (f, parsed) in zip(files, read_alignments(files,
+                                   file_format, n_jobs)):
+                if parsed is None:
+                    if file_format == 'phylip':
+                        print 'Error reading file'
+                    record_list.append(TCSeqRec(name=get_name(f),
+                            datatype=datatype))
+                    continue
+                (headers, sequences) = parsed
+                record_list.append(TCSeqRec(name=get_name(f),
+                                   headers=headers, sequences=sequences,
+                                   datatype=datatype))
         elif not files and not record_list:
 
             print 'Can\'t load records - no records or alignment files given'
@@ -444,19 +754,66 @@ class SequenceCollection(object):
         metrics,
         tmpdir='/tmp',
         normalise=False,
+        n_jobs=1,
         ):
         """
         Pass this function a list of metrics
-        valid kwargs - invert (bool), normalise (bool)
+        valid kwargs - invert (bool), normalise (bool), n_jobs (int)
+        When both 'wrf' and 'euc' are computed from scratch they are made
+        in one pass (and given the same timing)
         """
 
         if not isinstance(metrics, list):
             metrics = [metrics]
         trees = [rec.tree for rec in self.get_records()]
-        for metric in metrics:
-            dm = DistanceMatrix(trees, tmpdir=tmpdir)
-            dm.get_distance_matrix(metric, normalise=normalise)
+        split_table = None  # shared by the split-based metrics
+        done = set()  # metrics made alongside an earlier one
+        for (position, metric) in enumerate(metrics):
+            if metric in done:
+                continue
+            start = time.time()
+            dm = self.distance_matrices.get(metric)
+            if self._can_extend(dm, trees, normalise):
+
+                # only the trees added since it was computed are new
+
+                if split_table is not None:
+                    dm.split_table = split_table
+                dm.extend(trees[len(dm.trees):], n_jobs=n_jobs)
+            else:
+                dm = DistanceMatrix(trees, tmpdir=tmpdir,
+                                    split_table=split_table)
+                companion = None
+                if metric in LENGTH_METRICS:
+                    other = LENGTH_METRICS[1 - LENGTH_METRICS.index(metric)]
+                    if other in metrics[position + 1:] \
+                        and not self._can_extend(self.distance_matrices.get(other),
+                            trees, normalise):
+                        companion = DistanceMatrix(trees, tmpdir=tmpdir)
+                dm.get_distance_matrix(metric, normalise=normalise,
+                        n_jobs=n_jobs, cache=self.distance_cache,
+                        companion=companion)
+                if companion is not None:
+                    self.distance_matrices[other] = companion
+                    self._timed(('distance_matrix', other), start)
+                    done.add(other)
+            split_table = dm.split_table
             self.distance_matrices[metric] = dm
+            self._timed(('distance_matrix', metric), start)
+
+    @staticmethod
+    def _can_extend(dm, trees, normalise):
+        """
+        True if dm holds a computed matrix for a prefix of trees, so it
+        can be brought up to date with DistanceMatrix.extend
+        """
+
+        if dm is None or dm.metric is None or dm.normalise != normalise:
+            return False
+        if len(dm.trees) > len(trees):
+            return False
+        return all(old.newick == new.newick for (old, new) in
+                   zip(dm.trees, trees))
 
     def put_partition(
         self,
@@ -505,6 +862,9 @@ class SequenceCollection(object):
         """
         metrics, linkages and nclasses are given as lists, or coerced into
         lists
+        recalculate rebuilds the linkage or decomposition once for each
+        metric and method; the other numbers of clusters reuse it, and
+        hierarchical methods cut one linkage tree for all of them
         """
 
         if not isinstance(metrics, list):
@@ -522,26 +882,38 @@ class SequenceCollection(object):
 
         for metric in metrics:
             print 'Clustering {0} data'.format(metric)
-            self.Clustering.clear_cache()
             for cluster_method in cluster_methods:
                 print ' ', cluster_method
-                for n in nclusters:
-                    key = (metric, cluster_method, n)
-                    if key in self.clusters_to_partitions:
-                        continue
-                    else:
+                start = time.time()
+                needed = [n for n in nclusters if not (metric,
+                          cluster_method, n) in self.clusters_to_partitions]
+                if needed and cluster_method in HIERARCHICAL_METHODS:
+                    if not metric in self.get_distance_matrices():
+                        self.put_distance_matrices(metric, tmpdir=tmpdir)
+                    partition_vectors = \
+                        self.Clustering.run_hierarchical_cuts(self.distance_matrices[metric],
+                            needed, cluster_method,
+                            recalculate=recalculate)
+                    for (n, partition_vector) in zip(needed,
+                            partition_vectors):
+                        self.put_partition_vector(partition_vector,
+                                (metric, cluster_method, n))
+                else:
+                    for (i, n) in enumerate(needed):
                         self.put_partition(
                             metric,
                             cluster_method,
                             n,
                             prune=prune,
                             tmpdir=tmpdir,
-                            recalculate=recalculate,
+                            recalculate=recalculate and i == 0,
                             )
+                self._timed(('partitions', metric, cluster_method),
+                            start)
 
     def concatenate_records(self):
         for p in self.partitions.values():
-            p.concatenate_records(self.keys_to_records)
+            p.concatenate_records(self.keys_to_records, self.concats)
             for concat in p.concats:
                 if not concat[0].name in self.concats:
                     self.concats[concat[0].name] = concat
@@ -624,23 +996,25 @@ class SequenceCollection(object):
         if program not in ['treecollection', 'raxml', 'phyml', 'bionj']:
             print 'unrecognised program {0}'.format(program)
             return
+        start = time.time()
         if program == 'treecollection':
-            return self._put_best_TC_trees(tmpdir=tmpdir,
-                    overwrite=overwrite,
-                    max_guide_trees=max_guide_trees)
-        rec_list = self.get_cluster_records()
-        print 'Inferring {0} cluster trees'.format(len(rec_list))
-        self.put_trees(
-            rec_list=rec_list,
-            program=program,
-            model=model,
-            ncat=ncat,
-            optimise=optimise,
-            datatype=datatype,
-            tmpdir=tmpdir,
-            overwrite=overwrite,
-            )
-        self.update_scores()
+            self._put_best_TC_trees(tmpdir=tmpdir, overwrite=overwrite,
+                                    max_guide_trees=max_guide_trees)
+        else:
+            rec_list = self.get_cluster_records()
+            print 'Inferring {0} cluster trees'.format(len(rec_list))
+            self.put_trees(
+                rec_list=rec_list,
+                program=program,
+                model=model,
+                ncat=ncat,
+                optimise=optimise,
+                datatype=datatype,
+                tmpdir=tmpdir,
+                overwrite=overwrite,
+                )
+            self.update_scores()
+        self._timed(('cluster_trees', program), start)
 
     def _put_best_TC_trees(
         self,
@@ -693,10 +1067,9 @@ class SequenceCollection(object):
     def concatenate_list_of_records(self, records=None):
         if not records:
             records = self.get_records()
-        concat = copy.deepcopy(records[0])
-        for rec in records[1:]:
-            concat += rec
-        return concat
+        if len(records) == 1:
+            return copy.deepcopy(records[0])
+        return records[0].concatenate(records)
 
     def make_randomised_copy(
         self,
@@ -946,7 +1319,7 @@ class SequenceCollection(object):
         and saves as pdf.
         """
 
-        dm = distance_matrix.matrix
+        dm = distance_matrix.dense()
         partition_vector = np.array(partition_vector)
         labels = self.get_names()
         if embedding == 'MDS':
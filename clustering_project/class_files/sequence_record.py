@@ -3,6 +3,8 @@ import_debugging = False
 if import_debugging: print 'sequence_record imports:'
 import re
 if import_debugging: print '  re (sr)'
+import copy
+if import_debugging: print '  copy (sr)'
 import os
 if import_debugging: print '  os (sr)'
 import dendropy as dpy
@@ -14,6 +16,129 @@ if import_debugging: print '  tree::Tree (sr)'
 import hashlib
 if import_debugging: print '  hashlib (sr)'
 from random import shuffle as shf
+import numpy as np
+if import_debugging: print '  numpy (sr)'
+from memory_cache import MemoryCache
+if import_debugging: print '  memory_cache::MemoryCache (sr)'
+
+
+def to_array(sequences):
+    """
+    Sequences of equal length as a taxa x sites uint8 array (sharing the
+    memory of one joined string), or None if they are of unequal lengths
+    or not byte strings
+    """
+
+    if not len(sequences) or not all(isinstance(seq, str) for seq in
+            sequences):
+        return None
+    width = len(sequences[0])
+    if any(len(seq) != width for seq in sequences):
+        return None
+    if width == 0:
+        return np.zeros((len(sequences), 0), dtype=np.uint8)
+    return np.frombuffer(''.join(sequences),
+                         dtype=np.uint8).reshape(len(sequences), width)
+
+
+class AlignmentRows(object):
+
+    """
+    Read-only list-like view of the rows of a uint8 alignment, each row
+    made into a string only when it is read
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [row.tostring() for row in self.array[index]]
+        return self.array[index].tostring()
+
+    def __iter__(self):
+        for row in self.array:
+            yield row.tostring()
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def parse_fasta(text):
+    """
+    (headers, sequences) from the contents of a fasta file, split on
+    record boundaries in bulk rather than line by line. Anything before
+    the first header is skipped, line ends and trailing whitespace are
+    stripped and commas removed from sequences. None if there is no header.
+    """
+
+    if text.startswith('>'):
+        text = text[1:]
+    else:
+        start = text.find('\n>')
+        if start == -1:
+            return None
+        text = text[start + 2:]
+    headers = []
+    sequences = []
+    for chunk in text.split('\n>'):
+        (header, _, body) = chunk.partition('\n')
+        headers.append(header.rstrip())
+        if ' ' in body or '\t' in body or '\r' in body:
+            sequence = ''.join(line.rstrip() for line in body.split('\n'))
+        else:
+            sequence = body.replace('\n', '')
+        sequences.append(sequence.replace(',', ''))
+    return (headers, sequences)
+
+
+def parse_phylip(text):
+    """
+    (headers, sequences) from the contents of a sequential or interleaved
+    phylip file, or None if it doesn't match its dimensions line
+    """
+
+    lines = text.split('\n')
+    info = lines[0].split()
+    num_taxa = int(info[0])
+    seq_length = int(info[1])
+    rows = [line.split() for line in lines[1:] if line.strip()]
+    if len(rows) < num_taxa:
+        return None
+    headers = [row[0] for row in rows[:num_taxa]]
+    pieces = [[''.join(row[1:])] for row in rows[:num_taxa]]
+
+    # later lines are interleaved blocks, a line per taxon
+
+    for (i, row) in enumerate(rows[num_taxa:]):
+        pieces[i % num_taxa].append(''.join(row))
+    sequences = [''.join(p) for p in pieces]
+    if any(len(seq) != seq_length for seq in sequences):
+        return None
+    return (headers, sequences)
+
+
+def read_alignment(filename, file_format='fasta'):
+    """
+    Reads a whole fasta or phylip file at once and parses it, returning
+    (headers, sequences) or None
+    """
+
+    with open(filename, 'rb') as openfile:
+        text = openfile.read()
+    if file_format == 'phylip':
+        return parse_phylip(text)
+    return parse_fasta(text)
+
 
 class SequenceRecord(object):
 
@@ -23,8 +148,17 @@ class SequenceRecord(object):
     sorting sequences by length and name,
     concatenating sequences when sequence names are a perfect match,
     iterating over records.
+
+    Aligned sequences are held as a taxa x sites uint8 array (the
+    alignment attribute, in the order of headers) and read back as strings
+    on demand through sequences and mapping, so that sorting, shuffling,
+    splitting and concatenating are array slicing. Unaligned sequences,
+    or any sequences when compact is False, are held as a list of strings.
+    Assigning an array or a list of strings to sequences sets either form.
     """
 
+    compact = True
+
     def get_fasta_file(
         self,
         fasta_file,
@@ -34,57 +168,10 @@ class SequenceRecord(object):
         """ FASTA format parser: turns fasta file into Alignment_record object
         """
 
-        headers = []
-        sequences = []
-        openfile = open(fasta_file, 'r')
-
-        # skip over file until first header is found
-
-        while True:
-            line = openfile.readline()
-            if not line:
-                return
-            if line[0] == '>':
-                break
-
-            # we break the loop here at the start of the first record
-
-        headers.append(line[1:].rstrip())  # chuck the first header into list
-
-        while True:
-            line = openfile.readline()
-            sequence_so_far = []  # build up sequence a line at a time in list
-            while True:
-                if not line:
-                    break
-                elif not line[0] == '>':
-                    sequence_so_far.append(line.rstrip())
-                    line = openfile.readline()
-                else:
-                    break
-            sequences.append(''.join(sequence_so_far).replace(',', ''))
-            if not line:
-                break
-            headers.append(line[1:].rstrip())
-
-        # check all sequences the same length
-
-        first_seq_length = len(sequences[0])
-        is_alignment = True
-        for seq in sequences:
-            if len(seq) != first_seq_length:
-                is_alignment = False
-                break
-            else:
-                continue
-
-        # check same number of headers as sequences
-
-        if len(headers) != len(sequences):
-            print 'Error matching all headers and sequences'
-
-        if is_alignment:
-            self.is_aligned = True
+        parsed = read_alignment(fasta_file, 'fasta')
+        if parsed is None:
+            return
+        (headers, sequences) = parsed
         self.name = name
         self.headers = headers
         self.sequences = sequences
@@ -99,57 +186,13 @@ class SequenceRecord(object):
         ):
         """ PHYLIP format parser"""
 
-        openfile = open(phylip_file, 'r')
-        info = openfile.readline().split()
-        num_taxa = int(info[0])
-        seq_length = int(info[1])
-
-        # Initialise lists to hold the headers and sequences
-
-        headers = [None] * num_taxa
-        sequences = [None] * num_taxa
-
-        i = 0  # counter monitors how many (informative) lines we've seen
-        for line in openfile:
-            line = line.rstrip()
-            if not line:
-                continue  # skip empty lines and don't increment counter
-
-            line = line.split()
-
-            # IF header is None, split line into header / sequence pair
-            # ELSE header is not None, we've already seen it
-            # so this file must be interleaved, so carry on
-            # adding sequence fragments
-
-            if not headers[i % num_taxa]:
-                header = line[0]
-                sequence_fragment = ''.join(line[1:])
-
-                headers[i % num_taxa] = header
-                sequences[i % num_taxa] = [sequence_fragment]
-            else:
-
-                sequence_fragment = ''.join(line)
-                sequences[i % num_taxa].append(sequence_fragment)
-
-            i += 1  # increment counter
-
-        sequences = [''.join(x) for x in sequences]
-
-        # checks
-
-        try:
-            assert len(headers) == len(sequences) == num_taxa
-            for sequence in sequences:
-                assert len(sequence) == seq_length
-        except AssertionError:
+        parsed = read_alignment(phylip_file, 'phylip')
+        if parsed is None:
             print 'Error reading file'
             return
-
         self.name = name
         self.datatype = datatype
-        (self.headers, self.sequences) = (headers, sequences)
+        (self.headers, self.sequences) = parsed
         self._update()
 
     def __init__(
@@ -165,7 +208,6 @@ class SequenceRecord(object):
         self.name = name
         self.headers = headers
         self.sequences = sequences
-        self.mapping = {}
         self.length = 0
         self.seqlength = 0
         self.datatype = datatype
@@ -181,15 +223,18 @@ class SequenceRecord(object):
         self._update()
 
     def _update(self):
-        """ For updating the length and mapping attributes of the object after
+        """ For updating the length attributes of the object after
             reading sequences """
 
         if self.headers and self.sequences:
-            self.mapping = dict(zip(self.headers, self.sequences))
-            self.length = len(self.mapping)
-            first_seq_length = len(self.sequences[0])
+            self.length = len(self.headers)
+            if self._alignment is not None:
+                self.is_aligned = True
+                self.seqlength = self._alignment.shape[1]
+                return
+            first_seq_length = len(self._sequences[0])
             is_aligned = True
-            for seq in self.sequences:
+            for seq in self._sequences:
                 if len(seq) != first_seq_length:
                     is_aligned = False
                     break
@@ -198,6 +243,66 @@ class SequenceRecord(object):
             self.is_aligned = is_aligned
             self.seqlength = first_seq_length
 
+    def __setstate__(self, state):
+        """
+        Records pickled before the array store held sequences and mapping
+        as attributes
+        """
+
+        state = dict(state)
+        state.pop('mapping', None)
+        sequences = state.pop('sequences', None)
+        self.__dict__.update(state)
+        if sequences is not None:
+            self.sequences = sequences
+
+    @property
+    def sequences(self):
+        if self._alignment is not None:
+            return AlignmentRows(self._alignment)
+        return self._sequences
+
+    @sequences.setter
+    def sequences(self, sequences):
+        if isinstance(sequences, AlignmentRows):
+            sequences = sequences.array
+        if isinstance(sequences, np.ndarray):
+            (self._alignment, self._sequences) = (sequences, None)
+            return
+        alignment = (to_array(sequences) if self.compact else None)
+        if alignment is None:
+            (self._alignment, self._sequences) = (None, sequences)
+        else:
+            (self._alignment, self._sequences) = (alignment, None)
+
+    @property
+    def alignment(self):
+        """
+        The taxa x sites uint8 array, or None if the sequences are held as
+        strings
+        """
+
+        return self._alignment
+
+    @property
+    def mapping(self):
+        """
+        Dict of header: sequence, made when it is read
+        """
+
+        if not (self.headers and self.sequences):
+            return {}
+        return dict(zip(self.headers, self.sequences))
+
+    def _take(self, rows):
+        """
+        The sequences at positions rows, as an array or as strings
+        """
+
+        if self._alignment is not None:
+            return self._alignment[list(rows)]
+        return tuple(self._sequences[i] for i in rows)
+
     def __iter__(self):  # Should do this with generators / yield
         return self
 
@@ -243,9 +348,10 @@ class SequenceRecord(object):
         except AssertionError:
             print 'Sequence labels do not match between alignments'
             return self
+        (self_mapping, other_mapping) = (self.mapping, other.mapping)
         d = {}
-        for k in self.mapping.keys():
-            d[k] = self.mapping[k] + other.mapping[k]
+        for k in self_mapping.keys():
+            d[k] = self_mapping[k] + other_mapping[k]
         return SequenceRecord(headers=d.keys(), sequences=d.values())
 
     def __radd__(self, other):
@@ -292,16 +398,44 @@ class SequenceRecord(object):
         """
 
         # Sort sequences by descending order of length
-        # Uses zip as its own inverse [ zip(*zip(A,B)) == (A,B) ]
 
-        (h, s) = zip(*sorted(zip(self.headers, self.sequences),
-                     key=lambda item: len(item[1].replace('-', '')),
-                     reverse=True))
+        order = self._length_order('-')
+        h = tuple(self.headers[i] for i in order)
+        s = self._take(order)
         if in_place:
             self.headers = h
             self.sequences = s
         return SequenceRecord(name=self.name, headers=h, sequences=s)
 
+    def _length_order(self, ignore):
+        """
+        Positions of the sequences by descending length, not counting the
+        characters in ignore, keeping the order of ties
+        """
+
+        if self._alignment is not None:
+            counted = np.ones(self._alignment.shape, dtype=bool)
+            for char in ignore:
+                counted &= self._alignment != ord(char)
+            return list(np.argsort(-counted.sum(axis=1), kind='mergesort'))
+        lengths = [len(seq) - sum(seq.count(char) for char in ignore)
+                   for seq in self._sequences]
+        return sorted(range(len(lengths)), key=lambda i: lengths[i],
+                      reverse=True)
+
+    def _name_order(self):
+        return sorted(range(len(self.headers)), key=lambda i: \
+                      self.name_key(self.headers[i]))
+
+    @staticmethod
+    def name_key(name):
+        """
+        Sort key treating the numbers in a name as integers
+        """
+
+        return tuple((int(num) if num else alpha) for (num, alpha) in
+                     re.findall(r'(\d+)|(\D+)', name))
+
     def sort_by_name(self, in_place=True):
         """
         Sorts sequences by name, treating numbers as integers (i.e.
@@ -311,11 +445,9 @@ class SequenceRecord(object):
         If in_place = True the sorting mutates the self object
         """
 
-        items = self.mapping.items()
-        sort_key = lambda item: tuple((int(num) if num else alpha)
-                for (num, alpha) in re.findall(r'(\d+)|(\D+)', item[0]))
-        items = sorted(items, key=sort_key)
-        (h, s) = zip(*items)
+        order = self._name_order()
+        h = tuple(self.headers[i] for i in order)
+        s = self._take(order)
         if in_place:
             self.headers = h
             self.sequences = s
@@ -334,6 +466,13 @@ class SequenceRecord(object):
             num_chunks += 1
 
         new_records = []
+        if self._alignment is not None:
+            for i in range(num_chunks):
+                new_record = type(self)(headers=self.headers,
+                        sequences=self._alignment[:, i * chunksize:(i
+                        + 1) * chunksize])
+                new_records.append(new_record)
+            return new_records
         generators = [self.linebreaker(s, chunksize) for s in
                       self.sequences]
         for _ in range(num_chunks):
@@ -430,6 +569,7 @@ class SequenceRecord(object):
         maxheader = len(max(self.headers, key=len))
         label_length = max(maxheader + 1, 10)
         if interleaved:
+            mapping = self.mapping
             seq_length = linebreaks - label_length
             num_lines = maxlen / seq_length
             if maxlen % seq_length:
@@ -440,11 +580,11 @@ class SequenceRecord(object):
                     if i == 0:
                         s.append('{0:<{1}} {2}'.format(seq_header,
                                  label_length,
-                                 (self.mapping[seq_header])[i
+                                 (mapping[seq_header])[i
                                  * seq_length:(i + 1) * seq_length]))
                     else:
                         s.append('{0} {1}'.format(' ' * label_length,
-                                 (self.mapping[seq_header])[i
+                                 (mapping[seq_header])[i
                                  * seq_length:(i + 1) * seq_length]))
                 s.append('')
         else:
@@ -490,7 +630,6 @@ class TCSeqRec(SequenceRecord):
         self.name = name
         self.headers = headers
         self.sequences = sequences
-        self.mapping = {}
         self.datatype = datatype
         self.length = 0
         self.seqlength = 0
@@ -517,30 +656,61 @@ class TCSeqRec(SequenceRecord):
         Allows Records to be added together, concatenating sequences
         """
 
-        self_set = set(self.headers)
-        other_set = set(other.headers)
         if not self.datatype == other.datatype:
             print 'Trying to add sequences of different datatypes'
             return self
-        union = self_set | other_set
-        intersection = self_set & other_set
-        only_in_self = self_set - other_set
-        only_in_other = other_set - self_set
+        return self.concatenate([self, other])
 
-        d = {}
-        for k in union:
-            if k in intersection:
-                d[k] = self.mapping[k] + other.mapping[k]
-            elif k in only_in_self:
-                d[k] = self.mapping[k] + 'N' * other.seqlength
-            elif k in only_in_other:
-                d[k] = 'N' * self.seqlength + other.mapping[k]
-        dvsum = self.dv + other.dv
-        return_object = TCSeqRec(headers=d.keys(),
-                                 sequences=d.values(),
-                                 datatype=self.datatype).sort_by_name(in_place=False)
-        return_object.dv = dvsum
-        return return_object
+    @classmethod
+    def concatenate(cls, records):
+        """
+        Concatenation of records, the same as adding them up in order but
+        linear in the total alignment size: the union of taxa is laid out
+        once, the output alignment is preallocated (filled with 'N' for
+        taxa missing from a record) and each record's columns are copied
+        into place. The dv lists are joined in the same order.
+        Records of a different datatype from the first are skipped, as
+        by __add__.
+        """
+
+        records = list(records)
+        datatype = records[0].datatype
+        for rec in records[1:]:
+            if rec.datatype != datatype:
+                print 'Trying to add sequences of different datatypes'
+        records = [rec for rec in records if rec.datatype == datatype]
+
+        headers = sorted(set(h for rec in records for h in rec.headers),
+                         key=cls.name_key)
+        rows = dict((h, i) for (i, h) in enumerate(headers))
+        dv = [x for rec in records for x in rec.dv]
+        if not all(rec.alignment is not None or not rec.headers for rec in
+                   records):
+
+            # ragged records don't fit a preallocated block: join each
+            # taxon's pieces instead
+
+            pieces = [[] for _ in headers]
+            for rec in records:
+                (mapping, padding) = (rec.mapping, 'N' * rec.seqlength)
+                for h in headers:
+                    pieces[rows[h]].append(mapping.get(h, padding))
+            sequences = tuple(''.join(p) for p in pieces)
+        else:
+            widths = [rec.seqlength for rec in records]
+            starts = np.concatenate(([0], np.cumsum(widths)))
+            alignment = np.empty((len(headers), starts[-1]), dtype=np.uint8)
+            alignment.fill(ord('N'))
+            for (rec, start, width) in zip(records, starts, widths):
+                if width == 0:
+                    continue
+                alignment[[rows[h] for h in rec.headers], start:start
+                          + width] = rec.alignment
+            sequences = alignment
+        concat = TCSeqRec(headers=tuple(headers), sequences=sequences,
+                          datatype=datatype)
+        concat.dv = dv
+        return concat
 
     def sort_by_length(self, in_place=True):
         """
@@ -549,9 +719,9 @@ class TCSeqRec(SequenceRecord):
         Gaps and 'N' characters are not counted
         """
 
-        (h, s) = zip(*sorted(zip(self.headers, self.sequences),
-                     key=lambda item: len(item[1].replace('-', ''
-                     ).replace('N', '')), reverse=True))
+        order = self._length_order('-N')
+        h = tuple(self.headers[i] for i in order)
+        s = self._take(order)
         if in_place:
             self.headers = h
             self.sequences = s
@@ -568,13 +738,11 @@ class TCSeqRec(SequenceRecord):
         If in_place = True the sorting mutates the self object
         """
 
-        items = self.mapping.items()
-        if items == []:
+        if not (self.headers and self.sequences):
             return self
-        sort_key = lambda item: tuple((int(num) if num else alpha)
-                for (num, alpha) in re.findall(r'(\d+)|(\D+)', item[0]))
-        items = sorted(items, key=sort_key)
-        (h, s) = zip(*items)
+        order = self._name_order()
+        h = tuple(self.headers[i] for i in order)
+        s = self._take(order)
         if in_place:
             self.headers = h
             self.sequences = s
@@ -594,7 +762,11 @@ class TCSeqRec(SequenceRecord):
             h = h.replace(' ', '_')
             l.append(h)
         self.headers = l
-        self.sequences = [seq.upper() for seq in self.sequences]
+        if self._alignment is not None:
+            self.sequences = np.frombuffer(self._alignment.tostring().upper(),
+                    dtype=np.uint8).reshape(self._alignment.shape)
+        else:
+            self.sequences = [seq.upper() for seq in self.sequences]
         self._update()
 
     def hashname(self):
@@ -895,24 +1067,37 @@ class TCSeqRec(SequenceRecord):
         """
         Modifies in-place
         """
-        columns = self._pivot(self.sequences)
-        shf(columns)
-        self.sequences = self._pivot(columns)
+        if self._alignment is not None:
+            order = range(self.seqlength)
+            shf(order)
+            self.sequences = self._alignment[:, order]
+        else:
+            columns = self._pivot(self.sequences)
+            shf(columns)
+            self.sequences = self._pivot(columns)
         self._update()
 
     def split_by_lengths(self, lengths, names=None):
         assert sum(lengths) == self.seqlength
-        columns = self._pivot(self.sequences)
-        newcols = []
-        for l in lengths:
-            newcols.append(columns[:l])
-            columns = columns[l:]
         newrecs = []
-        for col in newcols:
-            newseqs = self._pivot(col)
-            newrec = TCSeqRec(headers=self.headers,
-                              sequences=newseqs, datatype=self.datatype)
-            newrecs.append(newrec)
+        if self._alignment is not None:
+            start = 0
+            for l in lengths:
+                newrecs.append(TCSeqRec(headers=self.headers,
+                               sequences=self._alignment[:, start:start
+                               + l], datatype=self.datatype))
+                start += l
+        else:
+            columns = self._pivot(self.sequences)
+            newcols = []
+            for l in lengths:
+                newcols.append(columns[:l])
+                columns = columns[l:]
+            for col in newcols:
+                newseqs = self._pivot(col)
+                newrec = TCSeqRec(headers=self.headers,
+                                  sequences=newseqs, datatype=self.datatype)
+                newrecs.append(newrec)
         if names:
             for i, newrec in enumerate(newrecs):            
                 newrec.name = names[i]
@@ -920,3 +1105,105 @@ class TCSeqRec(SequenceRecord):
             for i, newrec in enumerate(newrecs):            
                 newrec.name = 'record_{0}'.format(i+1)
         return newrecs
+
+
+class LazyTCSeqRec(TCSeqRec):
+
+    """
+    TCSeqRec that is a handle to its alignment file. The headers and
+    sequences are read (and sanitised) on first use and held in a shared
+    store, a MemoryCache keyed by file name, which drops the least
+    recently used alignments when they exceed its max_bytes; they are read
+    again when next needed. The taxa count, sequence length and
+    alignment flag are kept once known.
+    A store passed in is pickled with the record, empty but with its
+    max_bytes, and records pickled together still share one; a record
+    sent alone to a worker process gets a store of its own. Deep copies
+    (e.g. the singleton clusters of Partition.concatenate_records) share
+    the original's store, so its max_bytes still bounds them all.
+    Assigning headers or sequences (e.g. sorting or shuffling in place)
+    keeps the new values on the record itself, so they are not dropped.
+    """
+
+    store = MemoryCache(pickle_entries=False)
+
+    # attributes read from the file: the alignment, and its metadata
+
+    data = ('headers', '_alignment', '_sequences')
+    metadata = ('length', 'seqlength', 'is_aligned')
+
+    def __init__(
+        self,
+        infile,
+        file_format='fasta',
+        name=None,
+        datatype=None,
+        store=None,
+        ):
+
+        self.infile = infile
+        self.file_format = file_format
+        self.name = name
+        self.datatype = datatype
+        if store is not None:
+            self.store = store
+        self.TCfiles = {}
+        self.dv = []
+        self.tree = Tree()
+        self.index = -1
+
+    def __getattr__(self, name):
+        if name in LazyTCSeqRec.data or name in LazyTCSeqRec.metadata:
+            value = self.load()[name]
+            if name in LazyTCSeqRec.metadata:
+                self.__dict__[name] = value
+            return value
+        raise AttributeError(name)
+
+    def __deepcopy__(self, memo):
+        memo[id(self.store)] = self.store
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        new.__dict__.update(copy.deepcopy(self.__dict__, memo))
+        return new
+
+    @property
+    def is_loaded(self):
+        return self.infile in self.store
+
+    def load(self):
+        """
+        The alignment and metadata from the store, reading and sanitising
+        the file if they aren't there
+        """
+
+        loaded = self.store.get(self.infile)
+        if loaded is None:
+            rec = TCSeqRec(self.infile, file_format=self.file_format,
+                           name=self.name, datatype=self.datatype)
+            rec.sanitise()
+            loaded = dict((name, getattr(rec, name)) for name in
+                          LazyTCSeqRec.data + LazyTCSeqRec.metadata)
+            self.store.put(self.infile, loaded)
+        return loaded
+
+    def eager(self):
+        """
+        TCSeqRec holding this record's alignment, dv and tree
+        """
+
+        return TCSeqRec(name=self.name, headers=self.headers,
+                        sequences=self.sequences, datatype=self.datatype,
+                        dv=self.dv, tree=self.tree)
+
+    def make_chunks(self, chunksize):
+        return self.eager().make_chunks(chunksize)
+
+    def release(self):
+        """
+        Drops the stored alignment, and any assigned in place
+        """
+
+        self.store.discard(self.infile)
+        for name in LazyTCSeqRec.data:
+            self.__dict__.pop(name, None)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+import copy
+import numpy as np
+from scipy import sparse
+import dendropy as dpy
+from dpy_utils import get_dendropy_trees
+
+
+def _changed_by_encoding(tree):
+    """
+    dendropy's encode_splits deroots unrooted trees with a bifurcating
+    seed node, and removes nodes with a single child
+    """
+
+    if not tree.is_rooted and len(tree.seed_node.child_nodes()) == 2:
+        return True
+    return any(len(node.child_nodes()) == 1 for node in
+               tree.preorder_node_iter())
+
+
+class SplitTable(object):
+
+    """
+    Encodes the bipartitions of a list of trees once, as the columns of
+    a sparse (tree x split) incidence matrix. Each distinct split bitmask
+    found in the collection gets a column; each tree is a row.
+
+    Split bitmasks are taken from dendropy's own encoding (tree.split_edges),
+    so rooted / unrooted normalisation is exactly dendropy's. All-pairs
+    comparisons become sparse matrix products instead of an O(n^2) python
+    loop.
+
+    Trees are grouped by (rootedness, leaf set). Within a group splits are
+    compared directly. Between groups, dendropy looks each split up in the
+    other tree's split dictionary, which normalises it against that tree's
+    leaf set first; this is reproduced by projecting the split columns of
+    one group onto the leaf set of the other.
+    """
+
+    def __init__(self, trees=None, dpy_trees=None):
+
+        self.labels = []  # taxon labels, in bit order
+        self.newicks = []  # newick string of each tree, if known
+        self.split_index = {}  # split bitmask -> column number
+        self.split_keys = []  # column number -> split bitmask
+        self.tree_splits = []  # column numbers of each tree's splits
+        self.tree_lengths = []  # branch lengths of each tree's splits
+        self.groups = []  # (rooted, leaf mask) for each group of trees
+        self.tree_groups = []  # group number of each tree
+        self.incidence = None
+        self.lengths = None
+        self._projections = {}
+        if trees or dpy_trees:
+            self.add_trees(trees, dpy_trees)
+
+    def __len__(self):
+        return len(self.tree_splits)
+
+    def __str__(self):
+        return 'SplitTable: {0} trees, {1} distinct splits'.format(len(self),
+                len(self.split_index))
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d['_projections'] = {}
+        return d
+
+    def get_taxon_set(self):
+        """
+        Rebuilds a TaxonSet with the same bit order as the trees already
+        in the table, so new trees are encoded consistently
+        """
+
+        return dpy.TaxonSet(self.labels)
+
+    def add_trees(self, trees=None, dpy_trees=None):
+        """
+        Encodes the splits of each tree and appends a row per tree.
+        Either Tree objects or dendropy trees sharing the table's
+        TaxonSet can be given. The trees' cached parses are used where
+        possible (see dpy_utils.get_dendropy_trees); any that encoding
+        would modify are encoded as copies.
+        """
+
+        if dpy_trees is None:
+            dpy_trees = get_dendropy_trees(trees, self.labels)
+        self.newicks.extend([tree.newick for tree in trees] if trees
+                            else [None] * len(dpy_trees))
+        for tree in dpy_trees:
+            if not hasattr(tree, 'split_edges'):
+                if _changed_by_encoding(tree):
+                    tree = copy.deepcopy(tree)
+                tree.encode_splits()
+            self._add_row(tree)
+        if dpy_trees:
+            self.labels = [taxon.label for taxon in dpy_trees[0].taxon_set]
+        self.incidence = self._build_incidence()
+        self.lengths = self._build_incidence(self.tree_lengths)
+        self._projections = {}
+
+    def _add_row(self, tree):
+        split_index = self.split_index
+        columns = []
+        lengths = []
+        for (split, edge) in tree.split_edges.iteritems():
+            if not split in split_index:
+                split_index[split] = len(self.split_keys)
+                self.split_keys.append(split)
+            columns.append(split_index[split])
+            lengths.append(edge.length or 0.0)
+        group = (bool(tree.is_rooted), tree.seed_node.edge.split_bitmask)
+        if not group in self.groups:
+            self.groups.append(group)
+        self.tree_groups.append(self.groups.index(group))
+        self.tree_splits.append(np.array(columns, dtype=np.int))
+        self.tree_lengths.append(np.array(lengths, dtype=np.float))
+
+    def _build_incidence(self, values=None):
+        """
+        Tree x split sparse matrix holding 1 for each split of each tree,
+        or the corresponding entry of `values` (e.g. branch lengths).
+        Entries are stored even when the value is zero, so the incidence
+        and length matrices always share the same structure.
+        """
+
+        ntrees = len(self.tree_splits)
+        sizes = [len(row) for row in self.tree_splits]
+        indptr = np.concatenate(([0], np.cumsum(sizes))).astype(np.int)
+        if ntrees > 0:
+            indices = np.concatenate(self.tree_splits)
+        else:
+            indices = np.array([], dtype=np.int)
+        if values is None:
+            data = np.ones(len(indices), dtype=np.int32)
+        elif ntrees > 0:
+            data = np.concatenate(values)
+        else:
+            data = np.array([], dtype=np.float)
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=(ntrees, len(self.split_keys)))
+
+    def num_splits(self):
+        return np.array([len(row) for row in self.tree_splits],
+                        dtype=np.float)
+
+    def _projection(self, group):
+        """
+        Column map sending every split to the column of its normalised
+        form on the leaf set of `group` (-1 if no tree has that split),
+        or None when lookups in that group need no normalisation
+        """
+
+        (rooted, mask) = self.groups[group]
+        if rooted:
+            return None
+        if not group in self._projections:
+            lowest_bit = mask & -mask
+            get = self.split_index.get
+            self._projections[group] = np.array([get(((~key if key
+                    & lowest_bit else key) & mask), -1) for key in
+                    self.split_keys], dtype=np.int)
+        return self._projections[group]
+
+    def _project(self, matrix, group):
+        colmap = self._projection(group)
+        if colmap is None:
+            return matrix
+        matrix = matrix.tocoo()
+        cols = colmap[matrix.col]
+        keep = cols >= 0
+        return sparse.csr_matrix((matrix.data[keep], (matrix.row[keep],
+                                 cols[keep])), shape=matrix.shape)
+
+    def _indices(self, rows):
+        if rows is None:
+            return np.arange(len(self))
+        return np.asarray(rows, dtype=np.int)
+
+    def _group_blocks(self, rows, cols):
+        """
+        Yields (row positions, col positions, row group, col group) for
+        every pair of groups occurring in the block
+        """
+
+        tree_groups = np.array(self.tree_groups, dtype=np.int)
+        row_groups = tree_groups[rows]
+        col_groups = tree_groups[cols]
+        for g in np.unique(row_groups):
+            for h in np.unique(col_groups):
+                yield (np.where(row_groups == g)[0], np.where(col_groups
+                       == h)[0], g, h)
+
+    def rf_block(self, rows=None, cols=None):
+        """
+        Symmetric difference between every tree in `rows` and every tree
+        in `cols` (lists of tree indices; None means all trees):
+            rf(i, j) = |S_i| + |S_j| - |S_i in S_j| - |S_j in S_i|
+        where the membership counts for each group pair come from one
+        sparse product of (projected) incidence matrices
+        """
+
+        rows = self._indices(rows)
+        cols = self._indices(cols)
+        sizes = self.num_splits()
+        result = sizes[rows][:, np.newaxis] + sizes[cols][np.newaxis, :]
+        for (ri, ci, g, h) in self._group_blocks(rows, cols):
+            R = self.incidence[rows[ri]]
+            C = self.incidence[cols[ci]]
+            if g == h:
+                found = 2 * R.dot(C.T).toarray()
+            else:
+                found = self._project(R, h).dot(C.T).toarray() \
+                    + self._project(C, g).dot(R.T).toarray().T
+            result[np.ix_(ri, ci)] -= found
+        return result
+
+    def rf_matrix(self):
+        return self.rf_block()
+
+    def _length_diffs(self, i, j):
+        """
+        Pairs of branch lengths of tree i and tree j for each split, as
+        dendropy.treecalc.get_length_diffs pairs them when the two trees
+        belong to different groups: each split of i is matched (and
+        consumed) by an identical split of j, then each remaining split
+        of j is looked up in i after normalising it on i's leaf set.
+        """
+
+        proj_i = self._projection(self.tree_groups[i])
+        lengths_i = dict(zip(self.tree_splits[i], self.tree_lengths[i]))
+        remaining_j = dict(zip(self.tree_splits[j], self.tree_lengths[j]))
+        diffs = []
+        for (col, length) in zip(self.tree_splits[i],
+                                 self.tree_lengths[i]):
+            diffs.append((length, remaining_j.pop(col, 0.0)))
+        for (col, length) in remaining_j.iteritems():
+            target = (col if proj_i is None else proj_i[col])
+            diffs.append((lengths_i.get(target, 0.0), length))
+        return np.array(diffs, dtype=np.float).reshape(-1, 2)
+
+    def length_distance_blocks(self, rows=None, cols=None):
+        """
+        Weighted Robinson-Foulds (L1) and Euclidean branch score (L2)
+        distances between every tree in `rows` and every tree in `cols`,
+        computed together from the shared branch length table.
+
+        For each row tree i, with a_i(s) its length for split s (0 if absent),
+        the sum over the union of splits is split into
+            sum over S_j of f(b_j(s) - a_i(s))      (all column trees at once)
+          + sum over S_i not in S_j of f(a_i(s))     (masked by the incidence)
+        Both terms are sums of the exact per-split values, so identical trees
+        are at distance exactly 0.
+        Returns (wrf_block, euc_block).
+        """
+
+        rows = self._indices(rows)
+        cols = self._indices(cols)
+        l1 = np.zeros((len(rows), len(cols)))
+        l2 = np.zeros((len(rows), len(cols)))
+        lookup = np.zeros(len(self.split_keys))
+        for (ri, ci, g, h) in self._group_blocks(rows, cols):
+            if g == h:
+                C = self.lengths[cols[ci]]
+                present = self.incidence[cols[ci]].tocsc()
+                entry_rows = np.repeat(np.arange(len(ci)),
+                        np.diff(C.indptr))
+                for r in ri:
+                    (splits_i, lengths_i) = (self.tree_splits[rows[r]],
+                            self.tree_lengths[rows[r]])
+                    lookup[splits_i] = lengths_i
+                    diff = C.data - lookup[C.indices]
+                    lookup[splits_i] = 0.0
+                    absent = 1 - present[:, splits_i].toarray()
+                    l1[r, ci] = np.bincount(entry_rows,
+                            weights=np.abs(diff), minlength=len(ci)) \
+                        + absent.dot(np.abs(lengths_i))
+                    l2[r, ci] = np.bincount(entry_rows, weights=diff
+                            ** 2, minlength=len(ci)) \
+                        + absent.dot(lengths_i ** 2)
+            else:
+                for r in ri:
+                    for c in ci:
+                        # dendropy isn't symmetric here: keep the lower
+                        # index first, as the upper triangle would
+                        (i, j) = sorted((rows[r], cols[c]))
+                        diff = np.diff(self._length_diffs(i, j), axis=1)
+                        l1[r, c] = np.abs(diff).sum()
+                        l2[r, c] = (diff ** 2).sum()
+        return (l1, np.sqrt(l2))
+
+    def wrf_matrix(self):
+        return self.length_distance_blocks()[0]
+
+    def euc_matrix(self):
+        return self.length_distance_blocks()[1]
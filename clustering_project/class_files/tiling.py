@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from condensed import CondensedMatrix
+
+# Set in the parent before the pool is created, so forked workers inherit
+# the tile function (and whatever parsed trees it holds) without pickling
+
+_tile_function = None
+_outputs = None
+
+# Serial runs still go tile by tile, each about this many pairs, so no
+# dense size x size block is made
+
+TILE_PAIRS = 2 ** 22
+
+
+def balanced_tiles(size, ntiles):
+    """
+    Splits the rows of the upper triangle of a size x size matrix into
+    contiguous (start, stop) tiles holding roughly equal numbers of pairs
+    """
+
+    if size < 2:
+        return [(0, size)]
+    pairs = np.cumsum(np.arange(size - 1, -1, -1))
+    bounds = np.searchsorted(pairs, np.linspace(0, pairs[-1], ntiles
+                             + 1)[1:-1])
+    bounds = np.unique(np.concatenate(([0], bounds, [size])))
+    return [(lo, hi) for (lo, hi) in zip(bounds[:-1], bounds[1:])
+            if hi > lo]
+
+
+def _init_worker(outputs, shape):
+    global _outputs
+    _outputs = [(output if isinstance(output, CondensedMatrix)
+                else np.frombuffer(output).reshape(shape)) for output in
+                outputs]
+
+
+def _tile_blocks(rows, cols):
+    """
+    The tile function's blocks for rows and cols, one per output
+    """
+
+    blocks = _tile_function(rows, cols)
+    return ([blocks] if len(_outputs) == 1 else blocks)
+
+
+def _run_tile(tile):
+    """
+    Computes rows [start, stop) against columns [start, size) and writes
+    the strict upper triangle part, and its mirror, into the outputs
+    """
+
+    (start, stop) = tile
+    size = len(_outputs[0])
+    blocks = _tile_blocks(np.arange(start, stop), np.arange(start, size))
+    for (output, block) in zip(_outputs, blocks):
+        for (r, i) in enumerate(range(start, stop)):
+            row = block[r, i - start + 1:]
+            if isinstance(output, CondensedMatrix):
+                output.segment(i)[:] = row
+            else:
+                output[i, i + 1:] = row
+                output[i + 1:, i] = row
+    return stop - start
+
+
+def _run_row_tile(tile):
+    (rows, cols) = tile
+    for (output, block) in zip(_outputs, _tile_blocks(*tile)):
+        output[rows[0]:rows[-1] + 1] = block
+    return len(rows)
+
+
+def tiled_block(
+    rows,
+    cols,
+    tile_function,
+    n_jobs=1,
+    tiles_per_job=4,
+    nout=1,
+    ):
+    """
+    len(rows) x len(cols) array from tile_function(rows, cols), computed
+    as for tiled_matrix but over tiles of rows of the whole rectangle
+    (e.g. the new rows when trees are added to a matrix). With nout > 1,
+    tile_function returns nout blocks and a tuple of arrays is returned.
+    """
+
+    global _tile_function
+    (rows, cols) = (np.asarray(rows), np.asarray(cols))
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(rows))
+    shape = (len(rows), len(cols))
+    outputs = [RawArray('d', shape[0] * shape[1]) for _ in range(nout)]
+    _tile_function = lambda tile_rows, tile_cols: \
+        tile_function(rows[tile_rows], tile_cols)
+    tiles = [(positions, cols) for positions in
+             np.array_split(np.arange(len(rows)), max(tiles_per_job
+             * n_jobs, 1)) if len(positions) > 0]
+    try:
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                    initargs=(outputs, shape))
+            pool.map(_run_row_tile, tiles, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            _init_worker(outputs, shape)
+            for tile in tiles:
+                _run_row_tile(tile)
+    finally:
+        _tile_function = None
+    results = [np.frombuffer(output).reshape(shape) for output in
+               outputs]
+    return (results[0] if nout == 1 else tuple(results))
+
+
+def tiled_matrix(
+    size,
+    tile_function,
+    n_jobs=1,
+    tiles_per_job=4,
+    out=None,
+    nout=1,
+    ):
+    """
+    Symmetric size x size matrix with a zero diagonal, from
+    tile_function(rows, cols) -> len(rows) x len(cols) array, of which only
+    entries with col > row are used.
+    With n_jobs > 1 the upper triangle is split into balanced row tiles,
+    computed by a pool of forked workers writing straight into a shared
+    memory output array. n_jobs < 1 uses every core.
+    If out is given (a CondensedMatrix, in shared memory or a memmap file
+    when n_jobs > 1) the values are written there instead, and it is
+    returned.
+    With nout > 1, tile_function returns nout blocks (e.g. two metrics
+    computed together), out is a list of nout CondensedMatrix if given,
+    and a tuple of nout matrices is returned.
+    """
+
+    global _tile_function
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, max(size - 1, 1))
+    if out is None:
+        outputs = [RawArray('d', size * size) for _ in range(nout)]
+    else:
+        outputs = (list(out) if nout > 1 else [out])
+    _tile_function = tile_function
+    try:
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                    initargs=(outputs, (size, size)))
+            pool.map(_run_tile, balanced_tiles(size, tiles_per_job
+                     * n_jobs), chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            _init_worker(outputs, (size, size))
+            for tile in balanced_tiles(size, max(tiles_per_job, size
+                    * (size - 1) // (2 * TILE_PAIRS) + 1)):
+                _run_tile(tile)
+    finally:
+        _tile_function = None
+    if out is None:
+        outputs = [np.frombuffer(output).reshape(size, size) for output in
+                   outputs]
+    return (outputs[0] if nout == 1 else tuple(outputs))
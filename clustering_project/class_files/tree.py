@@ -40,6 +40,8 @@ class Tree(object):
     score_regex = re.compile('(?<=Log-likelihood: ).+')
     name_regex = \
         re.compile('([A-Za-z0-9\-_]+).([A-Za-z0-9\-_]+)(?=_phyml_)')
+    comment_regex = re.compile("\[[^\]]*\]|'[^']*'")
+    structure_regex = re.compile('[(),;]')
 
     def __init__(
         self,
@@ -56,7 +58,22 @@ class Tree(object):
         self.program = program
         self.name = name
         self.output = output
-        self.rooted = self.check_rooted(self.newick)
+        self.rooted = rooted
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d['_dendropy_tree'] = None
+        return d
+
+    def __setstate__(self, state):
+
+        # trees pickled before newick and rooted became properties
+
+        if 'newick' in state:
+            state['_newick'] = state.pop('newick')
+            state['_rooted'] = state.pop('rooted', None)
+        state['_dendropy_tree'] = None
+        self.__dict__.update(state)
 
     def __str__(self):
         """
@@ -90,6 +107,57 @@ class Tree(object):
             return False
         return equal
 
+    @property
+    def newick(self):
+        return self._newick
+
+    @newick.setter
+    def newick(self, newick):
+        self._newick = newick
+        self._rooted = None
+        self._dendropy_tree = None
+
+    @property
+    def rooted(self):
+        """
+        True if the root has two children; worked out from the newick string
+        when first needed, unless given
+        """
+
+        if self._rooted is None:
+            self._rooted = self.check_rooted(self.newick)
+        return self._rooted
+
+    @rooted.setter
+    def rooted(self, rooted):
+        self._rooted = rooted
+
+    @property
+    def cached_taxon_set(self):
+        """
+        TaxonSet of the cached dendropy tree, or None if there isn't one
+        """
+
+        if self._dendropy_tree is None:
+            return None
+        return self._dendropy_tree.taxon_set
+
+    def get_dendropy_tree(self, taxon_set=None):
+        """
+        The newick parsed by dendropy, kept until the newick changes. It is
+        only parsed again if a different taxon_set is asked for (None
+        accepts the cached tree's). Every caller gets the same object, so
+        it must not be modified: parse or deepcopy a private tree for that.
+        """
+
+        if self._dendropy_tree is None or taxon_set is not None \
+            and self._dendropy_tree.taxon_set is not taxon_set:
+            if taxon_set is None:
+                taxon_set = dpy.TaxonSet()
+            self._dendropy_tree = dpy.Tree.get_from_string(self.newick,
+                    'newick', taxon_set=taxon_set)
+        return self._dendropy_tree
+
     def pam2sps(self, multiplier=0.01):
         """
         Scales branch lengths by an order of `multiplier`.
@@ -188,13 +256,30 @@ class Tree(object):
 
     @classmethod
     def check_rooted(cls, newick):
+        """
+        True if the root has two children, found by counting the commas at
+        the top level of the newick string (outside comments and quoted
+        labels) instead of parsing the whole tree
+        """
+
         if newick is None:
             return None
         if newick == '':
             return None
-        t = dpy.Tree()
-        t.read_from_string(newick, 'newick')
-        root_degree = len(t.seed_node.child_nodes())
+        depth = 0
+        root_degree = 0
+        for char in cls.structure_regex.findall(cls.comment_regex.sub('',
+                newick)):
+            if char == '(':
+                depth += 1
+                if depth == 1:
+                    root_degree = 1
+            elif char == ')':
+                depth -= 1
+            elif char == ',' and depth == 1:
+                root_degree += 1
+            elif char == ';' and depth == 0:
+                break
         return root_degree == 2
 
     @classmethod
@@ -247,7 +332,6 @@ class Tree(object):
         self.output = stats
         self.score = score
         self.name = name
-        self.rooted = self.check_rooted(newick)
 
     @classmethod
     def new_tree_from_phyml_results(
@@ -1009,4 +1093,4 @@ class Tree(object):
         if tree.is_rooted:
             newick = '[&R] ' + newick
 
-        return Tree(newick=newick, rooted=tree.is_rooted)
+        return Tree(newick=newick)
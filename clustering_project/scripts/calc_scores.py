@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from sequence_collection import SequenceCollection
+from distance_cache import DistanceCache
 from partition import Partition
 import os
 import sys
@@ -42,6 +43,10 @@ except:
     TMPDIR = '/tmp'
 HELPER = os.environ['DARWINHELPER']
 GTP_PATH = os.environ['GTP_PATH']
+try:
+    CACHE = DistanceCache(os.environ['DISTANCE_CACHE'])
+except KeyError:
+    CACHE = None
 dists = ['rf', 'euc', 'geo']
 methods = [
     'single',
@@ -66,6 +71,7 @@ sc = SequenceCollection(
     datatype=datatype,
     parallel_load=False,
     get_distances=False,
+    distance_cache=CACHE,
     )
 
 sc.put_trees(program='bionj', model='GTR', tmpdir=TMPDIR, ncat=4,
@@ -79,6 +85,9 @@ sc.put_partitions('rf', methods, nclasses, recalculate=True)
 sc.put_partitions('euc', methods, nclasses, recalculate=True)
 sc.put_partitions('geo', methods, nclasses, recalculate=True)
 
+if CACHE is not None:
+    print CACHE
+
 if os.path.isfile('{0}/treedistances.txt'.format(indir)):
     calc_varinf = True
     with open('{0}/treedistances.txt'.format(indir)) as truthf:
@@ -94,14 +103,18 @@ sc.put_cluster_trees(program='bionj', datatype='nt', model='GTR',
 
 d = sc.clusters_to_partitions
 
+if calc_varinf:
+    keys = sorted(d)
+    varinfs = dict(zip(keys, Partition.compare_many(true_clustering,
+                   [d[k] for k in keys])))
+
 print 'writing to', outf
 with open(outf, 'w') as writer:
     for k in sorted(d):
         partition_object = sc.partitions[d[k]]
         score = partition_object.score
         if calc_varinf:
-            varinf = partition_object.variation_of_information(d[k],
-                    true_clustering)
+            varinf = float(varinfs[k])
         else:
             varinf = ''
 
@@ -141,6 +141,11 @@ sc.put_cluster_trees(program=treeprog, tmpdir=TMPDIR, max_guide_trees=nguide)
 
 d = sc.clusters_to_partitions
 true_score = sc.partitions[sc.clusters_to_partitions[('true','na')]].score
+if calc_varinf:
+    keys = [k for k in sorted(d) if k[0] != 'true']
+    varinfs = dict(zip(keys, Partition.compare_many(true_clustering,
+                   [d[k] for k in keys])))
+
 print 'writing to', outf
 with open(outf, 'w') as writer:
     for k in sorted(d):
@@ -148,8 +153,7 @@ with open(outf, 'w') as writer:
         partition_object = sc.partitions[d[k]]
         score = partition_object.score
         if calc_varinf:
-            varinf = partition_object.variation_of_information(d[k],
-                    true_clustering)
+            varinf = float(varinfs[k])
         else:
             varinf = ''
         
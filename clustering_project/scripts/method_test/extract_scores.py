@@ -40,10 +40,16 @@ header = args.header
 
 filecheck_and_quit(input_file)
 
-from sequence_collection import SequenceCollection
+from collection_store import read_summary
 
-sc = SequenceCollection.gunzip(input_file)
-scores = sorted(sc.get_scores(), key=lambda x: x[0])
+# the summary saved beside the collection has the scores; only if it is
+# missing is the collection itself loaded
+
+summary = read_summary(input_file)
+if summary is None:
+    from sequence_collection import SequenceCollection
+    summary = SequenceCollection.load_summary(input_file)
+scores = sorted(summary['scores'], key=lambda x: x[0])
 
 with open(output_file, 'w') as outf:
     if header:
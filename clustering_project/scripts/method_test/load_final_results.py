@@ -32,10 +32,14 @@ filecheck_and_quit(input_file)
 directorycheck_and_quit(phyml_dir)
 
 from sequence_collection import SequenceCollection
+from collection_store import CollectionStore
 
 sc = SequenceCollection.gunzip(input_file)
 cluster_records = sc.get_cluster_records()
 sc.load_phyml_results(phyml_dir, records=cluster_records,
                       use_hashname=True)
 sc.update_scores()
-sc.gzip(input_file)
+if CollectionStore.is_store(input_file):
+    sc.save(input_file, components=['partitions'])  # appends the changes
+else:
+    sc.gzip(input_file)
@@ -133,9 +133,9 @@ if score:
        sc.put_cluster_trees(program='bionj', optimise='r', ncat=4 )
 
 try:
-    sc.gzip(output)
+    sc.save(output)
 except:
-    print 'Couldn\'t save pickle'
+    print 'Couldn\'t save collection'
     raise
     sys.exit()
 
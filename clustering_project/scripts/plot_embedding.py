@@ -104,7 +104,7 @@ print 'distance matrix plot complete'
 
 # Plot the embedding
 
-coords = get_coords(dm.matrix)
+coords = get_coords(dm.dense())
 min_Z = min([z for x,y,z in coords])
 p = np.array(p.partition_vector)
 p1 = np.where(p == 1)
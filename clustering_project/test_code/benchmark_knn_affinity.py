@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Times DistanceMatrix.get_knn, get_affinity_matrix and add_noise on random
+distance matrices of 1000, 5000 and 10000 points, against the per-element
+loops they replaced (only run up to LOOP_LIMIT points, as they take
+minutes beyond that), and checks both give the same output.
+
+usage: benchmark_knn_affinity.py [sizes...]
+"""
+
+import sys
+import time
+import numpy as np
+from distance_matrix import DistanceMatrix
+
+LOOP_LIMIT = 5000
+K = 7
+
+
+def loop_knn(M, k):
+    shape = M.shape
+    kneighbour_matrix = np.zeros(shape)
+    max_dists = {}
+    for i in range(shape[0]):
+        row = M[i]
+        sorted_dists = row.argsort()
+        for j in sorted_dists[:k]:
+            kneighbour_matrix[i, j] = kneighbour_matrix[j, i] = 1
+            max_dists[i] = row[sorted_dists[k - 1]]
+    return (kneighbour_matrix, max_dists)
+
+
+def loop_affinity(M, kneighbour_matrix, max_dists):
+    shape = M.shape
+    affinity_matrix = np.zeros(shape)
+    for i in range(shape[0]):
+        for j in range(shape[1]):
+            if kneighbour_matrix[i, j] == 1:
+                affinity_matrix[i, j] = np.exp(-M[i, j] ** 2
+                        / (max_dists[i] * max_dists[j]))
+    return affinity_matrix
+
+
+def loop_noise(dm):
+    size = len(dm)
+    new = np.zeros((size, size))
+    r = range(size)
+    for i in r:
+        for j in r[i + 1:]:
+            eps = np.random.normal(0, 0.001)
+            if dm[i, j] + eps > 0:
+                new[i, j] = new[j, i] = dm[i, j] + eps
+            else:
+                new[i, j] = new[j, i] = dm[i, j] - eps
+    return new
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return (result, time.time() - start)
+
+
+def random_matrix(size):
+    points = np.random.rand(size, 5)
+    sq = (points ** 2).sum(axis=1)
+    d = sq[:, np.newaxis] + sq[np.newaxis, :] - 2 * points.dot(points.T)
+    d = np.sqrt(np.maximum(d, 0))
+    np.fill_diagonal(d, 0)
+    return d
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 5000, 10000]
+    print '{0:>6} {1:>10} {2:>10} {3:>10} {4:>10}'.format('n', 'step',
+            'vector/s', 'loop/s', 'speedup')
+    for size in sizes:
+        np.random.seed(1)
+        dm = DistanceMatrix([None] * size)
+        dm.matrix = random_matrix(size)
+        M = dm.matrix
+
+        (knn, knn_time) = timed(dm.get_knn, K)
+        (aff, aff_time) = timed(dm.get_affinity_matrix, knn[0], knn[1])
+        np.random.seed(2)
+        (noisy, noise_time) = timed(dm.add_noise)
+        rows = [('knn', knn_time), ('affinity', aff_time), ('noise',
+                noise_time)]
+
+        if size <= LOOP_LIMIT:
+            (ref_knn, ref_knn_time) = timed(loop_knn, M, K)
+            (ref_aff, ref_aff_time) = timed(loop_affinity, M, ref_knn[0],
+                    ref_knn[1])
+            np.random.seed(2)
+            (ref_noisy, ref_noise_time) = timed(loop_noise, M)
+            assert (knn[0] == ref_knn[0]).all()
+            assert knn[1] == ref_knn[1]
+            assert np.allclose(aff, ref_aff, rtol=1e-12, atol=0)
+            assert (noisy == ref_noisy).all()
+            loops = [ref_knn_time, ref_aff_time, ref_noise_time]
+        else:
+            loops = [None] * 3
+
+        for ((step, vector_time), loop_time) in zip(rows, loops):
+            print '{0:>6} {1:>10} {2:>10.3f} {3:>10} {4:>10}'.format(size,
+                    step, vector_time, ('-' if loop_time is None
+                     else '{0:.3f}'.format(loop_time)), ('-'
+                     if loop_time is None else '{0:.0f}x'.format(loop_time
+                    / vector_time)))
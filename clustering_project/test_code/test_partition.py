@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+"""
+Checks that Partition's pairwise measures agree with compare_many, including
+for single-cluster partitions (zero entropy), where NMI is 1.0.
+
+usage: test_partition.py
+"""
+
+import warnings
+import numpy as np
+from partition import Partition
+
+CASES = [([1, 1, 1, 1], [2, 2, 2, 2]), ([1, 1, 1, 1], [1, 2, 1, 2]),
+         ([1, 1, 2, 2], [1, 2, 1, 2]), ([1, 1, 2, 2, 3], [3, 3, 1, 1, 2])]
+
+
+def check(partition_1, partition_2):
+    p = Partition(partition_1)
+    pairwise = {'vi': p.variation_of_information(partition_1,
+                partition_2),
+                'nmi': p.normalised_mutual_information(partition_1,
+                partition_2),
+                'ari': p.adjusted_rand_index(partition_1, partition_2)}
+    for measure in ('vi', 'nmi', 'ari'):
+        many = Partition.compare_many(partition_1, [partition_2],
+                                      measure)[0]
+        assert np.isclose(pairwise[measure], many), (partition_1,
+                partition_2, measure, pairwise[measure], many)
+
+
+if __name__ == '__main__':
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for (partition_1, partition_2) in CASES:
+            check(partition_1, partition_2)
+        p = Partition([1, 1, 1, 1])
+        assert p.normalised_mutual_information([1, 1, 1, 1], [2, 2, 2,
+                2]) == 1.0
+    print 'ok'